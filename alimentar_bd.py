@@ -1,9 +1,17 @@
 # alimentar_banco.py
 import os
+import argparse
+import hashlib
+import time
 import pandas as pd
+from collections import Counter
 from datetime import datetime
+from sqlalchemy import func
+from sqlalchemy.orm import selectinload
 from app import app, db
-from app import Convenio, Setor, Responsavel, TipoErro, Causa, Prontuario, Erro
+from app import Convenio, Setor, Responsavel, TipoErro, Causa, Prontuario, Erro, CargaOrigem
+from app import migrar_schema, configurar_busca_textual, reconstruir_resumo_diario, _atualizar_contadores_erro
+from app import cadastrando_novos
 
 # --- DADOS DE CONFIGURAÇÃO (EMBUTIDOS) ---
 
@@ -121,7 +129,12 @@ for tipo_key, causas_lista in CAUSAS_PADRONIZADAS.items():
         MAPA_CAUSA_PARA_TIPO_NOME[causa_desc.strip().lower()] = nome_tipo
 
 
+CSV_PADRAO = 'Auditoria unique - lu.xlsx - OUTUBRO 2025 HU.csv'
+TAMANHO_LOTE = 500  # atendimentos gravados por commit
+
+
 def _parse_any_date_for_migration(s):
+    s = str(s).strip()
     if not s: return None
     try:
         return datetime.fromisoformat(s)
@@ -138,131 +151,247 @@ def _parse_any_date_for_migration(s):
 def normalize_key(text):
     return str(text).strip().lower()
 
-def main():
-    with app.app_context():
-        print("=== MIGRAÇÃO INICIADA ===")
-        # 1. Apagar e recriar tabelas
-        db.drop_all()
-        db.create_all()
-        print("✅ Banco criado")
+def hash_atendimento(linhas):
+    """sha256 das linhas de origem de um atendimento (já serializadas, na ordem do arquivo)"""
+    return hashlib.sha256('\n'.join(linhas).encode('utf-8')).hexdigest()
 
-        # 2. Migrar Configurações
-        print("📋 Migrando configurações...")
-        tipos_erro_map = {} # para consulta rápida
-        
-        # Migrar Tipos de Erro
-        for tipo_key, tipo_info in TIPOS_ERRO_PADRAO.items():
-            novo_tipo = TipoErro(
-                nome=tipo_info['nome'], # Ex: "Documentação"
-                descricao=f"Erros relacionados a {tipo_info['nome'].lower()}",
-                cor=tipo_info.get('cor', '#dc3545'),
-                status='ativo'
-            )
-            db.session.add(novo_tipo)
-        db.session.commit()
-        
-        tipos_salvos = TipoErro.query.all()
-        tipos_erro_map_lower = {t.nome.lower(): t.id for t in tipos_salvos} # ex: 'documentação' -> 1
-        print(f"  -> {len(tipos_erro_map_lower)} Tipos de Erro migrados.")
+def dados_prontuario(row):
+    """Campos do prontuário vindos da primeira linha do atendimento"""
+    return {
+        'beneficiario': str(row['Beneficiario']).strip(),
+        'convenio': str(row['Convênio']).strip(),
+        'setor': str(row['Setor']).strip(),
+        'status': row.get('STATUS') or row.get('Status') or 'Aguardando Auditoria',
+        'admissao': _parse_any_date_for_migration(row['Admissão']),
+        'alta': _parse_any_date_for_migration(row['Alta']),
+        'recebimento_prontuario': _parse_any_date_for_migration(row['Recebimento do Prontuário']),
+        'enviado_faturamento': _parse_any_date_for_migration(row['Envio para Correção']),
+    }
+
+def migrar_configuracoes():
+    """Cria tipos de erro, causas, convênios, setores e responsáveis padrão que ainda não existem"""
+    tipos_existentes = {t.nome for t in TipoErro.query.all()}
+    for tipo_key, tipo_info in TIPOS_ERRO_PADRAO.items():
+        if tipo_info['nome'] in tipos_existentes:
+            continue
+        novo_tipo = TipoErro(
+            nome=tipo_info['nome'], # Ex: "Documentação"
+            descricao=f"Erros relacionados a {tipo_info['nome'].lower()}",
+            cor=tipo_info.get('cor', '#dc3545'),
+            status='ativo'
+        )
+        db.session.add(novo_tipo)
+    db.session.commit()
+    
+    tipos_salvos = TipoErro.query.all()
+    tipos_erro_map_lower = {t.nome.lower(): t.id for t in tipos_salvos} # ex: 'documentação' -> 1
+    print(f"  -> {len(tipos_erro_map_lower)} Tipos de Erro no banco.")
 
-        # Migrar Causas
-        causas_count = 0
-        for tipo_key, causas_lista in CAUSAS_PADRONIZADAS.items():
-            tipo_nome = TIPOS_ERRO_PADRAO[tipo_key]['nome']
-            tipo_id = tipos_erro_map_lower.get(tipo_nome.lower())
+    # Migrar Causas
+    causas_existentes = {(c.tipo_erro_id, c.descricao) for c in Causa.query.all()}
+    causas_count = 0
+    for tipo_key, causas_lista in CAUSAS_PADRONIZADAS.items():
+        tipo_nome = TIPOS_ERRO_PADRAO[tipo_key]['nome']
+        tipo_id = tipos_erro_map_lower.get(tipo_nome.lower())
+        
+        if not tipo_id:
+            print(f"  ERRO FATAL: Não foi possível encontrar o ID para o tipo '{tipo_nome}'")
+            continue
             
-            if not tipo_id:
-                print(f"  ERRO FATAL: Não foi possível encontrar o ID para o tipo '{tipo_nome}'")
+        for causa_desc in causas_lista:
+            if (tipo_id, causa_desc) in causas_existentes:
                 continue
-                
-            for causa_desc in causas_lista:
-                nova_causa = Causa(
-                    descricao=causa_desc,
-                    status='ativo',
-                    tipo_erro_id=tipo_id
-                )
-                db.session.add(nova_causa)
-                causas_count += 1
-        print(f"  -> {causas_count} Causas migradas.")
+            nova_causa = Causa(
+                descricao=causa_desc,
+                status='ativo',
+                tipo_erro_id=tipo_id
+            )
+            db.session.add(nova_causa)
+            causas_count += 1
+    print(f"  -> {causas_count} Causas migradas.")
 
-        # Migrar Convenios, Setores, Responsaveis
-        for nome_conv in CONVENIOS_PADRAO:
-            db.session.add(Convenio(nome=nome_conv))
-        print(f"  -> {len(CONVENIOS_PADRAO)} Convênios migrados.")
-        
-        for nome_setor in SETORES_PADRAO:
-            db.session.add(Setor(nome=nome_setor, descricao=f'Setor de {nome_setor}'))
-        print(f"  -> {len(SETORES_PADRAO)} Setores migrados.")
+    # Migrar Convenios, Setores, Responsaveis
+    convenios_existentes = {c.nome for c in Convenio.query.all()}
+    novos_convenios = [n for n in CONVENIOS_PADRAO if n not in convenios_existentes]
+    for nome_conv in novos_convenios:
+        db.session.add(Convenio(nome=nome_conv))
+    print(f"  -> {len(novos_convenios)} Convênios migrados.")
+    
+    setores_existentes = {s.nome for s in Setor.query.all()}
+    novos_setores = [n for n in SETORES_PADRAO if n not in setores_existentes]
+    for nome_setor in novos_setores:
+        db.session.add(Setor(nome=nome_setor, descricao=f'Setor de {nome_setor}'))
+    print(f"  -> {len(novos_setores)} Setores migrados.")
 
-        for nome_resp in RESPONSAVEIS_PADRAO:
-            funcao = 'Auditor' if 'Auditor' in nome_resp else 'Enfermeiro' if 'Enfermeiro' in nome_resp else 'Médico' if 'Médico' in nome_resp else 'Coordenador'
-            setor_resp = 'Auditoria' if 'Auditor' in nome_resp else 'Enfermagem' if 'Enfermeiro' in nome_resp else 'Médico' if 'Médico' in nome_resp else 'Coordenação'
-            db.session.add(Responsavel(nome=nome_resp, funcao=funcao, setor_resp=setor_resp))
-        print(f"  -> {len(RESPONSAVEIS_PADRAO)} Responsáveis migrados.")
-        
+    responsaveis_existentes = {r.nome for r in Responsavel.query.all()}
+    novos_responsaveis = [n for n in RESPONSAVEIS_PADRAO if n not in responsaveis_existentes]
+    for nome_resp in novos_responsaveis:
+        funcao = 'Auditor' if 'Auditor' in nome_resp else 'Enfermeiro' if 'Enfermeiro' in nome_resp else 'Médico' if 'Médico' in nome_resp else 'Coordenador'
+        setor_resp = 'Auditoria' if 'Auditor' in nome_resp else 'Enfermagem' if 'Enfermeiro' in nome_resp else 'Médico' if 'Médico' in nome_resp else 'Coordenação'
+        db.session.add(Responsavel(nome=nome_resp, funcao=funcao, setor_resp=setor_resp))
+    print(f"  -> {len(novos_responsaveis)} Responsáveis migrados.")
+    
+    db.session.commit()
+
+class _CargaProntuarios:
+    """Mapas carregados uma vez (hash, id do prontuário e responsáveis) e o resumo da carga"""
+
+    def __init__(self):
+        self.hashes = dict(db.session.query(CargaOrigem.atendimento, CargaOrigem.hash_conteudo))
+        self.prontuario_ids = {atendimento: id_ for id_, atendimento in
+                               db.session.query(func.min(Prontuario.id), Prontuario.atendimento)
+                               .group_by(Prontuario.atendimento)}
+        self.responsaveis = {r.nome: r for r in Responsavel.query.all()}
+        self.resumo = {'inseridos': 0, 'atualizados': 0, 'ignorados': 0,
+                       'linhas_inseridas': 0, 'linhas_atualizadas': 0, 'linhas_ignoradas': 0}
+
+    def responsavel(self, nome):
+        if not nome:
+            return None
+        if nome not in self.responsaveis:
+            self.responsaveis[nome] = Responsavel(nome=nome, status='ativo')
+            db.session.add(self.responsaveis[nome])
+        return self.responsaveis[nome]
+
+    def gravar_lote(self, lote):
+        """Insere os atendimentos novos e atualiza no lugar os que mudaram; um commit por lote"""
+        existentes = {p.id: p for p in Prontuario.query
+                      .options(selectinload(Prontuario.erros), selectinload(Prontuario.responsaveis))
+                      .filter(Prontuario.id.in_([self.prontuario_ids[a] for a, _, _ in lote
+                                                 if a in self.prontuario_ids]))}
+        gravados = []
+        for atendimento, linhas, hash_ in lote:
+            erros_origem = []
+            for linha in linhas:
+                erro_desc_limpa = str(linha['Causa']).strip()
+                if not erro_desc_limpa:
+                    continue
+                # Encontra o Nome do Tipo (ex: "Materiais")
+                tipo_nome = MAPA_CAUSA_PARA_TIPO_NOME.get(normalize_key(erro_desc_limpa), 'Documentação')
+                erros_origem.append((tipo_nome, erro_desc_limpa,
+                                     self.responsavel(str(linha['Responsavel']).strip())))
+
+            prontuario = existentes.get(self.prontuario_ids.get(atendimento))
+            if prontuario is None:
+                prontuario = Prontuario(atendimento=atendimento, observacao='', **dados_prontuario(linhas[0]))
+                db.session.add(prontuario)
+                chave, chave_linhas = 'inseridos', 'linhas_inseridas'
+            else:
+                for campo, valor in dados_prontuario(linhas[0]).items():
+                    setattr(prontuario, campo, valor)
+                chave, chave_linhas = 'atualizados', 'linhas_atualizadas'
+            self.resumo[chave] += 1
+            self.resumo[chave_linhas] += len(linhas)
+
+            for responsavel in {r for _, _, r in erros_origem if r is not None}:
+                if responsavel not in prontuario.responsaveis:
+                    prontuario.responsaveis.append(responsavel)
+
+            # Erros: uma linha por (tipo, causa, responsável) com a quantidade da origem;
+            # as que saíram da origem são removidas e as que faltam, criadas
+            quantidades = Counter(erros_origem)
+            for erro in list(prontuario.erros):
+                chave_erro = (erro.tipo, erro.causa, erro.responsavel)
+                if chave_erro in quantidades:
+                    erro.quantidade = quantidades.pop(chave_erro)
+                else:
+                    prontuario.erros.remove(erro)
+            for (tipo_nome, causa, responsavel), qtd in quantidades.items():
+                prontuario.erros.append(Erro(tipo=tipo_nome, causa=causa, responsavel=responsavel, quantidade=qtd))
+            gravados.append((atendimento, prontuario, hash_))
+
+        db.session.flush()
+        tabela = CargaOrigem.__table__
+        agora = datetime.now()
+        novos = [{'atendimento': a, 'hash_conteudo': h, 'data_atualizacao': agora}
+                 for a, _, h in gravados if a not in self.hashes]
+        alterados = [{'_atendimento': a, 'hash_conteudo': h, 'data_atualizacao': agora}
+                     for a, _, h in gravados if a in self.hashes]
+        if novos:
+            db.session.execute(tabela.insert(), novos)
+        if alterados:
+            db.session.execute(tabela.update().where(tabela.c.atendimento == db.bindparam('_atendimento')),
+                               alterados)
+        _atualizar_contadores_erro([p.id for _, p, _ in gravados])
         db.session.commit()
+        for atendimento, prontuario, hash_ in gravados:
+            self.hashes[atendimento] = hash_
+            self.prontuario_ids[atendimento] = prontuario.id
+        db.session.expunge_all()
+        self.responsaveis = {r.nome: r for r in Responsavel.query.all()}
+
+def carregar_prontuarios(df):
+    """
+    Carrega o CSV agrupado por atendimento. Atendimentos cujo hash de conteúdo não mudou
+    desde a última carga são ignorados sem tocar no banco; os que mudaram são atualizados
+    no lugar e os novos são inseridos. Retorna o resumo com as contagens.
+    """
+    df = df.fillna('')
+    df['Atendimento'] = df['Atendimento'].astype(str).str.strip()
+    df = df[df['Atendimento'] != ''].reset_index(drop=True)
+    # Cada linha serializada com todas as colunas (em ordem fixa) alimenta o hash do atendimento
+    colunas = sorted(df.columns)
+    linhas_texto = ['\x1f'.join(valores) for valores in zip(*(df[c].astype(str).tolist() for c in colunas))]
+    registros = df.to_dict('records')
+    grupos = sorted(df.groupby('Atendimento', sort=False).indices.items(), key=lambda item: item[1][0])
+    print(f"📊 Encontrados {len(grupos)} prontuários únicos no CSV.")
+
+    carga = _CargaProntuarios()
+    lote = []
+    for atendimento, posicoes in grupos:
+        hash_ = hash_atendimento(linhas_texto[i] for i in posicoes)
+        if carga.hashes.get(atendimento) == hash_ and atendimento in carga.prontuario_ids:
+            carga.resumo['ignorados'] += 1
+            carga.resumo['linhas_ignoradas'] += len(posicoes)
+            continue
+        lote.append((atendimento, [registros[i] for i in posicoes], hash_))
+        if len(lote) >= TAMANHO_LOTE:
+            carga.gravar_lote(lote)
+            lote = []
+            print(f"  ⏳ {carga.resumo['inseridos']} inseridos, {carga.resumo['atualizados']} atualizados...")
+    if lote:
+        carga.gravar_lote(lote)
+    return carga.resumo
+
+def main(incremental=False, csv_path=CSV_PADRAO):
+    with app.app_context():
+        inicio = time.perf_counter()
+        if incremental:
+            print("=== CARGA INCREMENTAL INICIADA ===")
+        else:
+            print("=== MIGRAÇÃO INICIADA ===")
+            # 1. Apagar e recriar tabelas (schema_version junto: as migrações rodam todas de novo)
+            db.drop_all()
+        migrar_schema()
+        configurar_busca_textual()
+        print("✅ Banco criado")
+
+        # 2. Migrar Configurações
+        print("📋 Migrando configurações...")
+        migrar_configuracoes()
         print("✅ Configurações migradas!")
 
         # 3. Migrar Prontuários do CSV
         print("📁 Migrando prontuários do CSV...")
-        csv_path = 'Auditoria unique - lu.xlsx - OUTUBRO 2025 HU.csv'
         try:
             df = pd.read_csv(csv_path)
-            df = df.fillna('')
-            grouped = df.groupby('Atendimento')
-            total_prontuarios = len(grouped)
-            print(f"📊 Encontrados {total_prontuarios} prontuários únicos no CSV.")
-            
-            count = 0
-            for atendimento_id, erros_df in grouped:
-                first_row = erros_df.iloc[0]
-                
-                novo_prontuario = Prontuario(
-                    beneficiario=first_row['Beneficiario'],
-                    convenio=first_row['Convênio'],
-                    setor=first_row['Setor'],
-                    atendimento=str(atendimento_id),
-                    responsavel=first_row['Responsavel'],
-                    status=first_row['STATUS'] or first_row['Status'] or 'Aguardando Auditoria',
-                    observacao='',
-                    
-                    admissao=_parse_any_date_for_migration(first_row['Admissão']),
-                    alta=_parse_any_date_for_migration(first_row['Alta']),
-                    recebimento_prontuario=_parse_any_date_for_migration(first_row['Recebimento do Prontuário']),
-                    inicio_auditoria=_parse_any_date_for_migration(first_row['Início da Auditoria']),
-                    enviado_faturamento=_parse_any_date_for_migration(first_row['Envio para Correção']),
-                )
-                
-                for erro_desc in erros_df['Causa']:
-                    if not erro_desc:
-                        continue
-                    
-                    erro_desc_limpa = str(erro_desc).strip()
-                    chave_causa = normalize_key(erro_desc_limpa)
-                    
-                    # Encontra o Nome do Tipo (ex: "Materiais")
-                    tipo_nome = MAPA_CAUSA_PARA_TIPO_NOME.get(chave_causa, 'Documentação')
-
-                    novo_erro = Erro(
-                        tipo=tipo_nome,
-                        causa=erro_desc_limpa
-                    )
-                    novo_prontuario.erros.append(novo_erro)
-                
-                db.session.add(novo_prontuario)
-                count += 1
-                if count % 20 == 0:
-                    print(f"  ⏳ Processando {count}/{total_prontuarios}...")
+            # Convênios, setores e causas do CSV fora dos cadastros entram como inativos
+            with cadastrando_novos():
+                resumo = carregar_prontuarios(df)
+            if resumo['inseridos'] or resumo['atualizados']:
+                reconstruir_resumo_diario()
 
-            db.session.commit()
-            print(f"✅ Migração concluída! {count} prontuários processados.")
+            print(f"✅ Migração concluída em {time.perf_counter() - inicio:.1f}s!")
+            print(f"   Inseridos:   {resumo['inseridos']} prontuários ({resumo['linhas_inseridas']} linhas)")
+            print(f"   Atualizados: {resumo['atualizados']} prontuários ({resumo['linhas_atualizadas']} linhas)")
+            print(f"   Sem mudança: {resumo['ignorados']} prontuários ({resumo['linhas_ignoradas']} linhas)")
             
             total_no_bd = db.session.query(func.count(Prontuario.id)).scalar()
             print(f"📈 Prontuários no banco: {total_no_bd}")
 
         except FileNotFoundError:
             print(f"❌ ERRO FATAL: O arquivo CSV '{csv_path}' não foi encontrado.")
-            print("Por favor, coloque o arquivo 'Auditoria unique - lu.xlsx - OUTUBRO 2025 HU.csv' na mesma pasta do script.")
+            print(f"Por favor, coloque o arquivo '{CSV_PADRAO}' na mesma pasta do script.")
         except Exception as e:
             db.session.rollback()
             print(f"❌ ERRO DURANTE A MIGRAÇÃO DOS PRONTUÁRIOS: {e}")
@@ -270,4 +399,9 @@ def main():
             traceback.print_exc()
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Carrega configurações e prontuários do CSV no banco.')
+    parser.add_argument('csv', nargs='?', default=CSV_PADRAO, help='arquivo CSV de origem')
+    parser.add_argument('--incremental', action='store_true',
+                        help='não apaga o banco: só grava atendimentos novos ou alterados desde a última carga')
+    args = parser.parse_args()
+    main(incremental=args.incremental, csv_path=args.csv)
@@ -1,11 +1,33 @@
 import os
+import io
+import csv
 import json
-from flask import Flask, render_template, request, jsonify, redirect, url_for
+import tempfile
+from flask import Flask, render_template, request, jsonify, redirect, url_for, Response, stream_with_context, g, has_request_context, make_response
 from flask_sqlalchemy import SQLAlchemy
+from markupsafe import escape
 from datetime import datetime, date, timedelta
-from collections import Counter, defaultdict
+from collections import Counter, defaultdict, namedtuple
 import traceback
-from sqlalchemy import extract, func
+import re
+import threading
+import time
+import queue
+import heapq
+import sqlite3
+from concurrent.futures import Future
+from collections import OrderedDict
+from functools import wraps
+from contextlib import contextmanager, nullcontext
+from sqlalchemy import func, text, event, create_engine
+from sqlalchemy.exc import IntegrityError, OperationalError, ProgrammingError
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.hybrid import hybrid_property, Comparator
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import BinaryExpression, BindParameter, BooleanClauseList
+from sqlalchemy.schema import CreateTable
+from sqlalchemy.pool import QueuePool
 from calendar import monthrange, month_name
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
@@ -32,10 +54,100 @@ data_dir = os.path.join(basedir, 'data')
 os.makedirs(data_dir, exist_ok=True)
 db_path = os.path.join(data_dir, 'auditoria.db')
 
-app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_path}'
+# Backend: PostgreSQL se DATABASE_URL estiver definida, senão o SQLite local em data/auditoria.db
+DATABASE_URL = os.getenv('DATABASE_URL', '')
+if DATABASE_URL.startswith('postgres://'):
+    DATABASE_URL = 'postgresql://' + DATABASE_URL[len('postgres://'):]  # formato antigo (Heroku/Vercel)
+app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL or f'sqlite:///{db_path}'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['CACHE_RESULTADOS_TTL'] = int(os.getenv('CACHE_RESULTADOS_TTL', 300))
+app.config['CACHE_RESULTADOS_MAX_ITENS'] = int(os.getenv('CACHE_RESULTADOS_MAX_ITENS', 64))
+app.config['CACHE_REFERENCIA_TTL'] = int(os.getenv('CACHE_REFERENCIA_TTL', 3600))
+app.config['PRONTUARIOS_POR_PAGINA'] = int(os.getenv('PRONTUARIOS_POR_PAGINA', 50))
+app.config['PRONTUARIOS_POR_PAGINA_MAX'] = 200
+app.config['LOTE_PRONTUARIOS_MAX'] = 500
+app.config['MIGRAR_SCHEMA_AO_INICIAR'] = os.getenv('MIGRAR_SCHEMA_AO_INICIAR', '1') == '1'
+app.config['ESCRITA_AGRUPADA'] = os.getenv('ESCRITA_AGRUPADA', '0') == '1'
+app.config['ESCRITA_GRUPO_MAX'] = int(os.getenv('ESCRITA_GRUPO_MAX', 50))
+app.config['ESCRITA_GRUPO_INTERVALO_MS'] = int(os.getenv('ESCRITA_GRUPO_INTERVALO_MS', 5))
+app.config['ESCRITA_TIMEOUT'] = 30
+
+# statement_timeout do PostgreSQL por classe de rota (ver limite_tempo_consulta); 0 = sem limite
+app.config['DB_TEMPOS_LIMITE_MS'] = {
+    'padrao': int(os.getenv('DB_TIMEOUT_PADRAO_MS', 15000)),
+    'relatorio': int(os.getenv('DB_TIMEOUT_RELATORIO_MS', 120000)),
+    'lote': int(os.getenv('DB_TIMEOUT_LOTE_MS', 600000)),
+}
+if app.config['SQLALCHEMY_DATABASE_URI'].startswith('postgresql'):
+    # Pool por processo: workers x (DB_POOL_SIZE + DB_MAX_OVERFLOW) precisa caber no max_connections
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'poolclass': QueuePool,
+        'pool_size': int(os.getenv('DB_POOL_SIZE', 10)),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', 20)),
+        'pool_timeout': int(os.getenv('DB_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': True,
+        'connect_args': {
+            'application_name': os.getenv('DB_APPLICATION_NAME', 'auditoria'),
+            'options': f"-c statement_timeout={app.config['DB_TEMPOS_LIMITE_MS']['padrao']}",
+        },
+    }
+
+# Perfil do SQLite aplicado em cada conexão (sobrescreva com SQLITE_<PRAGMA>, ex.: SQLITE_CACHE_SIZE)
+PRAGMAS_SQLITE_PADRAO = {
+    'journal_mode': 'WAL',        # leitores não bloqueiam o escritor
+    'synchronous': 'NORMAL',      # seguro com WAL; fsync só nos checkpoints
+    'busy_timeout': 5000,         # ms esperando o lock de escrita antes de "database is locked"
+    'cache_size': -65536,         # negativo = KiB (64 MB por conexão)
+    'mmap_size': 268435456,       # 256 MB de leitura via mmap
+    'temp_store': 'MEMORY',       # ordenações/tabelas temporárias em memória
+}
+app.config['SQLITE_PRAGMAS'] = {nome: os.getenv(f'SQLITE_{nome.upper()}', valor)
+                                for nome, valor in PRAGMAS_SQLITE_PADRAO.items()}
+app.config['SQLITE_MANUTENCAO_INTERVALO'] = int(os.getenv('SQLITE_MANUTENCAO_INTERVALO', 3600))  # segundos; 0 desliga
+app.config['SQLITE_ANALYZE_A_CADA'] = int(os.getenv('SQLITE_ANALYZE_A_CADA', 24))  # ANALYZE completo a cada N rodadas
+
+# Arquivo (frio): prontuários entregues ao faturamento há mais de ARQUIVO_IDADE_DIAS saem das tabelas
+# quentes para um banco à parte com o mesmo schema (ver arquivar_prontuarios). No SQLite o padrão é
+# data/arquivo.db; com PostgreSQL o arquivo só existe se ARQUIVO_DATABASE_URL for definida.
+ARQUIVO_DATABASE_URL = os.getenv('ARQUIVO_DATABASE_URL', '')
+if ARQUIVO_DATABASE_URL.startswith('postgres://'):
+    ARQUIVO_DATABASE_URL = 'postgresql://' + ARQUIVO_DATABASE_URL[len('postgres://'):]
+app.config['ARQUIVO_DATABASE_URL'] = ARQUIVO_DATABASE_URL or (
+    '' if DATABASE_URL else f"sqlite:///{os.path.join(data_dir, 'arquivo.db')}")
+app.config['ARQUIVO_IDADE_DIAS'] = int(os.getenv('ARQUIVO_IDADE_DIAS', 180))
+app.config['ARQUIVO_LOTE'] = int(os.getenv('ARQUIVO_LOTE', 1000))
 db = SQLAlchemy(app)
 
+@event.listens_for(Engine, 'connect')
+def _aplicar_pragmas_sqlite(conexao_dbapi, registro):
+    if not isinstance(conexao_dbapi, sqlite3.Connection):
+        return
+    cursor = conexao_dbapi.cursor()
+    for nome, valor in app.config['SQLITE_PRAGMAS'].items():
+        if valor not in (None, ''):
+            cursor.execute(f'PRAGMA {nome}={valor}')
+    cursor.close()
+
+def limite_tempo_consulta(classe):
+    """Usa o statement_timeout da classe ('relatorio', 'lote') nas transações da rota (só PostgreSQL)"""
+    def decorador(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            g.limite_tempo_consulta = classe
+            return f(*args, **kwargs)
+        return wrapper
+    return decorador
+
+@event.listens_for(Session, 'after_begin')
+def _aplicar_limite_tempo_consulta(sessao, transacao, conexao):
+    # O padrão vem do connect_args; SET LOCAL vale só até o fim da transação
+    if conexao.dialect.name != 'postgresql' or not has_request_context():
+        return
+    classe = g.get('limite_tempo_consulta')
+    if classe and classe != 'padrao':
+        conexao.exec_driver_sql(f"SET LOCAL statement_timeout = {int(app.config['DB_TEMPOS_LIMITE_MS'][classe])}")
+
 STATUS_OPCOES = [
     "Aguardando Auditoria",
     "Em Auditoria", 
@@ -49,7 +161,10 @@ STATUS_OPCOES = [
 # Tabelas de associação PRIMEIRO
 prontuario_responsavel_association = db.Table('prontuario_responsavel_association',
     db.Column('prontuario_id', db.Integer, db.ForeignKey('prontuario.id'), primary_key=True),
-    db.Column('responsavel_id', db.Integer, db.ForeignKey('responsavel.id'), primary_key=True)
+    db.Column('responsavel_id', db.Integer, db.ForeignKey('responsavel.id'), primary_key=True),
+    # A PK (prontuario_id, responsavel_id) só serve a busca por prontuário; este índice serve
+    # o caminho inverso (filtro por responsável, prontuários de um responsável)
+    db.Index('ix_prontuario_responsavel_inverso', 'responsavel_id', 'prontuario_id')
 )
 
 # Tabela de relacionamento entre responsáveis e categorias de erro
@@ -57,7 +172,8 @@ responsavel_categoria_association = db.Table('responsavel_categoria_association'
     db.Column('responsavel_id', db.Integer, db.ForeignKey('responsavel.id'), primary_key=True),
     db.Column('categoria_erro_id', db.Integer, db.ForeignKey('categoria_erro.id'), primary_key=True),
     db.Column('data_inicio', db.DateTime, default=datetime.now),
-    db.Column('data_fim', db.DateTime, nullable=True)
+    db.Column('data_fim', db.DateTime, nullable=True),
+    db.Index('ix_responsavel_categoria_inverso', 'categoria_erro_id', 'responsavel_id')
 )
 
 # Modelos base PRIMEIRO
@@ -116,7 +232,7 @@ class Setor(db.Model):
 
 class TipoErro(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    nome = db.Column(db.String(50), unique=True, nullable=False)
+    nome = db.Column(db.String(100), unique=True, nullable=False)
     descricao = db.Column(db.String(200))
     cor = db.Column(db.String(20), default='#dc3545')
     status = db.Column(db.String(20), nullable=False, default='ativo')
@@ -136,6 +252,11 @@ class TipoErro(db.Model):
         }
 
 class Causa(db.Model):
+    # Chave do dicionário de causas dos erros (ver id_catalogo)
+    __table_args__ = (
+        db.Index('ix_causa_tipo_erro_descricao', 'tipo_erro_id', 'descricao'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     descricao = db.Column(db.String(300), nullable=False)
     status = db.Column(db.String(20), nullable=False, default='ativo')
@@ -209,15 +330,78 @@ class Responsavel(db.Model):
             'categorias_erro': [ce.to_dict() for ce in self.categorias_erro]
         }
 
+class StatusProntuario(db.Model):
+    """Status possíveis do prontuário (STATUS_OPCOES e os que vieram de importações)"""
+    id = db.Column(db.Integer, primary_key=True)
+    nome = db.Column(db.String(50), unique=True, nullable=False)
+
+# Convênio, setor, status, tipo e causa ficam na tabela como FK para o cadastro (dicionário);
+# os atributos de texto (p.convenio, erro.causa...) leem e gravam pelo nome e, em filtros,
+# viram condição sobre o id. Gravar um texto fora do cadastro levanta ValueError (as rotas
+# validam antes e respondem 400). Ver texto_catalogo/id_catalogo.
+_OPERADORES_TEXTO = {
+    operators.eq, operators.ne, operators.lt, operators.le, operators.gt, operators.ge,
+    operators.in_op, operators.not_in_op, operators.like_op, operators.not_like_op,
+    operators.ilike_op, operators.not_ilike_op, operators.startswith_op, operators.endswith_op,
+    operators.contains_op,
+}
+
+class ComparadorCatalogo(Comparator):
+    """Filtro pelo texto vira filtro pela FK: coluna_id IN (SELECT id FROM cadastro WHERE texto ...)"""
+
+    def __init__(self, coluna_id, coluna_texto):
+        self.coluna_id = coluna_id
+        self.coluna_texto = coluna_texto
+        # Em SELECT/ORDER BY o atributo é o texto, por subconsulta correlacionada
+        super().__init__(db.select(coluna_texto)
+                         .where(coluna_texto.table.c.id == coluna_id)
+                         .scalar_subquery())
+
+    def operate(self, op, *other, **kwargs):
+        if op in (operators.is_, operators.is_not) or (op in (operators.eq, operators.ne) and other[0] is None):
+            return op(self.coluna_id, *other, **kwargs)
+        if op in _OPERADORES_TEXTO:
+            ids = db.select(self.coluna_texto.table.c.id).where(op(self.coluna_texto, *other, **kwargs))
+            return self.coluna_id.in_(ids)
+        return op(self.expression, *other, **kwargs)
+
+def coluna_texto_catalogo(modelo):
+    """Coluna de texto que identifica o item do cadastro (nome; descricao na Causa)"""
+    return modelo.__table__.c.descricao if modelo is Causa else modelo.__table__.c.nome
+
+def propriedade_catalogo(coluna_id, modelo):
+    """Atributo de texto sobre a FK `coluna_id` para `modelo` (leitura, escrita e filtro)"""
+    def ler(self):
+        return texto_catalogo(modelo, getattr(self, coluna_id))
+
+    def gravar(self, valor):
+        setattr(self, coluna_id, id_catalogo(modelo, valor))
+
+    def comparar(cls):
+        return ComparadorCatalogo(getattr(cls, coluna_id), coluna_texto_catalogo(modelo))
+
+    return hybrid_property(ler, gravar, custom_comparator=comparar)
+
 class Prontuario(db.Model):
+    # Filtros da listagem/relatórios combinados com o período (e a ordenação) por data_criacao
+    __table_args__ = (
+        db.Index('ix_prontuario_status_id_data_criacao', 'status_id', 'data_criacao'),
+        db.Index('ix_prontuario_convenio_id_data_criacao', 'convenio_id', 'data_criacao'),
+        db.Index('ix_prontuario_setor_id_data_criacao', 'setor_id', 'data_criacao'),
+        # AUTOINCREMENT: no SQLite um id apagado ou arquivado não volta a ser usado
+        {'sqlite_autoincrement': True},
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     beneficiario = db.Column(db.String(200), nullable=False)
-    convenio = db.Column(db.String(100), nullable=False)
-    setor = db.Column(db.String(100), nullable=False)
+    convenio_id = db.Column(db.Integer, db.ForeignKey('convenio.id'), nullable=False)
+    setor_id = db.Column(db.Integer, db.ForeignKey('setor.id'), nullable=False)
     atendimento = db.Column(db.String(50), nullable=False, index=True)
     admissao = db.Column(db.DateTime)
     alta = db.Column(db.DateTime)
-    status = db.Column(db.String(50), default='Aguardando Auditoria', index=True)
+    status_id = db.Column(db.Integer, db.ForeignKey('status_prontuario.id'),
+                          default=db.select(StatusProntuario.id)
+                          .where(StatusProntuario.nome == STATUS_OPCOES[0]).scalar_subquery())
     data_erro = db.Column(db.DateTime)
     recebimento_prontuario = db.Column(db.DateTime)
     data_conta = db.Column(db.DateTime)
@@ -227,38 +411,130 @@ class Prontuario(db.Model):
     observacao = db.Column(db.Text)
     data_criacao = db.Column(db.DateTime, default=datetime.now, index=True)
     data_atualizacao = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
+    # Contadores desnormalizados de erros, mantidos por _registrar_escrita (ver recalcular_contadores_erro)
+    erro_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    has_erro = db.Column(db.Boolean, nullable=False, default=False, server_default=db.false(), index=True)
+
+    convenio = propriedade_catalogo('convenio_id', Convenio)
+    setor = propriedade_catalogo('setor_id', Setor)
+    status = propriedade_catalogo('status_id', StatusProntuario)
     
     erros = db.relationship('Erro', backref='prontuario', cascade='all, delete-orphan')
     responsaveis = db.relationship('Responsavel', secondary=prontuario_responsavel_association, back_populates='prontuarios')
 
 # ÚNICA definição da classe Erro
 class Erro(db.Model):
+    __table_args__ = (
+        db.Index('ix_erro_tipo_erro_id_data_criacao', 'tipo_erro_id', 'data_criacao'),
+        {'sqlite_autoincrement': True},
+    )
+
     id = db.Column(db.Integer, primary_key=True)
-    prontuario_id = db.Column(db.Integer, db.ForeignKey('prontuario.id'), nullable=False)
-    tipo = db.Column(db.String(100), nullable=False)
-    causa = db.Column(db.String(300), nullable=False)
+    prontuario_id = db.Column(db.Integer, db.ForeignKey('prontuario.id'), nullable=False, index=True)
+    tipo_erro_id = db.Column(db.Integer, db.ForeignKey('tipo_erro.id'), nullable=False)
+    causa_id = db.Column(db.Integer, db.ForeignKey('causa.id'), nullable=False, index=True)
     data_criacao = db.Column(db.DateTime, default=datetime.now, index=True)
+    # Ocorrências deste mesmo erro (tipo, causa, responsável) no prontuário
+    quantidade = db.Column(db.Integer, nullable=False, default=1, server_default='1')
     
     # NOVOS CAMPOS: responsável específico e categoria
-    responsavel_id = db.Column(db.Integer, db.ForeignKey('responsavel.id'), nullable=True)
+    responsavel_id = db.Column(db.Integer, db.ForeignKey('responsavel.id'), nullable=True, index=True)
     categoria_erro_id = db.Column(db.Integer, db.ForeignKey('categoria_erro.id'), nullable=True)
     
     # Relacionamentos
     responsavel = db.relationship('Responsavel', backref='erros_atribuidos')
     categoria_erro = db.relationship('CategoriaErro', backref='erros')
 
+    @hybrid_property
+    def tipo(self):
+        return texto_catalogo(TipoErro, self.tipo_erro_id)
+
+    @tipo.setter
+    def tipo(self, valor):
+        causa = self.causa
+        self.tipo_erro_id = id_catalogo(TipoErro, valor)
+        if causa is not None:
+            self.causa = causa  # a causa é cadastrada por tipo: acompanha a troca
+
+    @tipo.comparator
+    def tipo(cls):
+        return ComparadorCatalogo(cls.tipo_erro_id, coluna_texto_catalogo(TipoErro))
+
+    @hybrid_property
+    def causa(self):
+        pendente = self.__dict__.get('_causa_pendente')
+        return pendente if pendente is not None else texto_catalogo(Causa, self.causa_id)
+
+    @causa.setter
+    def causa(self, valor):
+        # Sem o tipo ainda (Erro(causa=..., tipo=...)), a causa espera a atribuição do tipo
+        if self.tipo_erro_id is None:
+            self._causa_pendente = valor
+        else:
+            self._causa_pendente = None
+            self.causa_id = id_catalogo(Causa, valor, self.tipo_erro_id)
+
+    @causa.comparator
+    def causa(cls):
+        return ComparadorCatalogo(cls.causa_id, coluna_texto_catalogo(Causa))
+
     def to_dict(self):
         return {
             'id': self.id,
             'prontuario_id': self.prontuario_id,
             'tipo': self.tipo,
             'causa': self.causa,
+            'quantidade': self.quantidade,
             'responsavel_id': self.responsavel_id,
             'responsavel_nome': self.responsavel.nome if self.responsavel else None,
             'categoria_erro_id': self.categoria_erro_id,
             'categoria_erro_nome': self.categoria_erro.nome if self.categoria_erro else None
         }
 
+# Rollup diário das métricas do dashboard/relatórios, mantido na mesma transação das escritas
+class ResumoDiario(db.Model):
+    """
+    Linhas com tipo_erro_id=0 contam os prontuários criados no dia (qtd_prontuarios e
+    qtd_prontuarios_com_erro). Linhas com tipo_erro_id preenchido contam, em qtd_prontuarios,
+    os prontuários do dia que têm aquele tipo de erro e, em qtd_erros, os erros criados
+    no dia com aquele tipo e responsável (responsavel_id=0 quando não atribuído).
+    Setor, convênio e status são os ids dos cadastros (0 quando o prontuário não tem).
+    """
+    __table_args__ = (
+        db.UniqueConstraint('dia', 'setor_id', 'convenio_id', 'status_id', 'tipo_erro_id', 'responsavel_id',
+                            name='uq_resumo_diario_chave'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    dia = db.Column(db.Date, nullable=False, index=True)
+    setor_id = db.Column(db.Integer, nullable=False, default=0)
+    convenio_id = db.Column(db.Integer, nullable=False, default=0)
+    status_id = db.Column(db.Integer, nullable=False, default=0)
+    tipo_erro_id = db.Column(db.Integer, nullable=False, default=0)
+    responsavel_id = db.Column(db.Integer, nullable=False, default=0)
+    qtd_prontuarios = db.Column(db.Integer, nullable=False, default=0)
+    qtd_prontuarios_com_erro = db.Column(db.Integer, nullable=False, default=0)
+    qtd_erros = db.Column(db.Integer, nullable=False, default=0)
+
+# Hash do conteúdo de origem de cada atendimento (carga incremental do alimentar_bd.py)
+class CargaOrigem(db.Model):
+    atendimento = db.Column(db.String(50), primary_key=True)
+    hash_conteudo = db.Column(db.String(64), nullable=False)
+    data_atualizacao = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
+
+class VersaoSchema(db.Model):
+    """Migrações de schema já aplicadas (ver MIGRACOES_SCHEMA)"""
+    __tablename__ = 'schema_version'
+    versao = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    descricao = db.Column(db.String(200), nullable=False)
+    aplicada_em = db.Column(db.DateTime, default=datetime.now)
+
+class VersaoCache(db.Model):
+    """Versão dos dados de um cache, compartilhada entre os processos (ver CacheResultados)"""
+    __tablename__ = 'versao_cache'
+    nome = db.Column(db.String(50), primary_key=True)
+    versao = db.Column(db.Integer, nullable=False, default=0)
+
 # --- 3. FUNÇÕES HELPER (DATAS E CONVERSORES) ---
 
 def _parse_any_date(s):
@@ -305,12 +581,15 @@ def _to_iso_date(value) -> str:
     return dt.strftime("%Y-%m-%d") if dt else ""
 
 def get_tipos_erro_dict():
+    """Tipos de erro (com causas ativas) por nome; vem do cache de catálogos, não altere o retorno"""
     try:
-        tipos_erro_db = TipoErro.query.options(db.joinedload(TipoErro.causas)).all()
+        return cache_referencia.obter('tipos_erro', _carregar_tipos_erro_dict)
     except Exception as e:
         print(f"AVISO: Falha ao carregar Tipos de Erro: {e}")
         return {}
-        
+
+def _carregar_tipos_erro_dict():
+    tipos_erro_db = TipoErro.query.options(db.joinedload(TipoErro.causas)).all()
     tipos_erro_dict = {}
     for tipo in tipos_erro_db:
         chave = tipo.nome
@@ -327,24 +606,19 @@ def get_tipos_erro_dict():
 def prontuario_to_dict(p: Prontuario) -> dict:
     """Converte um prontuário para dicionário, incluindo todos os erros - VERSÃO CORRIGIDA"""
     try:
-        print(f"🔍 DEBUG prontuario_to_dict - ID: {p.id}")
-        
         # Carregar responsáveis
         responsaveis_nomes = [r.nome for r in p.responsaveis]
-        print(f"   👥 Responsáveis: {responsaveis_nomes}")
 
         # 🔥 CORREÇÃO CRÍTICA: Garantir que os erros estão carregados
+        # (chamada por linha na listagem e nos relatórios: nada de print aqui)
         erros_list = []
-        total_erros = len(p.erros) if p.erros else 0
-        print(f"   📝 Total de erros no objeto: {total_erros}")
-        
         if p.erros:
-            for i, erro in enumerate(p.erros):
+            for erro in p.erros:
                 erro_dict = {
                     'id': erro.id,
                     'tipo': erro.tipo,
                     'causa': erro.causa,
-                    'quantidade': 1,
+                    'quantidade': erro.quantidade,
                     'responsavel_id': erro.responsavel_id,
                     'responsavel_nome': erro.responsavel.nome if erro.responsavel else 'Não atribuído',
                     'categoria_erro_id': erro.categoria_erro_id,
@@ -352,9 +626,6 @@ def prontuario_to_dict(p: Prontuario) -> dict:
                     'data_criacao': _to_iso_date(erro.data_criacao)
                 }
                 erros_list.append(erro_dict)
-                print(f"   📝 Erro {i+1}: {erro.tipo} - {erro.causa}")
-        else:
-            print("   ⚠️  NENHUM ERRO CARREGADO para este prontuário")
 
         return {
             'id': p.id,
@@ -376,8 +647,8 @@ def prontuario_to_dict(p: Prontuario) -> dict:
             'data_criacao': _to_iso_date(p.data_criacao),
             'data_atualizacao': _to_iso_date(p.data_atualizacao),
             'erros': erros_list,
-            'total_erros': len(erros_list),
-            'tem_erros': len(erros_list) > 0  # 🔥 Campo adicional para facilitar filtros
+            'total_erros': p.erro_count,
+            'tem_erros': p.has_erro  # 🔥 Campo adicional para facilitar filtros
         }
         
     except Exception as e:
@@ -401,8 +672,7 @@ def prontuario_to_dict(p: Prontuario) -> dict:
 def get_categorias_erro_dict():
     """Busca todas as categorias de erro"""
     try:
-        categorias = CategoriaErro.query.filter_by(status='ativo').all()
-        return {cat.codigo: cat.to_dict() for cat in categorias}
+        return {cat['codigo']: cat for cat in categorias_erro_ativas()}
     except Exception as e:
         print(f"AVISO: Falha ao carregar Categorias de Erro: {e}")
         return {}
@@ -469,175 +739,41 @@ def _dif_dias(a, b):
     return max((b - a).days, 0)
 
 def _calc_tempos_medios(prontuarios):
-    tot_aud, n = 0, 0
-    for p in prontuarios:
-        rec = _parse_any_date(p.get("recebimento_prontuario", ""))
-        env = _parse_any_date(p.get("enviado_faturamento", ""))
-        if rec and env:
-            n += 1
-            tot_aud += _dif_dias(rec, env)
-    if n == 0:
-        return {"aguardando": 0, "auditoria": 0, "correcao": 0, "total": 0}
-    tempo_auditoria = round(tot_aud / n, 1)
-    return {"aguardando": 0, "auditoria": tempo_auditoria, "correcao": 0, "total": tempo_auditoria}
+    return StatsAccumulator(prontuarios).tempos_medios()
 
 def _calc_produtividade_diaria_mes(prontuarios_lista, ano, mes):
-    num_dias = monthrange(ano, mes)[1]
-    dias_do_mes = [date(ano, mes, dia) for dia in range(1, num_dias + 1)]
-    mapa = {d: 0 for d in dias_do_mes}
-    total_registrado = 0
-    
-    for p in prontuarios_lista:
-        dt = _pega_data_base(p)
-        if isinstance(dt, datetime):
-            dt = dt.date()
-        if dt and dt in mapa:
-            mapa[dt] += 1
-            total_registrado += 1
-            
-    labels = [d.strftime("%d/%m") for d in dias_do_mes]
-    valores = [mapa[d] for d in dias_do_mes]
-    return {"labels": labels, "valores": valores, "total_registrado": total_registrado}
+    return StatsAccumulator(prontuarios_lista).produtividade_diaria_mes(ano, mes)
 
-def _calc_erros_timeline_mensal():
-    labels = []
-    valores = []
-    hoje = datetime.now()
+def _calc_erros_timeline_mensal(meses=6):
+    """Total de erros por mês (últimos `meses` meses), em uma única query sobre o ResumoDiario"""
+    nome_mes_pt = {
+        1: 'Jan', 2: 'Fev', 3: 'Mar', 4: 'Abr', 5: 'Mai', 6: 'Jun',
+        7: 'Jul', 8: 'Ago', 9: 'Set', 10: 'Out', 11: 'Nov', 12: 'Dez'
+    }
+    limites = limites_periodo('mes', meses)
+    labels = [f"{nome_mes_pt[inicio.month]}/{inicio.year % 100}" for inicio, _ in limites]
     
-    for i in range(5, -1, -1):
-        ano = hoje.year
-        mes = hoje.month - i
-        if mes <= 0:
-            mes += 12
-            ano -= 1
-        
-        nome_mes_pt = {
-            1: 'Jan', 2: 'Fev', 3: 'Mar', 4: 'Abr', 5: 'Mai', 6: 'Jun',
-            7: 'Jul', 8: 'Ago', 9: 'Set', 10: 'Out', 11: 'Nov', 12: 'Dez'
-        }
-        labels.append(f"{nome_mes_pt[mes]}/{ano % 100}")
-        
-        try:
-            total_erros = db.session.query(func.count(Erro.id)).filter(
-                extract('year', Erro.data_criacao) == ano,
-                extract('month', Erro.data_criacao) == mes
-            ).scalar()
-            valores.append(total_erros or 0)
-        except Exception as e:
-            print(f"AVISO: Falha ao buscar timeline de erros: {e}")
-            valores.append(0)
+    try:
+        valores = serie_temporal(ResumoDiario.dia, func.sum(ResumoDiario.qtd_erros), limites)
+    except Exception as e:
+        print(f"AVISO: Falha ao buscar timeline de erros: {e}")
+        valores = [0] * len(limites)
     return {"labels": labels, "valores": valores}
 
 def _calc_taxa_erros_setor(prontuarios):
     """Calcula taxa APENAS para setores que tiveram prontuários COM ERROS"""
-    prontuarios_com_erro = [p for p in prontuarios if _tem_erro(p)]
-    total_com_erro = len(prontuarios_com_erro)
-    
-    if total_com_erro == 0:
-        return []
-    
-    # Conta quantos prontuários com erro cada setor teve
-    contagem_por_setor = Counter()
-    
-    for p in prontuarios_com_erro:
-        setor = _norm_setor(p)
-        contagem_por_setor[setor] += 1
-    
-    # Calcula a porcentagem em relação ao total de prontuários com erro
-    resultado = []
-    for setor, quantidade in contagem_por_setor.items():
-        taxa = round(100 * quantidade / total_com_erro, 1)
-        resultado.append({
-            'nome': setor,
-            'prontuarios_com_erro': quantidade,
-            'taxa': taxa
-        })
-    
-    return sorted(resultado, key=lambda x: x['taxa'], reverse=True)
+    return StatsAccumulator(prontuarios).taxa_erros_setor()
 
 def _calc_taxa_erros_convenio(prontuarios):
     """Calcula taxa APENAS para convênios que tiveram prontuários COM ERROS"""
-    prontuarios_com_erro = [p for p in prontuarios if _tem_erro(p)]
-    total_com_erro = len(prontuarios_com_erro)
-    
-    if total_com_erro == 0:
-        return []
-    
-    # Conta quantos prontuários com erro cada convênio teve
-    contagem_por_convenio = Counter()
-    
-    for p in prontuarios_com_erro:
-        convenio = _norm_convenio(p)
-        contagem_por_convenio[convenio] += 1
-    
-    # Calcula a porcentagem em relação ao total de prontuários com erro
-    resultado = []
-    for convenio, quantidade in contagem_por_convenio.items():
-        taxa = round(100 * quantidade / total_com_erro, 1)
-        resultado.append({
-            'nome': convenio,
-            'prontuarios_com_erro': quantidade,
-            'taxa': taxa
-        })
-    
-    return sorted(resultado, key=lambda x: x['taxa'], reverse=True)
+    return StatsAccumulator(prontuarios).taxa_erros_convenio()
 
 def _calc_top_erros(prontuarios_lista):
-    contagem_motivos = Counter()
-    contagem_causas = Counter()
-    
-    for p in prontuarios_lista:
-        if _tem_erro(p):
-            motivos_neste_prontuario = set() 
-            for erro in p.get("erros", []):
-                motivo = erro.get('tipo', 'Desconhecido')
-                causa = erro.get('causa', 'Desconhecida')
-                motivos_neste_prontuario.add(motivo)
-                contagem_causas[causa] += 1
-            for m in motivos_neste_prontuario:
-                contagem_motivos[m] += 1
-
-    mapa_tipos_erro = get_tipos_erro_dict()
-    top_motivos = []
-    for codigo, contagem in contagem_motivos.most_common(5):
-        info = mapa_tipos_erro.get(codigo)
-        nome = info['nome'] if info else codigo
-        top_motivos.append({"nome": nome, "contagem": contagem})
-        
-    top_causas = []
-    for causa, contagem in contagem_causas.most_common(5):
-        top_causas.append({"nome": causa, "contagem": contagem})
-
-    return top_motivos, top_causas
+    return StatsAccumulator(prontuarios_lista).top_erros()
 
 def _calc_taxa_erros_responsavel(prontuarios):
     """Calcula taxa APENAS para responsáveis que tiveram prontuários COM ERROS"""
-    prontuarios_com_erro = [p for p in prontuarios if _tem_erro(p)]
-    total_com_erro = len(prontuarios_com_erro)
-    
-    if total_com_erro == 0:
-        return []  # Nenhum prontuário com erro = lista vazia
-    
-    # Conta quantos prontuários com erro cada responsável teve
-    contagem_por_responsavel = Counter()
-    
-    for p in prontuarios_com_erro:
-        responsaveis = p.get('responsaveis', [])
-        for responsavel in responsaveis:
-            contagem_por_responsavel[responsavel] += 1
-    
-    # Calcula a porcentagem em relação ao total de prontuários com erro
-    resultado = []
-    for responsavel, quantidade in contagem_por_responsavel.items():
-        taxa = round(100 * quantidade / total_com_erro, 1)
-        resultado.append({
-            'nome': responsavel,
-            'prontuarios_com_erro': quantidade,
-            'taxa': taxa,
-            'participacao': f"{quantidade}/{total_com_erro}"
-        })
-    
-    return sorted(resultado, key=lambda x: x['taxa'], reverse=True)
+    return StatsAccumulator(prontuarios).taxa_erros_responsavel()
 
 def gerar_texto_periodo(ano, mes, periodo, data_inicio, data_fim):
     meses_pt = {
@@ -668,73 +804,197 @@ def gerar_texto_periodo(ano, mes, periodo, data_inicio, data_fim):
 
 def _calc_erros_por_motivo_detalhado(prontuarios):
     """Calcula estatísticas detalhadas de erros por motivo"""
-    prontuarios_com_erro = [p for p in prontuarios if _tem_erro(p)]
-    total_prontuarios_com_erro = len(prontuarios_com_erro)
-    
-    if total_prontuarios_com_erro == 0:
-        return [], {
-            'total_prontuarios_com_erro': 0,
-            'total_erros_registrados': 0,
-            'total_tipos_erro': 0,
-            'media_erros_por_prontuario': 0
-        }
-    
-    # Contagem de prontuários por tipo de erro
-    prontuarios_por_tipo = Counter()
-    # Contagem total de ocorrências por tipo
-    ocorrencias_por_tipo = Counter()
-    # Cores dos tipos de erro
-    cores_por_tipo = {}
-    
-    tipos_erro_dict = get_tipos_erro_dict()
-    
-    for p in prontuarios_com_erro:
+    return StatsAccumulator(prontuarios).erros_por_motivo_detalhado()
+
+# Linha mínima consumida pelo StatsAccumulator (datas já truncadas para o dia)
+LinhaEstatistica = namedtuple('LinhaEstatistica', [
+    'status', 'convenio', 'setor', 'data_base', 'recebimento', 'enviado_faturamento',
+    'responsaveis', 'erros'  # erros: lista de (tipo, causa, quantidade)
+])
+
+def _dia_ou_none(valor):
+    dt = _parse_any_date(valor) if valor else None
+    return date(dt.year, dt.month, dt.day) if dt else None
+
+def linha_estatistica(p):
+    """Converte um prontuário (objeto do banco ou dict de prontuario_to_dict) em LinhaEstatistica"""
+    if isinstance(p, LinhaEstatistica):
+        return p
+    if isinstance(p, dict):
+        data_base = _pega_data_base(p)
+        return LinhaEstatistica(
+            status=_norm_status(p),
+            convenio=_norm_convenio(p),
+            setor=_norm_setor(p),
+            data_base=_dia_ou_none(data_base),
+            recebimento=_dia_ou_none(p.get('recebimento_prontuario', '')),
+            enviado_faturamento=_dia_ou_none(p.get('enviado_faturamento', '')),
+            responsaveis=list(p.get('responsaveis', [])),
+            erros=[(e.get('tipo'), e.get('causa', 'Desconhecida'), int(e.get('quantidade') or 1))
+                   for e in (p.get('erros') or [])]
+        )
+    return LinhaEstatistica(
+        status=_norm_status({'status': p.status or ''}),
+        convenio=_norm_convenio({'convenio': p.convenio or ''}),
+        setor=_norm_setor({'setor': p.setor or ''}),
+        data_base=_dia_ou_none(p.data_criacao or p.recebimento_prontuario or p.admissao),
+        recebimento=_dia_ou_none(p.recebimento_prontuario),
+        enviado_faturamento=_dia_ou_none(p.enviado_faturamento),
+        responsaveis=[r.nome for r in p.responsaveis],
+        erros=[(e.tipo, e.causa, e.quantidade) for e in p.erros]
+    )
+
+def linhas_estatistica_bd(query=None, lote=500):
+    """Lê prontuários do banco em lotes e gera LinhaEstatistica (uso em rotas e recálculos offline)"""
+    query = query if query is not None else Prontuario.query
+    query = query.options(
+        db.selectinload(Prontuario.responsaveis),
+        db.selectinload(Prontuario.erros)
+    ).yield_per(lote)
+    for p in query:
+        yield linha_estatistica(p)
+        query.session.expunge(p)
+
+class StatsAccumulator:
+    """
+    Consome os prontuários uma única vez e produz a saída de todos os widgets (_calc_*),
+    com a mesma semântica das versões que percorriam a lista separadamente. Aceita objetos
+    Prontuario, dicts de prontuario_to_dict ou LinhaEstatistica.
+    """
+
+    def __init__(self, prontuarios=()):
+        self.total = 0
+        self.com_erro = 0
+        self.por_status = Counter()
+        self.dias = Counter()
+        self.setor_com_erro = Counter()
+        self.convenio_com_erro = Counter()
+        self.responsavel_com_erro = Counter()
+        self.prontuarios_por_tipo = Counter()
+        self.ocorrencias_por_tipo = Counter()
+        self.ocorrencias_por_causa = Counter()
+        self.soma_dias_auditoria = 0
+        self.qtd_auditados = 0
+        self.consumir(prontuarios)
+
+    def consumir(self, prontuarios):
+        for p in prontuarios:
+            self.adicionar(p)
+        return self
+
+    def adicionar(self, p):
+        linha = linha_estatistica(p)
+        self.total += 1
+        self.por_status[linha.status] += 1
+        if linha.data_base:
+            self.dias[linha.data_base] += 1
+        if linha.recebimento and linha.enviado_faturamento:
+            self.qtd_auditados += 1
+            self.soma_dias_auditoria += _dif_dias(linha.recebimento, linha.enviado_faturamento)
+
+        if not linha.erros:
+            return
+        self.com_erro += 1
+        self.setor_com_erro[linha.setor] += 1
+        self.convenio_com_erro[linha.convenio] += 1
+        for responsavel in linha.responsaveis:
+            self.responsavel_com_erro[responsavel] += 1
+
         tipos_neste_prontuario = set()
-        for erro in p.get('erros', []):
-            tipo_erro = erro.get('tipo')
-            tipos_neste_prontuario.add(tipo_erro)
-            ocorrencias_por_tipo[tipo_erro] += 1
-            
-            # Guarda a cor do tipo de erro
-            if tipo_erro not in cores_por_tipo and tipo_erro in tipos_erro_dict:
-                cores_por_tipo[tipo_erro] = tipos_erro_dict[tipo_erro].get('cor', '#6c757d')
-        
+        for tipo, causa, quantidade in linha.erros:
+            tipos_neste_prontuario.add(tipo)
+            self.ocorrencias_por_tipo[tipo] += quantidade
+            self.ocorrencias_por_causa[causa] += quantidade
         for tipo in tipos_neste_prontuario:
-            prontuarios_por_tipo[tipo] += 1
-    
-    # Prepara os dados detalhados
-    resultado = []
-    for tipo_erro, qtd_prontuarios in prontuarios_por_tipo.most_common():
-        info_tipo = tipos_erro_dict.get(tipo_erro, {})
-        nome_exibicao = info_tipo.get('nome', tipo_erro)
-        cor = info_tipo.get('cor', '#6c757d')
-        
-        taxa_prontuarios = round(100 * qtd_prontuarios / total_prontuarios_com_erro, 1)
-        total_ocorrencias = ocorrencias_por_tipo.get(tipo_erro, 0)
-        
-        # Calcular a média aqui no backend
-        media_por_prontuario = round(total_ocorrencias / qtd_prontuarios, 1) if qtd_prontuarios > 0 else 0.0
-        
-        resultado.append({
-            'tipo': tipo_erro,
-            'nome': nome_exibicao,
-            'prontuarios_com_erro': qtd_prontuarios,
-            'taxa_prontuarios': taxa_prontuarios,
-            'total_ocorrencias': total_ocorrencias,
-            'media_por_prontuario': media_por_prontuario,
-            'cor': cor
-        })
-    
-    # Estatísticas gerais
-    total_erros_registrados = sum(ocorrencias_por_tipo.values())
-    stats_gerais = {
-        'total_prontuarios_com_erro': total_prontuarios_com_erro,
-        'total_erros_registrados': total_erros_registrados,
-        'total_tipos_erro': len(prontuarios_por_tipo),
-        'media_erros_por_prontuario': round(total_erros_registrados / total_prontuarios_com_erro, 1) if total_prontuarios_com_erro > 0 else 0
-    }
-    
-    return resultado, stats_gerais
+            self.prontuarios_por_tipo[tipo] += 1
+
+    def somar(self, outro):
+        """Acumula os totais de outro acumulador (ex.: o do arquivo no do banco quente)"""
+        for campo, valor in vars(outro).items():
+            if isinstance(valor, Counter):
+                getattr(self, campo).update(valor)
+            else:
+                setattr(self, campo, getattr(self, campo) + valor)
+        return self
+
+    # --- Saídas (mesmo formato das antigas funções _calc_*) ---
+
+    def contagem_status(self):
+        return dict(self.por_status)
+
+    def tempos_medios(self):
+        if self.qtd_auditados == 0:
+            return {"aguardando": 0, "auditoria": 0, "correcao": 0, "total": 0}
+        tempo_auditoria = round(self.soma_dias_auditoria / self.qtd_auditados, 1)
+        return {"aguardando": 0, "auditoria": tempo_auditoria, "correcao": 0, "total": tempo_auditoria}
+
+    def produtividade_diaria_mes(self, ano, mes):
+        num_dias = monthrange(ano, mes)[1]
+        dias_do_mes = [date(ano, mes, dia) for dia in range(1, num_dias + 1)]
+        valores = [self.dias.get(d, 0) for d in dias_do_mes]
+        return {
+            "labels": [d.strftime("%d/%m") for d in dias_do_mes],
+            "valores": valores,
+            "total_registrado": sum(valores)
+        }
+
+    def _taxas(self, contagem, com_participacao=False):
+        if self.com_erro == 0:
+            return []
+        return _montar_taxas(contagem.items(), self.com_erro, com_participacao)
+
+    def taxa_erros_setor(self):
+        return self._taxas(self.setor_com_erro)
+
+    def taxa_erros_convenio(self):
+        return self._taxas(self.convenio_com_erro)
+
+    def taxa_erros_responsavel(self):
+        return self._taxas(self.responsavel_com_erro, com_participacao=True)
+
+    def top_erros(self, tipos_erro_dict=None):
+        mapa_tipos_erro = tipos_erro_dict if tipos_erro_dict is not None else get_tipos_erro_dict()
+        top_motivos = []
+        for codigo, contagem in _mais_frequentes(self.prontuarios_por_tipo, 5):
+            info = mapa_tipos_erro.get(codigo)
+            nome = info['nome'] if info else codigo
+            top_motivos.append({"nome": nome, "contagem": contagem})
+        top_causas = [{"nome": causa, "contagem": contagem}
+                      for causa, contagem in _mais_frequentes(self.ocorrencias_por_causa, 5)]
+        return top_motivos, top_causas
+
+    def erros_por_motivo_detalhado(self, tipos_erro_dict=None):
+        if self.com_erro == 0:
+            return [], {
+                'total_prontuarios_com_erro': 0,
+                'total_erros_registrados': 0,
+                'total_tipos_erro': 0,
+                'media_erros_por_prontuario': 0
+            }
+        tipos_erro_dict = tipos_erro_dict if tipos_erro_dict is not None else get_tipos_erro_dict()
+
+        resultado = []
+        for tipo_erro, qtd_prontuarios in _mais_frequentes(self.prontuarios_por_tipo):
+            info_tipo = tipos_erro_dict.get(tipo_erro, {})
+            total_ocorrencias = self.ocorrencias_por_tipo.get(tipo_erro, 0)
+            resultado.append({
+                'tipo': tipo_erro,
+                'nome': info_tipo.get('nome', tipo_erro),
+                'prontuarios_com_erro': qtd_prontuarios,
+                'taxa_prontuarios': round(100 * qtd_prontuarios / self.com_erro, 1),
+                'total_ocorrencias': total_ocorrencias,
+                'media_por_prontuario': round(total_ocorrencias / qtd_prontuarios, 1) if qtd_prontuarios > 0 else 0.0,
+                'cor': info_tipo.get('cor', '#6c757d')
+            })
+
+        total_erros_registrados = sum(self.ocorrencias_por_tipo.values())
+        stats_gerais = {
+            'total_prontuarios_com_erro': self.com_erro,
+            'total_erros_registrados': total_erros_registrados,
+            'total_tipos_erro': len(self.prontuarios_por_tipo),
+            'media_erros_por_prontuario': round(total_erros_registrados / self.com_erro, 1)
+        }
+        return resultado, stats_gerais
 
 def calcular_estatisticas_bd(prontuarios_obj):
     """Calcula estatísticas diretamente dos objetos do banco"""
@@ -769,94 +1029,2226 @@ def calcular_estatisticas_bd(prontuarios_obj):
         'erros_por_tipo': dict(erros_por_tipo),
         'convenios': dict(convenios),
         'setores': dict(setores),
-        'total_prontuarios_com_erro': sum(1 for p in prontuarios_obj if p.erros)  # 🔥 Nova estatística
+        'total_prontuarios_com_erro': sum(1 for p in prontuarios_obj if p.has_erro)  # 🔥 Nova estatística
     }
     
     print(f"📊 ESTATÍSTICAS BD: {stats['total_prontuarios_com_erro']} prontuários com erro")
     return stats
 
-# --- ROTAS DE LOGIN/LOGOUT/REGISTRO ---
+# --- 4.1 AGREGAÇÕES SQL DO DASHBOARD ---
+# Mesmos números dos _calc_* acima, mas calculados com GROUP BY / COUNT(DISTINCT)
+# no banco: o custo cresce com o número de grupos, não com o número de prontuários.
 
-@app.route('/login', methods=['GET', 'POST'])
-def login():
-    if request.method == 'POST':
-        username = request.form.get('username')
-        password = request.form.get('password')
-        
-        user = User.query.filter_by(username=username).first()
-        
-        # Verifica se usuário existe e a senha bate
-        if user and user.check_password(password):
-            login_user(user)
-            return redirect(url_for('index'))
-        
-        return render_template('login.html', error="Usuário ou senha incorretos")
+def _inicio_do_dia(d):
+    return datetime(d.year, d.month, d.day)
 
-    return render_template('login.html')
+def _limite_data(coluna, valor):
+    """Ajusta o limite ao tipo da coluna: colunas Date comparam com date, DateTime com datetime"""
+    if isinstance(coluna.type, db.Date):
+        return _dia(valor)
+    return valor
 
-@app.route('/logout')
-@login_required
-def logout():
-    logout_user()
-    return redirect(url_for('login'))
+def _somar_meses(d, meses):
+    total = d.year * 12 + (d.month - 1) + meses
+    return datetime(total // 12, total % 12 + 1, 1)
 
-@app.route('/registrar_admin', methods=['GET', 'POST'])
-def registrar_admin():
-    if request.method == 'POST':
-        username = request.form.get('username')
-        password = request.form.get('password')
-        
-        if User.query.filter_by(username=username).first():
-            return "Usuário já existe!"
-            
-        novo_usuario = User(username=username)
-        novo_usuario.set_password(password)
-        db.session.add(novo_usuario)
-        db.session.commit()
-        
-        return redirect(url_for('login'))
-        
-    return render_template('register.html')
+def limites_periodo(unidade, n, referencia=None):
+    """
+    Limites [inicio, fim) dos n últimos períodos ('dia', 'semana' ou 'mes'), terminando
+    no período que contém a data de referência (hoje, por padrão). Semanas começam na segunda.
+    """
+    ref = _inicio_do_dia(referencia or datetime.now())
+    if unidade == 'mes':
+        primeiro = _somar_meses(ref, -(n - 1))
+        return [(_somar_meses(primeiro, i), _somar_meses(primeiro, i + 1)) for i in range(n)]
+    if unidade == 'semana':
+        passo = timedelta(days=7)
+        ultimo = ref - timedelta(days=ref.weekday())
+    elif unidade == 'dia':
+        passo = timedelta(days=1)
+        ultimo = ref
+    else:
+        raise ValueError(f"Unidade de período inválida: {unidade}")
+    primeiro = ultimo - passo * (n - 1)
+    return [(primeiro + passo * i, primeiro + passo * (i + 1)) for i in range(n)]
 
+def serie_temporal(coluna, agregado, limites, filtros=(), sessao=None):
+    """
+    Agrega `agregado` em cada intervalo de `limites` com UMA query: filtra por faixa na
+    coluna de data (usa o índice) e agrupa por um CASE que devolve o índice do intervalo.
+    Retorna a lista de valores, um por intervalo.
+    """
+    inicio, fim = limites[0][0], limites[-1][1]
+    balde = db.case(*[(coluna < _limite_data(coluna, f), i) for i, (_, f) in enumerate(limites)])
+    rows = ((sessao or db.session).query(balde, agregado)
+            .filter(coluna >= _limite_data(coluna, inicio), coluna < _limite_data(coluna, fim))
+            .filter(*filtros)
+            .group_by(balde)
+            .all())
+    valores = [0] * len(limites)
+    for indice, valor in rows:
+        if indice is not None:
+            valores[indice] = valor or 0
+    return valores
 
-@app.route('/debug/verificar_erros')
-@login_required
-def debug_verificar_erros():
-    """Rota para verificar rapidamente se os erros estão sendo salvos e carregados"""
-    try:
-        # Buscar o último prontuário salvo
-        ultimo_prontuario = Prontuario.query.options(
-            db.joinedload(Prontuario.erros)
-        ).order_by(Prontuario.id.desc()).first()
-        
-        if not ultimo_prontuario:
-            return jsonify({'erro': 'Nenhum prontuário encontrado'})
-        
-        resultado = {
-            'ultimo_prontuario': {
-                'id': ultimo_prontuario.id,
-                'beneficiario': ultimo_prontuario.beneficiario,
-                'atendimento': ultimo_prontuario.atendimento,
-                'total_erros': len(ultimo_prontuario.erros),
-                'erros': []
-            }
+def _intervalo_ano_mes(ano, mes):
+    """Intervalo [inicio, fim) de um ano ou de um mês do ano, para filtrar por faixa em vez de extract()"""
+    if not ano:
+        return None
+    ano = int(ano)
+    if mes:
+        inicio = datetime(ano, int(mes), 1)
+        return inicio, _somar_meses(inicio, 1)
+    return datetime(ano, 1, 1), datetime(ano + 1, 1, 1)
+
+def _filtros_dashboard(ano, mes, periodo, data_inicio, data_fim):
+    """Monta a lista de condições de data aplicadas sobre Prontuario no dashboard"""
+    filtros = []
+    agora = datetime.now()
+
+    if periodo == 'mes':
+        filtros.append(Prontuario.data_criacao >= agora.replace(day=1, hour=0, minute=0, second=0, microsecond=0))
+    elif periodo == 'semana':
+        filtros.append(Prontuario.data_criacao >= agora - timedelta(days=7))
+    elif periodo == 'hoje':
+        filtros.append(Prontuario.data_criacao >= agora.replace(hour=0, minute=0, second=0, microsecond=0))
+    # 'todos' não aplica filtro
+
+    if data_inicio:
+        data_ini = _parse_any_date(data_inicio)
+        if data_ini:
+            filtros.append(Prontuario.data_criacao >= _inicio_do_dia(data_ini))
+    if data_fim:
+        data_fim_dt = _parse_any_date(data_fim)
+        if data_fim_dt:
+            filtros.append(Prontuario.data_criacao < _inicio_do_dia(data_fim_dt) + timedelta(days=1))
+    intervalo = _intervalo_ano_mes(ano, mes)
+    if intervalo:
+        filtros.append(Prontuario.data_criacao >= intervalo[0])
+        filtros.append(Prontuario.data_criacao < intervalo[1])
+    elif mes:
+        # Mês sem ano vale para todos os anos: não cabe em uma única faixa de datas
+        filtros.append(db.extract('month', Prontuario.data_criacao) == int(mes))
+    return filtros
+
+def _query_erros_filtrados(sessao, *colunas, filtros):
+    """Query sobre Erro já unida ao Prontuario e restrita pelos filtros"""
+    return (sessao.query(*colunas)
+            .select_from(Erro)
+            .join(Prontuario, Erro.prontuario_id == Prontuario.id)
+            .filter(*filtros))
+
+def contagens_dashboard(filtros, sessao=None, produtividade=None):
+    """
+    Contagens do dashboard numa sessão (banco quente ou arquivo), pelos ids dos cadastros.
+    São aditivas: somadas as do quente e as do arquivo (somar_contagens_dashboard) dão os
+    mesmos números de uma base só. `produtividade` = (ano, mes) da série diária, ou None.
+    """
+    sessao = sessao or db.session
+    contagens = {
+        'status': Counter(dict(sessao.query(Prontuario.status_id, func.count(Prontuario.id))
+                               .filter(*filtros)
+                               .group_by(Prontuario.status_id)
+                               .all())),
+        'com_erro': 0,
+        'motivos_prontuarios': Counter(),
+        'motivos_ocorrencias': Counter(),
+        'setores': Counter(),
+        'convenios': Counter(),
+        'responsaveis': Counter(),
+        'causas': Counter(),
+        'nomes_responsaveis': {},
+        'produtividade': None,
+    }
+    if not sum(contagens['status'].values()):
+        return contagens
+
+    if produtividade:
+        ano, mes = produtividade
+        num_dias = monthrange(ano, mes)[1]
+        limites = limites_periodo('dia', num_dias, referencia=date(ano, mes, num_dias))
+        data_base = func.coalesce(Prontuario.data_criacao, Prontuario.recebimento_prontuario, Prontuario.admissao)
+        contagens['produtividade'] = serie_temporal(data_base, func.count(Prontuario.id), limites, filtros, sessao)
+
+    contagens['com_erro'] = sessao.query(func.count(Prontuario.id)).filter(*filtros, Prontuario.has_erro).scalar() or 0
+    if not contagens['com_erro']:
+        return contagens
+
+    # Agrupa pelo id do cadastro (inteiro) e só depois traduz para o nome
+    qtd_prontuarios = func.count(func.distinct(Erro.prontuario_id))
+    for tipo_erro_id, qtd, ocorrencias in (_query_erros_filtrados(sessao, Erro.tipo_erro_id, qtd_prontuarios,
+                                                                  func.sum(Erro.quantidade), filtros=filtros)
+                                           .group_by(Erro.tipo_erro_id)):
+        contagens['motivos_prontuarios'][tipo_erro_id] += qtd
+        contagens['motivos_ocorrencias'][tipo_erro_id] += ocorrencias or 0
+    for chave, coluna_id in (('setores', Prontuario.setor_id), ('convenios', Prontuario.convenio_id)):
+        contagens[chave].update(dict(_query_erros_filtrados(sessao, coluna_id, qtd_prontuarios, filtros=filtros)
+                                     .group_by(coluna_id)
+                                     .all()))
+    contagens['causas'].update(dict(_query_erros_filtrados(sessao, Erro.causa_id, func.sum(Erro.quantidade),
+                                                           filtros=filtros)
+                                    .group_by(Erro.causa_id)
+                                    .all()))
+
+    for responsavel_id, nome, qtd in (sessao.query(Responsavel.id, Responsavel.nome,
+                                                   func.count(func.distinct(Prontuario.id)))
+                                      .select_from(Prontuario)
+                                      .join(prontuario_responsavel_association,
+                                            prontuario_responsavel_association.c.prontuario_id == Prontuario.id)
+                                      .join(Responsavel, Responsavel.id == prontuario_responsavel_association.c.responsavel_id)
+                                      .filter(*filtros)
+                                      .filter(Prontuario.has_erro)
+                                      .group_by(Responsavel.id, Responsavel.nome)):
+        contagens['responsaveis'][responsavel_id] += qtd
+        contagens['nomes_responsaveis'][responsavel_id] = nome
+    return contagens
+
+def somar_contagens_dashboard(contagens, outras):
+    """Soma em `contagens` as de outra sessão; nomes de responsável do banco quente têm precedência"""
+    contagens['com_erro'] += outras['com_erro']
+    for chave in ('status', 'motivos_prontuarios', 'motivos_ocorrencias', 'setores', 'convenios',
+                  'responsaveis', 'causas'):
+        contagens[chave].update(outras[chave])
+    contagens['nomes_responsaveis'] = {**outras['nomes_responsaveis'], **contagens['nomes_responsaveis']}
+    if outras['produtividade'] is not None:
+        atual = contagens['produtividade']
+        contagens['produtividade'] = (list(outras['produtividade']) if atual is None
+                                      else [a + b for a, b in zip(atual, outras['produtividade'])])
+    return contagens
+
+def _mais_frequentes(contagem, n=None):
+    """Itens de {nome: contagem} do maior para o menor; empates pelo nome (ordem estável entre bancos)"""
+    return sorted(contagem.items(), key=lambda c: (-c[1], str(c[0])))[:n]
+
+def _montar_taxas(contagem, total_com_erro, com_participacao=False):
+    resultado = []
+    for nome, quantidade in contagem:
+        item = {
+            'nome': nome,
+            'prontuarios_com_erro': quantidade,
+            'taxa': round(100 * quantidade / total_com_erro, 1)
         }
-        
-        for erro in ultimo_prontuario.erros:
-            resultado['ultimo_prontuario']['erros'].append({
-                'tipo': erro.tipo,
-                'causa': erro.causa,
-                'responsavel_id': erro.responsavel_id
-            })
-        
-        # Verificar total de erros no sistema
-        total_erros_sistema = db.session.query(func.count(Erro.id)).scalar()
-        resultado['total_erros_sistema'] = total_erros_sistema
-        
-        return jsonify(resultado)
-        
-    except Exception as e:
-        return jsonify({'erro': str(e)}), 500
+        if com_participacao:
+            item['participacao'] = f"{quantidade}/{total_com_erro}"
+        resultado.append(item)
+    # Mesma taxa: pela quantidade (a taxa é arredondada) e depois pelo nome
+    return sorted(resultado, key=lambda x: (-x['prontuarios_com_erro'], str(x['nome'])))
+
+def _agg_contagem_status(contagens):
+    resultado = Counter()
+    for status_id, quantidade in contagens['status'].items():
+        resultado[texto_catalogo(StatusProntuario, status_id)] += quantidade
+    return dict(resultado)
+
+def _agg_erros_por_motivo_detalhado(contagens, tipos_erro_dict):
+    """Equivalente SQL de _calc_erros_por_motivo_detalhado"""
+    total_com_erro = contagens['com_erro']
+    if total_com_erro == 0:
+        return [], {
+            'total_prontuarios_com_erro': 0,
+            'total_erros_registrados': 0,
+            'total_tipos_erro': 0,
+            'media_erros_por_prontuario': 0
+        }
+
+    rows = sorted(((texto_catalogo(TipoErro, tipo_erro_id), qtd, contagens['motivos_ocorrencias'][tipo_erro_id])
+                   for tipo_erro_id, qtd in contagens['motivos_prontuarios'].items()),
+                  key=lambda r: (-r[1], str(r[0])))
+
+    resultado = []
+    for tipo_erro, qtd_prontuarios, total_ocorrencias in rows:
+        info_tipo = tipos_erro_dict.get(tipo_erro, {})
+        resultado.append({
+            'tipo': tipo_erro,
+            'nome': info_tipo.get('nome', tipo_erro),
+            'prontuarios_com_erro': qtd_prontuarios,
+            'taxa_prontuarios': round(100 * qtd_prontuarios / total_com_erro, 1),
+            'total_ocorrencias': total_ocorrencias,
+            'media_por_prontuario': round(total_ocorrencias / qtd_prontuarios, 1) if qtd_prontuarios > 0 else 0.0,
+            'cor': info_tipo.get('cor', '#6c757d')
+        })
+
+    total_erros_registrados = sum(r['total_ocorrencias'] for r in resultado)
+    stats_gerais = {
+        'total_prontuarios_com_erro': total_com_erro,
+        'total_erros_registrados': total_erros_registrados,
+        'total_tipos_erro': len(resultado),
+        'media_erros_por_prontuario': round(total_erros_registrados / total_com_erro, 1)
+    }
+    return resultado, stats_gerais
+
+def _agg_taxa_erros_por_coluna(contagem_ids, modelo, total_com_erro):
+    """Taxa por setor/convênio, normalizando vazios como 'Não Informado' (igual a _norm_setor/_norm_convenio)"""
+    if total_com_erro == 0:
+        return []
+    # Cada prontuário tem um só setor/convênio: somar os ids que normalizam para o mesmo nome não conta duas vezes
+    contagem = Counter()
+    for id_, quantidade in contagem_ids.items():
+        contagem[(texto_catalogo(modelo, id_) or '').strip() or 'Não Informado'] += quantidade
+    return _montar_taxas(contagem.items(), total_com_erro)
+
+def _agg_taxa_erros_setor(contagens):
+    return _agg_taxa_erros_por_coluna(contagens['setores'], Setor, contagens['com_erro'])
+
+def _agg_taxa_erros_convenio(contagens):
+    return _agg_taxa_erros_por_coluna(contagens['convenios'], Convenio, contagens['com_erro'])
+
+def _agg_taxa_erros_responsavel(contagens):
+    """Equivalente SQL de _calc_taxa_erros_responsavel"""
+    if contagens['com_erro'] == 0:
+        return []
+    nomes = contagens['nomes_responsaveis']
+    return _montar_taxas(((nomes[id_], quantidade) for id_, quantidade in contagens['responsaveis'].items()),
+                         contagens['com_erro'], com_participacao=True)
+
+def _agg_top_erros(contagens, tipos_erro_dict, motivos_detalhados):
+    """Top 5 motivos (por prontuário) e top 5 causas (por ocorrência)"""
+    top_motivos = []
+    for motivo in motivos_detalhados[:5]:
+        info = tipos_erro_dict.get(motivo['tipo'])
+        nome = info['nome'] if info else motivo['tipo']
+        top_motivos.append({"nome": nome, "contagem": motivo['prontuarios_com_erro']})
+
+    # A mesma descrição pode estar cadastrada em mais de um tipo: soma por texto antes do top 5
+    por_causa = Counter()
+    for causa_id, contagem in contagens['causas'].items():
+        por_causa[texto_catalogo(Causa, causa_id)] += contagem
+    top_causas = [{"nome": causa, "contagem": contagem}
+                  for causa, contagem in _mais_frequentes(por_causa, 5)]
+    return top_motivos, top_causas
+
+def _agg_produtividade_diaria_mes(contagens, ano, mes):
+    """Equivalente SQL de _calc_produtividade_diaria_mes (mesma data base de _pega_data_base)"""
+    num_dias = monthrange(ano, mes)[1]
+    limites = limites_periodo('dia', num_dias, referencia=date(ano, mes, num_dias))
+    valores = contagens['produtividade'] or [0] * num_dias
+
+    labels = [inicio.strftime("%d/%m") for inicio, _ in limites]
+    return {"labels": labels, "valores": valores, "total_registrado": sum(valores)}
+
+# --- 4.2 RESUMO DIÁRIO (ROLLUP) ---
+
+CHAVE_RESUMO = ('dia', 'setor_id', 'convenio_id', 'status_id', 'tipo_erro_id', 'responsavel_id')
+CONTADORES_RESUMO = ('qtd_prontuarios', 'qtd_prontuarios_com_erro', 'qtd_erros')
+
+def _dia(valor):
+    if not valor:
+        return None
+    if isinstance(valor, datetime):
+        return valor.date()
+    if isinstance(valor, date):
+        return valor
+    return _parse_any_date(str(valor)[:10])
+
+def _contribuicoes_resumo(p):
+    """Contribuição de um prontuário (e seus erros) no ResumoDiario: {chave: [prontuarios, com_erro, erros]}"""
+    contribuicoes = defaultdict(lambda: [0, 0, 0])
+    base = (p.setor_id or 0, p.convenio_id or 0, p.status_id or 0)
+    erros = list(p.erros)
+
+    dia_prontuario = _dia(p.data_criacao)
+    if dia_prontuario:
+        linha = contribuicoes[(dia_prontuario, *base, 0, 0)]
+        linha[0] += 1
+        if erros:
+            linha[1] += 1
+        for tipo_erro_id in {e.tipo_erro_id for e in erros}:
+            contribuicoes[(dia_prontuario, *base, tipo_erro_id, 0)][0] += 1
+
+    for e in erros:
+        dia_erro = _dia(e.data_criacao)
+        if dia_erro:
+            contribuicoes[(dia_erro, *base, e.tipo_erro_id, e.responsavel_id or 0)][2] += e.quantidade
+    return dict(contribuicoes)
+
+def _upsert_resumo(deltas):
+    """
+    Soma os deltas {chave: (prontuarios, com_erro, erros)} com um único INSERT ... ON CONFLICT
+    DO UPDATE executado para a lista de linhas (executemany)
+    """
+    if not deltas:
+        return
+    if db.engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+
+    tabela = ResumoDiario.__table__
+    stmt = insert(tabela)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=list(CHAVE_RESUMO),
+        set_={c: tabela.c[c] + stmt.excluded[c] for c in CONTADORES_RESUMO}
+    )
+    db.session.execute(stmt, [dict(zip(CHAVE_RESUMO, chave), **dict(zip(CONTADORES_RESUMO, contadores)))
+                              for chave, contadores in deltas.items()])
+
+def _somar_contribuicoes(total, contribuicoes):
+    """Acumula as contribuições de um prontuário em `total` (defaultdict de [0, 0, 0])"""
+    for chave, valores in contribuicoes.items():
+        total[chave] = [x + y for x, y in zip(total[chave], valores)]
+
+def _atualizar_resumo(antes, depois):
+    """Aplica no ResumoDiario a diferença entre duas contribuições (mesma transação da escrita)"""
+    deltas = {}
+    for chave in set(antes) | set(depois):
+        a = antes.get(chave, (0, 0, 0))
+        d = depois.get(chave, (0, 0, 0))
+        delta = tuple(x - y for x, y in zip(d, a))
+        if any(delta):
+            deltas[chave] = delta
+    _upsert_resumo(deltas)
+
+def _registrar_escrita(p, antes):
+    """
+    Pós-escrita de um prontuário (mesma transação): atualiza erro_count/has_erro e aplica
+    no ResumoDiario o delta entre a contribuição atual de p e `antes`
+    """
+    db.session.flush()
+    db.session.expire(p, ['erros'])
+    _sincronizar_contadores_erro(p)
+    _atualizar_resumo(antes, _contribuicoes_resumo(p))
+
+def _totais_resumo(ids=None, sessao=None):
+    """
+    Contribuições agregadas no ResumoDiario ({chave: [prontuarios, com_erro, erros]}) calculadas
+    com GROUP BY: de todos os prontuários, ou só dos que estão em `ids`. `sessao` permite
+    somar os do banco de arquivo.
+    """
+    sessao = sessao or db.session
+    restricao = [Prontuario.id.in_(ids)] if ids is not None else []
+    dia_p = func.date(Prontuario.data_criacao)
+    dia_e = func.date(Erro.data_criacao)
+    setor = func.coalesce(Prontuario.setor_id, 0)
+    convenio = func.coalesce(Prontuario.convenio_id, 0)
+    status = func.coalesce(Prontuario.status_id, 0)
+    tem_erro = db.case((Prontuario.erros.any(), 1), else_=0)
+
+    totais = defaultdict(lambda: [0, 0, 0])
+
+    # Prontuários por dia de criação
+    for dia, s, c, st, qtd, com_erro in (sessao.query(dia_p, setor, convenio, status,
+                                                      func.count(Prontuario.id), func.sum(tem_erro))
+                                         .filter(Prontuario.data_criacao.isnot(None), *restricao)
+                                         .group_by(dia_p, setor, convenio, status)):
+        linha = totais[(_dia(dia), s, c, st, 0, 0)]
+        linha[0] += qtd
+        linha[1] += com_erro or 0
+
+    # Prontuários com cada tipo de erro, no dia de criação do prontuário
+    for dia, s, c, st, tipo, qtd in (sessao.query(dia_p, setor, convenio, status, Erro.tipo_erro_id,
+                                                  func.count(func.distinct(Prontuario.id)))
+                                     .select_from(Erro).join(Prontuario, Erro.prontuario_id == Prontuario.id)
+                                     .filter(Prontuario.data_criacao.isnot(None), *restricao)
+                                     .group_by(dia_p, setor, convenio, status, Erro.tipo_erro_id)):
+        totais[(_dia(dia), s, c, st, tipo, 0)][0] += qtd
+
+    # Erros por dia de criação do erro
+    responsavel = func.coalesce(Erro.responsavel_id, 0)
+    for dia, s, c, st, tipo, resp, qtd in (sessao.query(dia_e, setor, convenio, status, Erro.tipo_erro_id,
+                                                        responsavel, func.sum(Erro.quantidade))
+                                           .select_from(Erro).join(Prontuario, Erro.prontuario_id == Prontuario.id)
+                                           .filter(Erro.data_criacao.isnot(None), *restricao)
+                                           .group_by(dia_e, setor, convenio, status, Erro.tipo_erro_id, responsavel)):
+        totais[(_dia(dia), s, c, st, tipo, resp)][2] += qtd
+    return totais
+
+def _totais_resumo_ids(ids):
+    """_totais_resumo de uma lista longa de ids, em blocos de LOTE_IDS_IN"""
+    totais = defaultdict(lambda: [0, 0, 0])
+    ids = list(ids)
+    for bloco in _blocos_ids(ids):
+        _somar_contribuicoes(totais, _totais_resumo(bloco))
+    return totais
+
+def reconstruir_resumo_diario():
+    """Recalcula todo o ResumoDiario a partir de prontuario/erro (backfill), contando os arquivados"""
+    if 'convenio_id' not in _colunas('prontuario'):
+        # Banco antigo no meio das migrações, com convênio/setor ainda em texto: o resumo é
+        # chaveado pelos ids, e o passo 9 (dicionário) o reconstrói depois de converter
+        print("⏭️  Resumo diário fica para a conversão dos cadastros (passo 9 das migrações)")
+        return 0
+    inicio = datetime.now()
+    totais = _totais_resumo()
+    if estado_arquivo() is not None:
+        _somar_contribuicoes(totais, consultar_arquivo(lambda sessao: _totais_resumo(sessao=sessao)))
+
+    db.session.query(ResumoDiario).delete()
+    db.session.bulk_insert_mappings(ResumoDiario, [
+        dict(zip(CHAVE_RESUMO, chave), **dict(zip(CONTADORES_RESUMO, contadores)))
+        for chave, contadores in totais.items()
+    ])
+    db.session.commit()
+
+    duracao = (datetime.now() - inicio).total_seconds()
+    print(f"✅ Resumo diário reconstruído: {len(totais)} linhas em {duracao:.2f}s")
+    return len(totais)
+
+def _resumo_produtividade_diaria_mes(ano, mes):
+    """Mesma saída de _calc_produtividade_diaria_mes, lida do ResumoDiario (sem filtros)"""
+    num_dias = monthrange(ano, mes)[1]
+    limites = limites_periodo('dia', num_dias, referencia=date(ano, mes, num_dias))
+    valores = serie_temporal(ResumoDiario.dia, func.sum(ResumoDiario.qtd_prontuarios), limites,
+                             [ResumoDiario.tipo_erro_id == 0])
+
+    labels = [inicio.strftime("%d/%m") for inicio, _ in limites]
+    return {"labels": labels, "valores": valores, "total_registrado": sum(valores)}
+
+def calcular_estatisticas_resumo(query_resumo):
+    """Mesma saída de calcular_estatisticas_bd, lida de uma query já filtrada sobre ResumoDiario"""
+    total_por_status = {status: 0 for status in STATUS_OPCOES}
+    erros_por_tipo = Counter()
+    convenios = Counter()
+    setores = Counter()
+    total_com_erro = 0
+
+    colunas = (ResumoDiario.status_id, ResumoDiario.convenio_id, ResumoDiario.setor_id, ResumoDiario.tipo_erro_id)
+    rows = (query_resumo
+            .with_entities(*colunas, func.sum(ResumoDiario.qtd_prontuarios),
+                           func.sum(ResumoDiario.qtd_prontuarios_com_erro))
+            .group_by(*colunas)
+            .all())
+
+    for status_id, convenio_id, setor_id, tipo_erro_id, qtd, com_erro in rows:
+        qtd = qtd or 0
+        if tipo_erro_id == 0:
+            total_com_erro += com_erro or 0
+        status = texto_catalogo(StatusProntuario, status_id or None)
+        if not status or not qtd:
+            continue
+        if tipo_erro_id:
+            erros_por_tipo[texto_catalogo(TipoErro, tipo_erro_id)] += qtd
+            continue
+        convenio = texto_catalogo(Convenio, convenio_id or None)
+        setor = texto_catalogo(Setor, setor_id or None)
+        status_normalizado = status.title().replace('Ao', 'ao')
+        if status_normalizado in total_por_status:
+            total_por_status[status_normalizado] += qtd
+        convenios[convenio] += qtd
+        setores[setor] += qtd
+
+    stats = {
+        'total_por_status': total_por_status,
+        'erros_por_tipo': dict(erros_por_tipo),
+        'convenios': dict(convenios),
+        'setores': dict(setores),
+        'total_prontuarios_com_erro': total_com_erro
+    }
+
+    print(f"📊 ESTATÍSTICAS (RESUMO): {stats['total_prontuarios_com_erro']} prontuários com erro")
+    return stats
+
+# --- 4.3 CACHE DE RESULTADOS (DASHBOARD / RELATÓRIOS) ---
+
+class CacheResultados:
+    """
+    Cache em memória (por processo) com TTL e descarte LRU. Cada entrada guarda a versão
+    dos dados em que foi calculada; toda escrita aceita chama nova_versao(), então um
+    resultado só é servido enquanto nenhum dado mudou desde o cálculo.
+
+    A versão local só enxerga as escritas do próprio processo. Com `compartilhado` (nome da
+    linha em versao_cache) nova_versao() também incrementa a versão no banco e obter() a lê
+    a cada consulta, então uma escrita em qualquer worker invalida o cache de todos. Sem ela
+    (ou antes da migração que cria a tabela), só o TTL limita o que outro processo escreveu.
+    Com `releitura_segundos` a versão do banco é relida no máximo uma vez nesse intervalo
+    (para caches consultados linha a linha, como o dos catálogos).
+    """
+
+    def __init__(self, max_itens=64, ttl_segundos=300, compartilhado=None, releitura_segundos=0):
+        self.max_itens = max_itens
+        self.ttl_segundos = ttl_segundos
+        self.compartilhado = compartilhado
+        self.releitura_segundos = releitura_segundos
+        self.versao = 0
+        self.versao_compartilhada = None
+        self._lida = (None, None)  # (instante da última leitura, versão lida)
+        self.hits = 0
+        self.misses = 0
+        self._itens = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _ler_versao_compartilhada(self):
+        if not self.compartilhado or not _tabela_versao_cache():
+            return None
+        agora = time.monotonic()
+        lida_em, versao = self._lida
+        if lida_em is None or agora - lida_em >= self.releitura_segundos:
+            versao = db.session.scalar(db.select(VersaoCache.versao).where(VersaoCache.nome == self.compartilhado))
+            self._lida = (agora, versao)
+        return versao
+
+    def nova_versao(self):
+        with self._lock:
+            self.versao += 1
+            self._itens.clear()
+        if self.compartilhado and _tabela_versao_cache():
+            # Conexão própria: a transação da rota já terminou (commit ou rollback)
+            with db.engine.begin() as conexao:
+                conexao.execute(db.update(VersaoCache).where(VersaoCache.nome == self.compartilhado)
+                                .values(versao=VersaoCache.versao + 1))
+
+    def descartar(self, chave):
+        """Tira uma entrada só (a próxima leitura recalcula), sem mexer nas demais"""
+        with self._lock:
+            self._itens.pop(chave, None)
+
+    def limpar(self):
+        """Esvazia só a memória deste processo (os dados não mudaram: nada a avisar aos outros)"""
+        with self._lock:
+            self._itens.clear()
+
+    def obter(self, chave, calcular):
+        agora = time.monotonic()
+        compartilhada = self._ler_versao_compartilhada()
+        with self._lock:
+            if compartilhada != self.versao_compartilhada:
+                # Outro processo escreveu: nada do que está guardado vale mais
+                self.versao_compartilhada = compartilhada
+                self._itens.clear()
+            versao = self.versao
+            item = self._itens.get(chave)
+            if item and item[0] == versao and item[1] > agora:
+                self._itens.move_to_end(chave)
+                self.hits += 1
+                return item[2]
+            self.misses += 1
+
+        valor = calcular()
+
+        with self._lock:
+            # Se houve escrita durante o cálculo, o resultado pode estar velho: não guarda
+            if versao == self.versao and compartilhada == self.versao_compartilhada:
+                self._itens[chave] = (versao, agora + self.ttl_segundos, valor)
+                self._itens.move_to_end(chave)
+                while len(self._itens) > self.max_itens:
+                    self._itens.popitem(last=False)
+        return valor
+
+    def estatisticas(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'versao': self.versao,
+                'versao_compartilhada': self.versao_compartilhada,
+                'itens': len(self._itens),
+                'max_itens': self.max_itens,
+                'ttl_segundos': self.ttl_segundos,
+                'hits': self.hits,
+                'misses': self.misses,
+                'taxa_acerto': round(100 * self.hits / total, 1) if total else 0.0
+            }
+
+_versao_cache = {'tabela': False}
+
+def _tabela_versao_cache():
+    """versao_cache já existe? (só a resposta positiva fica guardada: a migração pode criá-la depois)"""
+    if not _versao_cache['tabela']:
+        _versao_cache['tabela'] = db.inspect(db.engine).has_table(VersaoCache.__tablename__)
+    return _versao_cache['tabela']
+
+cache_resultados = CacheResultados(
+    max_itens=app.config['CACHE_RESULTADOS_MAX_ITENS'],
+    ttl_segundos=app.config['CACHE_RESULTADOS_TTL'],
+    compartilhado='resultados'
+)
+
+def chave_filtros(rota, ano='', mes='', periodo='', data_inicio='', data_fim=''):
+    """Normaliza os filtros de período em uma tupla usada como chave do cache"""
+    def _inteiro(valor):
+        try:
+            return int(str(valor).strip())
+        except (TypeError, ValueError):
+            return None
+
+    # O dia atual entra na chave porque 'hoje', 'semana', 'mes'... são relativos a ele
+    return (
+        rota,
+        date.today().isoformat(),
+        str(periodo or '').strip().lower(),
+        _inteiro(ano) if ano else None,
+        _inteiro(mes) if mes else None,
+        _to_iso_date(data_inicio),
+        _to_iso_date(data_fim)
+    )
+
+def _escrita_aceita(resposta):
+    """POST/DELETE que respondeu 2xx; 4xx/5xx não gravaram nada (validação falhou ou houve rollback)"""
+    return request.method != 'GET' and 200 <= resposta.status_code < 300
+
+def invalida_cache(f):
+    """Decorator das rotas de escrita: POST/DELETE aceito (2xx) incrementa a versão dos dados"""
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        try:
+            resposta = make_response(f(*args, **kwargs))
+        except Exception:
+            # Transação que falhou não pode segurar a trava de escrita (SQLite)
+            db.session.rollback()
+            raise
+        if _escrita_aceita(resposta):
+            cache_resultados.nova_versao()
+        return resposta
+    return wrapper
+
+# --- 4.4 BUSCA TEXTUAL (FTS5) ---
+
+# Tabela virtual com uma linha por prontuário (rowid = prontuario.id). As causas de todos
+# os erros do prontuário ficam concatenadas na coluna 'causas'. Os triggers mantêm o índice
+# em sincronia com qualquer escrita nas tabelas, inclusive a dos scripts de importação e a
+# edição da descrição de uma causa no cadastro.
+_CAUSAS_DO_PRONTUARIO = ("(SELECT COALESCE(group_concat(c.descricao, ' '), '') FROM erro e "
+                         "JOIN causa c ON c.id = e.causa_id WHERE e.prontuario_id = {id})")
+
+BUSCA_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS prontuario_busca USING fts5(
+        beneficiario, atendimento, observacao, causas,
+        tokenize = 'unicode61 remove_diacritics 2'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS prontuario_busca_ai AFTER INSERT ON prontuario BEGIN
+        INSERT INTO prontuario_busca(rowid, beneficiario, atendimento, observacao, causas)
+        VALUES (NEW.id, NEW.beneficiario, NEW.atendimento, COALESCE(NEW.observacao, ''),
+                %s);
+    END""" % _CAUSAS_DO_PRONTUARIO.format(id='NEW.id'),
+    """CREATE TRIGGER IF NOT EXISTS prontuario_busca_au
+    AFTER UPDATE OF beneficiario, atendimento, observacao ON prontuario BEGIN
+        UPDATE prontuario_busca
+        SET beneficiario = NEW.beneficiario, atendimento = NEW.atendimento,
+            observacao = COALESCE(NEW.observacao, '')
+        WHERE rowid = NEW.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS prontuario_busca_ad AFTER DELETE ON prontuario BEGIN
+        DELETE FROM prontuario_busca WHERE rowid = OLD.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS erro_busca_ai AFTER INSERT ON erro BEGIN
+        UPDATE prontuario_busca SET causas = %s WHERE rowid = NEW.prontuario_id;
+    END""" % _CAUSAS_DO_PRONTUARIO.format(id='NEW.prontuario_id'),
+    """CREATE TRIGGER IF NOT EXISTS erro_busca_au AFTER UPDATE OF causa_id, prontuario_id ON erro BEGIN
+        UPDATE prontuario_busca SET causas = %s WHERE rowid = OLD.prontuario_id;
+        UPDATE prontuario_busca SET causas = %s WHERE rowid = NEW.prontuario_id;
+    END""" % (_CAUSAS_DO_PRONTUARIO.format(id='OLD.prontuario_id'),
+              _CAUSAS_DO_PRONTUARIO.format(id='NEW.prontuario_id')),
+    """CREATE TRIGGER IF NOT EXISTS erro_busca_ad AFTER DELETE ON erro BEGIN
+        UPDATE prontuario_busca SET causas = %s WHERE rowid = OLD.prontuario_id;
+    END""" % _CAUSAS_DO_PRONTUARIO.format(id='OLD.prontuario_id'),
+    """CREATE TRIGGER IF NOT EXISTS causa_busca_au AFTER UPDATE OF descricao ON causa BEGIN
+        UPDATE prontuario_busca SET causas = %s
+        WHERE rowid IN (SELECT prontuario_id FROM erro WHERE causa_id = NEW.id);
+    END""" % _CAUSAS_DO_PRONTUARIO.format(id='prontuario_busca.rowid'),
+]
+
+_busca_fts = {'ativa': None}
+
+def reconstruir_busca_textual():
+    """Repopula o índice FTS inteiro a partir de prontuario/erro"""
+    inicio = time.perf_counter()
+    db.session.execute(text("DELETE FROM prontuario_busca"))
+    db.session.execute(text(
+        "INSERT INTO prontuario_busca(rowid, beneficiario, atendimento, observacao, causas) "
+        "SELECT p.id, p.beneficiario, p.atendimento, COALESCE(p.observacao, ''), "
+        "COALESCE(e.causas, '') FROM prontuario p "
+        "LEFT JOIN (SELECT e.prontuario_id, group_concat(c.descricao, ' ') AS causas "
+        "           FROM erro e JOIN causa c ON c.id = e.causa_id GROUP BY e.prontuario_id) e "
+        "       ON e.prontuario_id = p.id"
+    ))
+    db.session.commit()
+    total = db.session.execute(text("SELECT count(*) FROM prontuario_busca")).scalar()
+    print(f"🔎 Índice de busca reconstruído: {total} prontuários em {time.perf_counter() - inicio:.2f}s")
+
+def configurar_busca_textual():
+    """
+    Cria a tabela FTS5 e os triggers (idempotente) e faz a carga inicial quando o índice
+    está vazio. Retorna False se o banco não for SQLite ou não tiver FTS5; nesse caso a
+    busca usa LIKE.
+    """
+    if _busca_fts['ativa'] is not None:
+        return _busca_fts['ativa']
+    if db.engine.dialect.name != 'sqlite':
+        _busca_fts['ativa'] = False
+        return False
+    try:
+        for ddl in BUSCA_DDL:
+            db.session.execute(text(ddl))
+        db.session.commit()
+        indexados = db.session.execute(text("SELECT count(*) FROM prontuario_busca")).scalar()
+        if indexados != db.session.query(func.count(Prontuario.id)).scalar():
+            reconstruir_busca_textual()
+        _busca_fts['ativa'] = True
+    except Exception as e:
+        db.session.rollback()
+        print(f"⚠️ FTS5 indisponível, busca textual vai usar LIKE: {e}")
+        _busca_fts['ativa'] = False
+    return _busca_fts['ativa']
+
+def _consulta_fts(texto):
+    """Converte o texto digitado em uma consulta FTS5: cada palavra vira um prefixo entre aspas"""
+    termos = re.findall(r'\w+', texto or '')
+    return ' '.join(f'"{t}"*' for t in termos)
+
+def buscar_prontuarios(texto, pagina=1, por_pagina=20):
+    """Busca ranqueada (bm25) por prefixo; retorna (resultados, total)"""
+    deslocamento = (pagina - 1) * por_pagina
+    colunas = (Prontuario.id, Prontuario.beneficiario, Prontuario.atendimento, Prontuario.convenio_id,
+               Prontuario.setor_id, Prontuario.status_id)
+
+    def resultado(linha, trecho):
+        item = dict(linha)
+        for campo, (coluna_id, modelo) in CAMPOS_CATALOGO_PRONTUARIO.items():
+            item[campo] = texto_catalogo(modelo, item.pop(coluna_id))
+        return {**item, 'trecho': trecho}
+
+    if configurar_busca_textual():
+        consulta = _consulta_fts(texto)
+        if not consulta:
+            return [], 0
+        total = db.session.execute(
+            text("SELECT count(*) FROM prontuario_busca WHERE prontuario_busca MATCH :q"),
+            {'q': consulta}).scalar()
+        linhas = db.session.execute(text(
+            "SELECT p.id, p.beneficiario, p.atendimento, p.convenio_id, p.setor_id, p.status_id, "
+            "       snippet(prontuario_busca, -1, char(2), char(3), '…', 12) AS trecho "
+            "FROM prontuario_busca JOIN prontuario p ON p.id = prontuario_busca.rowid "
+            "WHERE prontuario_busca MATCH :q ORDER BY prontuario_busca.rank "
+            "LIMIT :limite OFFSET :deslocamento"
+        ), {'q': consulta, 'limite': por_pagina, 'deslocamento': deslocamento}).mappings().all()
+        # O trecho vai escapado, só os marcadores do snippet viram <mark>
+        return [resultado(linha, str(escape(linha['trecho'] or '')).replace('\x02', '<mark>').replace('\x03', '</mark>'))
+                for linha in linhas], total
+
+    # Fallback sem FTS5 (ex.: PostgreSQL): LIKE em cada palavra, mais recentes primeiro
+    termos = re.findall(r'\w+', texto or '')
+    if not termos:
+        return [], 0
+    query = db.session.query(*colunas)
+    for termo in termos:
+        padrao = f'%{termo}%'
+        query = query.filter(db.or_(
+            Prontuario.beneficiario.ilike(padrao),
+            Prontuario.atendimento.ilike(padrao),
+            Prontuario.observacao.ilike(padrao),
+            Prontuario.erros.any(Erro.causa.ilike(padrao))
+        ))
+    total = query.count()
+    linhas = query.order_by(Prontuario.data_criacao.desc(), Prontuario.id.desc()) \
+        .limit(por_pagina).offset(deslocamento).all()
+    return [resultado(l._mapping, '') for l in linhas], total
+
+# --- 4.5 CONTADORES DE ERRO DO PRONTUÁRIO ---
+
+def _sincronizar_contadores_erro(p):
+    """Atualiza erro_count/has_erro de p a partir da coleção de erros (recarregada após flush)"""
+    p.erro_count = sum(e.quantidade for e in p.erros)
+    p.has_erro = p.erro_count > 0
+
+def garantir_colunas_contadores_erro():
+    """Adiciona erro_count/has_erro em bancos antigos (create_all não altera tabelas existentes)"""
+    colunas = {c['name'] for c in db.inspect(db.engine).get_columns('prontuario')}
+    adicionadas = False
+    if 'erro_count' not in colunas:
+        db.session.execute(text("ALTER TABLE prontuario ADD COLUMN erro_count INTEGER NOT NULL DEFAULT 0"))
+        adicionadas = True
+    if 'has_erro' not in colunas:
+        db.session.execute(text("ALTER TABLE prontuario ADD COLUMN has_erro BOOLEAN NOT NULL DEFAULT FALSE"))
+        adicionadas = True
+    db.session.commit()
+    if adicionadas:
+        print("🔧 Colunas erro_count/has_erro adicionadas em 'prontuario'")
+    return adicionadas
+
+def garantir_coluna_quantidade_erro():
+    """Adiciona erro.quantidade em bancos antigos (cada linha antiga vale 1 ocorrência)"""
+    colunas = {c['name'] for c in db.inspect(db.engine).get_columns('erro')}
+    if 'quantidade' in colunas:
+        return False
+    db.session.execute(text("ALTER TABLE erro ADD COLUMN quantidade INTEGER NOT NULL DEFAULT 1"))
+    db.session.commit()
+    print("🔧 Coluna quantidade adicionada em 'erro'")
+    return True
+
+def consolidar_erros_duplicados():
+    """
+    Junta linhas repetidas de erro (mesmo prontuário, tipo, causa, responsável, categoria e
+    dia de criação) numa só, somando a quantidade. Totais, contadores e o ResumoDiario não
+    mudam. Retorna quantas linhas foram removidas.
+    """
+    chave = (Erro.prontuario_id, Erro.tipo_erro_id, Erro.causa_id, Erro.responsavel_id,
+             Erro.categoria_erro_id, func.date(Erro.data_criacao))
+    grupos = (db.session.query(func.min(Erro.id), func.sum(Erro.quantidade))
+              .group_by(*chave)
+              .having(func.count(Erro.id) > 1)
+              .all())
+    if not grupos:
+        return 0
+    tabela = Erro.__table__
+    db.session.execute(tabela.update().where(tabela.c.id == db.bindparam('_id'))
+                       .values(quantidade=db.bindparam('_quantidade')),
+                       [{'_id': id_, '_quantidade': quantidade} for id_, quantidade in grupos])
+    manter = db.select(func.min(Erro.id)).group_by(*chave)
+    removidas = db.session.execute(tabela.delete().where(tabela.c.id.not_in(manter))).rowcount
+    db.session.commit()
+    print(f"🧹 {removidas} linhas de erro repetidas consolidadas em {len(grupos)}")
+    return removidas
+
+def recalcular_contadores_erro():
+    """Recontagem completa de erro_count/has_erro com um único UPDATE; retorna quantos estavam divergentes"""
+    # A recontagem é uma subconsulta por prontuário: sem o índice de erro.prontuario_id ela varre
+    # a tabela erro inteira para cada prontuário (banco antigo chega aqui no passo 4, antes do 5)
+    criar_indice('ix_erro_prontuario_id', 'erro', 'prontuario_id')
+    contagem = (db.select(func.coalesce(func.sum(Erro.quantidade), 0))
+                .where(Erro.prontuario_id == Prontuario.id)
+                .scalar_subquery())
+    divergentes = db.session.query(func.count(Prontuario.id)).filter(
+        db.or_(Prontuario.erro_count != contagem, Prontuario.has_erro != (contagem > 0))
+    ).scalar()
+    _atualizar_contadores_erro()
+    db.session.commit()
+    print(f"🔢 Contadores de erro recalculados ({divergentes} prontuários estavam divergentes)")
+    return divergentes
+
+def _atualizar_contadores_erro(ids=None):
+    """UPDATE de erro_count/has_erro a partir da tabela erro (todos, ou só os prontuários em `ids`)"""
+    tabela = Prontuario.__table__
+    contagem = (db.select(func.coalesce(func.sum(Erro.quantidade), 0))
+                .where(Erro.prontuario_id == tabela.c.id)
+                .scalar_subquery())
+    # Só grava quem diverge, e sem o onupdate de data_atualizacao: recontagem não é alteração
+    # do prontuário (a data de atualização é auditoria e critério do arquivamento)
+    stmt = (tabela.update()
+            .where(db.or_(tabela.c.erro_count.is_distinct_from(contagem),
+                          tabela.c.has_erro.is_distinct_from(contagem > 0)))
+            .values(erro_count=contagem, has_erro=contagem > 0, data_atualizacao=tabela.c.data_atualizacao))
+    if ids is not None:
+        stmt = stmt.where(tabela.c.id.in_(list(ids)))
+    db.session.execute(stmt)
+
+# --- 4.6 CATÁLOGOS DE REFERÊNCIA (CACHE) ---
+# Convênios, setores, responsáveis, tipos e categorias de erro mudam poucas vezes por mês e
+# são lidos em toda página. Ficam em memória já no formato dos templates; só as rotas de
+# configuração (@invalida_catalogos) e os cadastros feitos por uma transação trocam a versão,
+# que fica na linha 'referencia' de versao_cache: vale para todos os workers. Os valores são
+# compartilhados entre requisições: trate-os como somente leitura.
+
+cache_referencia = CacheResultados(max_itens=32, ttl_segundos=app.config['CACHE_REFERENCIA_TTL'],
+                                   compartilhado='referencia', releitura_segundos=1)
+
+def invalida_catalogos(f):
+    """Decorator das rotas de configuração: POST/DELETE aceito (2xx) descarta os catálogos em cache"""
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        resposta = make_response(f(*args, **kwargs))
+        if _escrita_aceita(resposta):
+            cache_referencia.nova_versao()
+        return resposta
+    return wrapper
+
+def nomes_ativos(modelo):
+    """Nomes ativos de Convenio, Setor ou Responsavel, em ordem alfabética"""
+    return cache_referencia.obter(('nomes_ativos', modelo.__tablename__), lambda: [
+        item.nome for item in modelo.query.filter_by(status='ativo').order_by(modelo.nome).all()
+    ])
+
+def responsaveis_ativos():
+    return cache_referencia.obter('responsaveis_ativos', lambda: [
+        {'id': r.id, 'nome': r.nome}
+        for r in Responsavel.query.filter_by(status='ativo').order_by(Responsavel.nome).all()
+    ])
+
+def categorias_erro_ativas():
+    return cache_referencia.obter('categorias_erro_ativas', lambda: [
+        ce.to_dict() for ce in CategoriaErro.query.filter_by(status='ativo').order_by(CategoriaErro.nome).all()
+    ])
+
+def categoria_id_por_tipo(tipo):
+    """id da CategoriaErro ativa com o mesmo nome do tipo de erro (ou None)"""
+    mapa = cache_referencia.obter('categoria_por_tipo', lambda: {
+        nome: id_ for id_, nome in db.session.query(CategoriaErro.id, CategoriaErro.nome)
+        .filter_by(status='ativo').order_by(CategoriaErro.id.desc())
+    })
+    return mapa.get(tipo)
+
+# Dicionário dos cadastros usados como FK (convênio, setor, status, tipo e causa do erro):
+# id <-> texto em memória. Só entra no cache o que já foi commitado; o que a transação atual
+# cadastrou fica em session.info até o commit (ver _descartar_dicionarios).
+
+def _chave_dicionario(modelo, texto, tipo_erro_id=None):
+    return (tipo_erro_id, texto) if modelo is Causa else texto
+
+def _dicionario(modelo):
+    return cache_referencia.obter(('dicionario', modelo.__tablename__), lambda: _carregar_dicionario(modelo))
+
+def _carregar_dicionario(modelo):
+    tabela = modelo.__table__
+    colunas = [tabela.c.id, coluna_texto_catalogo(modelo)] + ([tabela.c.tipo_erro_id] if modelo is Causa else [])
+    textos, ids = {}, {}
+    # Conexão própria: não enxerga inserções ainda não commitadas da sessão (que podem sofrer rollback)
+    with db.engine.connect() as conexao:
+        for id_, texto, *tipo in conexao.execute(db.select(*colunas).order_by(tabela.c.id)):
+            textos[id_] = texto
+            ids.setdefault(_chave_dicionario(modelo, texto, *tipo), id_)
+    return {'texto': textos, 'id': ids}
+
+def _novos_da_sessao():
+    return db.session.info.setdefault('dicionario_novos', {})
+
+def texto_catalogo(modelo, id_):
+    """Texto do item `id_` do cadastro (None para None)"""
+    if id_ is None:
+        return None
+    texto = _dicionario(modelo)['texto'].get(id_)
+    if texto is not None:
+        return texto
+    chave = (modelo.__tablename__, 'texto', id_)
+    novos = _novos_da_sessao()
+    if chave not in novos:
+        with db.session.no_autoflush:
+            novos[chave] = db.session.scalar(db.select(coluna_texto_catalogo(modelo))
+                                             .where(modelo.__table__.c.id == id_))
+        # Cadastrado por outro processo depois da carga do dicionário
+        cache_referencia.descartar(('dicionario', modelo.__tablename__))
+    return novos[chave]
+
+# Nome do cadastro nas mensagens de validação
+ROTULOS_CATALOGO = {'convenio': 'Convênio', 'setor': 'Setor', 'status_prontuario': 'Status',
+                    'tipo_erro': 'Tipo de erro', 'causa': 'Causa'}
+
+@contextmanager
+def cadastrando_novos():
+    """
+    Dentro do bloco, id_catalogo cadastra como 'inativo' o texto que não está no cadastro.
+    Só para cargas em massa que pediram isso (importação com criar_cadastros, alimentar_bd):
+    os itens aparecem na tela de configurações para revisão.
+    """
+    anterior = db.session.info.get('criar_cadastros', False)
+    db.session.info['criar_cadastros'] = True
+    try:
+        yield
+    finally:
+        db.session.info['criar_cadastros'] = anterior
+
+def id_catalogo(modelo, texto, tipo_erro_id=None):
+    """
+    id do item com este texto no cadastro (na Causa, dentro do tipo de erro). None para None.
+    Texto fora do cadastro levanta ValueError, a não ser dentro de cadastrando_novos().
+    """
+    if texto is None:
+        return None
+    chave = _chave_dicionario(modelo, texto, tipo_erro_id)
+    id_ = _dicionario(modelo)['id'].get(chave)
+    if id_ is not None:
+        return id_
+    novos = _novos_da_sessao()
+    chave_sessao = (modelo.__tablename__, 'id', chave)
+    if chave_sessao in novos:
+        return novos[chave_sessao]
+
+    tabela = modelo.__table__
+    coluna = coluna_texto_catalogo(modelo)
+    consulta = db.select(func.min(tabela.c.id)).where(coluna == texto)
+    if modelo is Causa:
+        consulta = consulta.where(tabela.c.tipo_erro_id == tipo_erro_id)
+    # Direto na conexão da sessão (sem autoflush: pode ser chamado no meio da montagem de um objeto)
+    conexao = db.session.connection()
+    id_ = conexao.execute(consulta).scalar()
+    if id_ is not None:
+        cache_referencia.descartar(('dicionario', tabela.name))  # cadastrado por outro processo
+    elif not db.session.info.get('criar_cadastros'):
+        raise ValueError(f"{ROTULOS_CATALOGO[tabela.name]} '{texto}' não está no cadastro")
+    else:
+        agora = datetime.now()
+        valores = {coluna.name: texto, 'tipo_erro_id': tipo_erro_id, 'status': 'inativo',
+                   'data_criacao': agora, 'data_atualizacao': agora}
+        if modelo is TipoErro:
+            valores.update(descricao=texto, cor='#6c757d')
+        try:
+            with conexao.begin_nested():
+                conexao.execute(tabela.insert().values({k: v for k, v in valores.items() if k in tabela.c}))
+        except IntegrityError:
+            pass  # outro processo cadastrou o mesmo nome ao mesmo tempo
+        id_ = conexao.execute(consulta).scalar()
+        db.session.info.setdefault('dicionario_alterado', set()).add(tabela.name)
+        app.logger.info("'%s' cadastrado em %s (id %s, inativo)", texto, tabela.name, id_)
+    novos[chave_sessao] = id_
+    novos[(tabela.name, 'texto', id_)] = texto
+    return id_
+
+def ids_erro(tipo, causa):
+    """(tipo_erro_id, causa_id) de um erro a partir dos textos"""
+    tipo_erro_id = id_catalogo(TipoErro, tipo)
+    return tipo_erro_id, id_catalogo(Causa, causa, tipo_erro_id)
+
+# Campo de texto do prontuário -> (coluna da FK, cadastro), para INSERT/UPDATE direto na tabela
+CAMPOS_CATALOGO_PRONTUARIO = {
+    'convenio': ('convenio_id', Convenio),
+    'setor': ('setor_id', Setor),
+    'status': ('status_id', StatusProntuario),
+}
+
+def colunas_prontuario(campos):
+    """Troca convenio/setor/status de um dict de campos pelos ids dos cadastros (ValueError se faltar)"""
+    colunas = dict(campos)
+    for campo, (coluna_id, modelo) in CAMPOS_CATALOGO_PRONTUARIO.items():
+        if campo in colunas:
+            colunas[coluna_id] = id_catalogo(modelo, colunas.pop(campo))
+    return colunas
+
+@event.listens_for(Session, 'after_commit')
+def _descartar_dicionarios(sessao):
+    # O que a transação cadastrou já está commitado: todos os processos recarregam os catálogos
+    if sessao.info.get('dicionario_alterado'):
+        cache_referencia.nova_versao()
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _esquecer_novos_do_dicionario(sessao, transacao_anterior):
+    # Rollback (inclusive de SAVEPOINT) pode ter desfeito cadastros: volta a consultar o banco
+    sessao.info.pop('dicionario_novos', None)
+
+@event.listens_for(Session, 'after_transaction_end')
+def _limpar_dicionario_da_transacao(sessao, transacao):
+    if transacao.parent is None:
+        sessao.info.pop('dicionario_novos', None)
+        sessao.info.pop('dicionario_alterado', None)
+
+def catalogo_configuracoes():
+    """Todos os cadastros (ativos e inativos) no formato da tela de configurações"""
+    return cache_referencia.obter('configuracoes', lambda: {
+        'convenios': [c.to_dict() for c in Convenio.query.order_by(Convenio.nome).all()],
+        'setores': [s.to_dict() for s in Setor.query.order_by(Setor.nome).all()],
+        'responsaveis': [r.to_dict() for r in Responsavel.query.order_by(Responsavel.nome).all()],
+        'tipos_erro_lista': [t.to_dict() for t in TipoErro.query.order_by(TipoErro.nome).all()]
+    })
+
+# --- 4.7 IMPORTAÇÃO DE PLANILHA (XLSX) ---
+# Uma linha da planilha = um erro; as linhas do mesmo atendimento formam um prontuário.
+# A leitura é em modo read-only (iter_rows), em lotes: cada lote faz o upsert dos
+# prontuários pelo atendimento e insere com executemany apenas os erros que ainda não
+# existem, então reimportar a mesma planilha não duplica nada.
+
+ABA_PADRAO_IMPORTACAO = 'OUTUBRO 2025 HU'
+
+# Nome normalizado do cabeçalho (minúsculo, sem acento) -> campo
+CABECALHOS_IMPORTACAO = {
+    'beneficiario': 'beneficiario',
+    'convenio': 'convenio',
+    'setor': 'setor',
+    'atendimento': 'atendimento',
+    'admissao': 'admissao',
+    'alta': 'alta',
+    'recebimento do prontuario': 'recebimento_prontuario',
+    'data conta': 'data_conta',
+    'envio para correcao': 'enviado_faturamento',
+    'enviado faturamento': 'enviado_faturamento',
+    'fim auditoria': 'fim_auditoria',
+    'observacoes': 'observacao',
+    'observacao': 'observacao',
+    'status': 'status',
+    'causa': 'causa',
+    'tipo': 'tipo',
+    'tipo de erro': 'tipo',
+    'responsavel': 'responsavel',
+}
+CAMPOS_DATA_IMPORTACAO = ('admissao', 'alta', 'recebimento_prontuario', 'data_conta',
+                          'enviado_faturamento', 'fim_auditoria')
+TIPO_NAO_CLASSIFICADO = 'Não classificado'
+
+def _normalizar_cabecalho(valor):
+    import unicodedata
+    texto = unicodedata.normalize('NFKD', str(valor or '')).encode('ascii', 'ignore').decode()
+    return ' '.join(texto.lower().split())
+
+def _texto_planilha(valor):
+    if valor is None:
+        return ''
+    if isinstance(valor, float) and valor.is_integer():
+        valor = int(valor)  # atendimento lido como 12345.0
+    texto = str(valor).strip()
+    return '' if texto.lower() in ('nan', 'nat', 'none') else texto
+
+def _data_planilha(valor):
+    if valor is None or valor == '':
+        return None
+    if isinstance(valor, datetime):
+        return valor
+    if isinstance(valor, date):
+        return datetime(valor.year, valor.month, valor.day)
+    texto = _texto_planilha(valor)
+    for formato in ('%d/%m/%Y', '%Y-%m-%d', '%d/%m/%y', '%Y-%m-%d %H:%M:%S'):
+        try:
+            return datetime.strptime(texto, formato)
+        except ValueError:
+            continue
+    raise ValueError(f"data inválida: {texto}")
+
+class _ContextoImportacao:
+    """Estado que atravessa os lotes: mapas de referência e o que a importação já gravou"""
+
+    def __init__(self, status_padrao, criar_cadastros=False):
+        self.status_padrao = status_padrao
+        self.criar_cadastros = criar_cadastros
+        self.status_validos = {s.lower(): s for s in STATUS_OPCOES}
+        self.tipo_por_causa = {
+            causa['descricao'].strip().lower(): nome_tipo
+            for nome_tipo, info in get_tipos_erro_dict().items()
+            for causa in info.get('causas', [])
+        }
+        self.responsaveis = {nome: id_ for id_, nome in db.session.query(Responsavel.id, Responsavel.nome)}
+        # atendimento -> Counter das chaves de erro já vistas nesta planilha
+        self.erros_importados = defaultdict(Counter)
+        self.atendimentos_vistos = set()
+        self.resumo = {
+            'linhas_lidas': 0, 'linhas_invalidas': 0, 'prontuarios_inseridos': 0,
+            'prontuarios_atualizados': 0, 'erros_inseridos': 0, 'responsaveis_criados': 0,
+            'erros_sem_tipo': 0, 'problemas': []
+        }
+
+    def problema(self, linha, mensagem):
+        self.resumo['linhas_invalidas'] += 1
+        if len(self.resumo['problemas']) < 50:
+            self.resumo['problemas'].append({'linha': linha, 'erro': mensagem})
+
+def _ler_linha_planilha(valores, colunas, numero, contexto):
+    """Valida uma linha e devolve um dict com os campos do prontuário e do erro (ou None)"""
+    def campo(nome):
+        indice = colunas.get(nome)
+        return valores[indice] if indice is not None and indice < len(valores) else None
+
+    atendimento = _texto_planilha(campo('atendimento'))
+    if not atendimento:
+        if any(v not in (None, '') for v in valores):
+            contexto.problema(numero, 'atendimento em branco')
+        return None
+    registro = {
+        'atendimento': atendimento,
+        'beneficiario': _texto_planilha(campo('beneficiario')),
+        'convenio': _texto_planilha(campo('convenio')),
+        'setor': _texto_planilha(campo('setor')),
+        'observacao': _texto_planilha(campo('observacao')) or None,
+        'status': contexto.status_validos.get(_texto_planilha(campo('status')).lower()),
+    }
+    if not registro['beneficiario']:
+        contexto.problema(numero, f'beneficiário em branco (atendimento {atendimento})')
+        return None
+    if not registro['convenio'] or not registro['setor']:
+        contexto.problema(numero, f'convênio ou setor em branco (atendimento {atendimento})')
+        return None
+    try:
+        for nome in CAMPOS_DATA_IMPORTACAO:
+            registro[nome] = _data_planilha(campo(nome))
+    except ValueError as e:
+        contexto.problema(numero, f'{e} (atendimento {atendimento})')
+        return None
+
+    causa = _texto_planilha(campo('causa'))
+    registro['erro'] = None
+    tipo = None
+    if causa:
+        tipo = _texto_planilha(campo('tipo')) or contexto.tipo_por_causa.get(causa.lower())
+        registro['erro'] = (tipo or TIPO_NAO_CLASSIFICADO, causa, _texto_planilha(campo('responsavel')))
+    if not contexto.criar_cadastros:
+        # Sem o opt-in, valor fora dos cadastros rejeita a linha: a planilha não cadastra nada
+        try:
+            if causa and not tipo:
+                raise ValueError(f"Causa '{causa}' não está no cadastro")
+            colunas_prontuario({'convenio': registro['convenio'], 'setor': registro['setor']})
+            if registro['erro']:
+                ids_erro(*registro['erro'][:2])
+        except ValueError as e:
+            contexto.problema(numero, f'{e} (atendimento {atendimento})')
+            return None
+    if causa and not tipo:
+        contexto.resumo['erros_sem_tipo'] += 1
+    return registro
+
+def _gravar_lote_importacao(lote, contexto):
+    """Upsert dos prontuários do lote, responsáveis novos, vínculos, erros faltantes e o ResumoDiario"""
+    tabela = Prontuario.__table__
+    agora = datetime.now()
+
+    # Primeira linha de cada atendimento define os dados do prontuário
+    por_atendimento = {}
+    erros_lote = defaultdict(Counter)
+    for registro in lote:
+        por_atendimento.setdefault(registro['atendimento'], registro)
+        if registro['erro']:
+            erros_lote[registro['atendimento']][registro['erro']] += 1
+
+    existentes = {}
+    for id_, atendimento in (db.session.query(func.min(Prontuario.id), Prontuario.atendimento)
+                             .filter(Prontuario.atendimento.in_(list(por_atendimento)))
+                             .group_by(Prontuario.atendimento)):
+        existentes[atendimento] = id_
+    # Convênio, setor e status fazem parte da chave do ResumoDiario: diferença antes/depois do lote
+    resumo_antes = _totais_resumo_ids(existentes.values())
+
+    campos = ['beneficiario', 'convenio', 'setor', 'observacao', 'status', *CAMPOS_DATA_IMPORTACAO]
+    novos, atualizados = [], []
+    for atendimento, r in por_atendimento.items():
+        diarias = max(1, (r['alta'] - r['admissao']).days) if r['admissao'] and r['alta'] else 0
+        if atendimento in existentes:
+            atualizados.append({'_id': existentes[atendimento], 'v_diarias': diarias or None,
+                                **{f'v_{c}': r[c] for c in campos}})
+        else:
+            novos.append({'atendimento': atendimento, 'diarias': diarias,
+                          'data_criacao': agora, 'data_atualizacao': agora,
+                          **{c: r[c] for c in campos}, 'status': r['status'] or contexto.status_padrao})
+    if novos:
+        db.session.execute(tabela.insert(), [colunas_prontuario(n) for n in novos])
+    if atualizados:
+        # Só sobrescreve o que veio preenchido na planilha
+        colunas = [CAMPOS_CATALOGO_PRONTUARIO.get(c, (c,))[0] for c in campos]
+        db.session.execute(
+            tabela.update().where(tabela.c.id == db.bindparam('_id')).values(
+                data_atualizacao=agora,
+                diarias=func.coalesce(db.bindparam('v_diarias'), tabela.c.diarias),
+                **{c: func.coalesce(db.bindparam(f'v_{c}'), tabela.c[c]) for c in colunas}
+            ),
+            [{'_id': a['_id'], 'v_diarias': a['v_diarias'],
+              **{f'v_{c}': v for c, v in colunas_prontuario({c: a[f'v_{c}'] for c in campos}).items()}}
+             for a in atualizados]
+        )
+    # Um atendimento pode se repetir em lotes seguintes: conta cada um uma vez só
+    contexto.resumo['prontuarios_inseridos'] += len(novos)
+    contexto.resumo['prontuarios_atualizados'] += sum(
+        1 for a in por_atendimento if a in existentes and a not in contexto.atendimentos_vistos)
+    contexto.atendimentos_vistos.update(por_atendimento)
+    if novos:
+        for id_, atendimento in (db.session.query(func.min(Prontuario.id), Prontuario.atendimento)
+                                 .filter(Prontuario.atendimento.in_([n['atendimento'] for n in novos]))
+                                 .group_by(Prontuario.atendimento)):
+            existentes[atendimento] = id_
+
+    # Responsáveis que ainda não existem
+    nomes = {erro[2] for contagem in erros_lote.values() for erro in contagem if erro[2]}
+    faltantes = [n for n in nomes if n not in contexto.responsaveis]
+    if faltantes:
+        db.session.execute(Responsavel.__table__.insert(), [
+            {'nome': n, 'status': 'ativo', 'data_criacao': agora, 'data_atualizacao': agora} for n in faltantes
+        ])
+        contexto.responsaveis.update(
+            {nome: id_ for id_, nome in db.session.query(Responsavel.id, Responsavel.nome)
+             .filter(Responsavel.nome.in_(faltantes))})
+        contexto.resumo['responsaveis_criados'] += len(faltantes)
+
+    ids_lote = [existentes[a] for a in erros_lote]
+    if not ids_lote:
+        _atualizar_resumo(resumo_antes, _totais_resumo_ids(existentes.values()))
+        return set()
+
+    # Vínculos prontuário x responsável que faltam
+    vinculos = {(existentes[a], contexto.responsaveis[erro[2]])
+                for a, contagem in erros_lote.items() for erro in contagem if erro[2]}
+    assoc = prontuario_responsavel_association
+    ja_vinculados = set(db.session.execute(
+        db.select(assoc.c.prontuario_id, assoc.c.responsavel_id).where(assoc.c.prontuario_id.in_(ids_lote))
+    ).all())
+    novos_vinculos = [{'prontuario_id': p, 'responsavel_id': r} for p, r in vinculos - ja_vinculados]
+    if novos_vinculos:
+        db.session.execute(assoc.insert(), novos_vinculos)
+
+    # Erros: grava só a diferença entre o que a planilha pede e o que já está no banco,
+    # somando na quantidade da linha existente ou criando uma linha com a quantidade faltante.
+    # A comparação é pelos ids de tipo e causa.
+    no_banco = defaultdict(Counter)
+    linha_existente = {}
+    for id_, pid, tipo_erro_id, causa_id, responsavel_id, quantidade in db.session.query(
+            Erro.id, Erro.prontuario_id, Erro.tipo_erro_id, Erro.causa_id, Erro.responsavel_id, Erro.quantidade
+    ).filter(Erro.prontuario_id.in_(ids_lote)).order_by(Erro.id):
+        no_banco[pid][(tipo_erro_id, causa_id, responsavel_id)] += quantidade
+        linha_existente.setdefault((pid, tipo_erro_id, causa_id, responsavel_id), id_)
+
+    novos_erros, somas, alterados = [], [], set()
+    for atendimento, contagem in erros_lote.items():
+        pid = existentes[atendimento]
+        contexto.erros_importados[atendimento].update(contagem)
+        pedidos = Counter()
+        for (t, c, r), n in contexto.erros_importados[atendimento].items():
+            pedidos[(*ids_erro(t, c), contexto.responsaveis.get(r))] += n
+        for (tipo_erro_id, causa_id, responsavel_id), qtd in (pedidos - no_banco[pid]).items():
+            id_ = linha_existente.get((pid, tipo_erro_id, causa_id, responsavel_id))
+            if id_:
+                somas.append({'_id': id_, '_quantidade': qtd})
+            else:
+                novos_erros.append({'prontuario_id': pid, 'tipo_erro_id': tipo_erro_id, 'causa_id': causa_id,
+                                    'quantidade': qtd, 'responsavel_id': responsavel_id, 'data_criacao': agora})
+            alterados.add(pid)
+            contexto.resumo['erros_inseridos'] += qtd
+    if novos_erros:
+        db.session.execute(Erro.__table__.insert(), novos_erros)
+    if somas:
+        tabela_erro = Erro.__table__
+        db.session.execute(tabela_erro.update().where(tabela_erro.c.id == db.bindparam('_id'))
+                           .values(quantidade=tabela_erro.c.quantidade + db.bindparam('_quantidade')), somas)
+    _atualizar_resumo(resumo_antes, _totais_resumo_ids(existentes.values()))
+    # Só esses precisam recontar erro_count/has_erro (reimportar a mesma planilha não mexe em nada)
+    return alterados
+
+def importar_planilha(origem, aba=None, tamanho_lote=1000, status_padrao='Aguardando Auditoria',
+                      criar_cadastros=False):
+    """
+    Importa uma planilha .xlsx (caminho ou arquivo aberto) em lotes de `tamanho_lote` linhas.
+    Linha com convênio, setor, tipo ou causa fora dos cadastros é rejeitada; com
+    criar_cadastros=True esses valores são cadastrados como inativos (ver cadastrando_novos).
+    Cada lote é uma transação que já atualiza os contadores de erro e o ResumoDiario dos
+    prontuários do lote: o custo acompanha o tamanho da planilha, não o histórico do banco.
+    Retorna um resumo com contagens e as primeiras linhas rejeitadas.
+    """
+    from openpyxl import load_workbook
+
+    inicio = time.perf_counter()
+    wb = load_workbook(origem, read_only=True, data_only=True)
+    try:
+        if aba:
+            if aba not in wb.sheetnames:
+                raise ValueError(f"Aba '{aba}' não encontrada. Abas: {', '.join(wb.sheetnames)}")
+            ws = wb[aba]
+        else:
+            ws = wb[ABA_PADRAO_IMPORTACAO] if ABA_PADRAO_IMPORTACAO in wb.sheetnames else wb.worksheets[0]
+
+        linhas = ws.iter_rows(values_only=True)
+        cabecalho = next(linhas, None) or ()
+        colunas = {}
+        for indice, valor in enumerate(cabecalho):
+            campo = CABECALHOS_IMPORTACAO.get(_normalizar_cabecalho(valor))
+            if campo and campo not in colunas:
+                colunas[campo] = indice
+        faltando = [c for c in ('atendimento', 'beneficiario') if c not in colunas]
+        if faltando:
+            raise ValueError(f"Colunas obrigatórias ausentes na aba '{ws.title}': {', '.join(faltando)}")
+
+        contexto = _ContextoImportacao(status_padrao, criar_cadastros)
+        print(f"📥 Importando aba '{ws.title}' em lotes de {tamanho_lote} linhas...")
+        with cadastrando_novos() if criar_cadastros else nullcontext():
+            lote = []
+            for numero, valores in enumerate(linhas, start=2):
+                contexto.resumo['linhas_lidas'] += 1
+                registro = _ler_linha_planilha(valores, colunas, numero, contexto)
+                if registro:
+                    lote.append(registro)
+                if len(lote) >= tamanho_lote:
+                    _atualizar_contadores_erro(_gravar_lote_importacao(lote, contexto))
+                    db.session.commit()
+                    lote = []
+                    print(f"   ⏳ {contexto.resumo['linhas_lidas']} linhas processadas...")
+            if lote:
+                _atualizar_contadores_erro(_gravar_lote_importacao(lote, contexto))
+                db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    finally:
+        wb.close()
+
+    resumo = contexto.resumo
+    resumo['aba'] = ws.title
+    resumo['segundos'] = round(time.perf_counter() - inicio, 2)
+    print(f"✅ Importação concluída em {resumo['segundos']}s: {resumo['prontuarios_inseridos']} prontuários novos, "
+          f"{resumo['prontuarios_atualizados']} atualizados, {resumo['erros_inseridos']} erros, "
+          f"{resumo['linhas_invalidas']} linhas rejeitadas")
+    return resumo
+
+# --- 4.8 ESCRITA AGRUPADA (GROUP COMMIT NO SQLITE) ---
+# Com ESCRITA_AGRUPADA=1 as rotas de lançamento não fazem commit próprio: a operação já
+# validada vai para uma fila e uma única thread escritora executa as operações em grupo
+# (até ESCRITA_GRUPO_MAX operações ou ESCRITA_GRUPO_INTERVALO_MS de espera), cada uma
+# num SAVEPOINT, com um só commit por grupo. A requisição espera o Future da sua operação.
+# A fila é por processo: com vários workers, cada um tem o seu escritor.
+
+class FilaEscrita:
+    def __init__(self, app):
+        self.app = app
+        self.fila = queue.Queue()
+        self.grupos = 0
+        self.operacoes = 0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def enviar(self, operacao, *args):
+        futuro = Future()
+        self._iniciar()
+        self.fila.put((operacao, args, futuro))
+        return futuro
+
+    def _iniciar(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._executar, name='escritor-sqlite', daemon=True)
+                self._thread.start()
+
+    def _executar(self):
+        with self.app.app_context():
+            while True:
+                grupo = [self.fila.get()]
+                maximo = self.app.config['ESCRITA_GRUPO_MAX']
+                limite = time.monotonic() + self.app.config['ESCRITA_GRUPO_INTERVALO_MS'] / 1000
+                while len(grupo) < maximo:
+                    restante = limite - time.monotonic()
+                    if restante <= 0:
+                        break
+                    try:
+                        grupo.append(self.fila.get(timeout=restante))
+                    except queue.Empty:
+                        break
+                self._gravar_grupo(grupo)
+
+    def _gravar_grupo(self, grupo):
+        concluidas = []
+        try:
+            conexao = db.session.connection()
+            if conexao.dialect.name == 'sqlite':
+                # Pega o lock de escrita já no início (o pysqlite só abriria a transação no primeiro
+                # INSERT/UPDATE e o SAVEPOINT da primeira operação viraria a transação inteira)
+                conexao.exec_driver_sql('BEGIN IMMEDIATE')
+            for operacao, args, futuro in grupo:
+                if not futuro.set_running_or_notify_cancel():
+                    continue
+                try:
+                    with db.session.begin_nested():
+                        concluidas.append((futuro, operacao(*args)))
+                except Exception as e:
+                    futuro.set_exception(e)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"❌ Falha no commit do grupo de escrita ({len(grupo)} operações):", str(e))
+            for _, _, futuro in grupo:
+                if not futuro.done():
+                    futuro.set_exception(e)
+            return
+        finally:
+            db.session.close()
+        for futuro, resultado in concluidas:
+            futuro.set_result(resultado)
+        self.grupos += 1
+        self.operacoes += len(concluidas)
+
+fila_escrita = FilaEscrita(app)
+
+def executar_escrita(operacao, *args):
+    """Executa uma operação de escrita (que não faz commit): pela fila agrupada, se ativa, ou direto com commit"""
+    if app.config['ESCRITA_AGRUPADA']:
+        return fila_escrita.enviar(operacao, *args).result(timeout=app.config['ESCRITA_TIMEOUT'])
+    try:
+        resultado = operacao(*args)
+        db.session.commit()
+        return resultado
+    except Exception:
+        db.session.rollback()
+        raise
+
+# --- 4.9 MANUTENÇÃO DO SQLITE ---
+# PRAGMA optimize (estatísticas das consultas recentes), ANALYZE completo de tempos em tempos
+# e checkpoint do WAL, para o arquivo -wal não crescer sem limite com leitores sempre abertos.
+
+def manutencao_sqlite(analisar=False, checkpoint='PASSIVE'):
+    """Roda a manutenção do SQLite e devolve os tempos de cada passo em ms"""
+    if db.engine.dialect.name != 'sqlite':
+        return {}
+    tempos = {}
+    with db.engine.connect() as conexao:
+        passos = [('optimize', 'PRAGMA optimize')]
+        if analisar:
+            passos.append(('analyze', 'ANALYZE'))
+        passos.append(('checkpoint', f'PRAGMA wal_checkpoint({checkpoint})'))
+        for nome, sql in passos:
+            inicio = time.perf_counter()
+            cursor = conexao.exec_driver_sql(sql)
+            resultado = cursor.fetchall() if cursor.returns_rows else []
+            tempos[nome] = round((time.perf_counter() - inicio) * 1000, 1)
+            if nome == 'checkpoint' and resultado:
+                ocupado, paginas_wal, paginas_copiadas = resultado[0]
+                tempos['wal_paginas'] = paginas_wal
+                tempos['wal_copiadas'] = paginas_copiadas
+        conexao.commit()
+    print("🧹 Manutenção SQLite: " + ', '.join(f'{k}={v}' for k, v in tempos.items()))
+    return tempos
+
+def iniciar_manutencao_sqlite():
+    """Thread de fundo que roda manutencao_sqlite a cada SQLITE_MANUTENCAO_INTERVALO segundos"""
+    intervalo = app.config['SQLITE_MANUTENCAO_INTERVALO']
+    if intervalo <= 0:
+        return None
+
+    def executar():
+        rodada = 0
+        while True:
+            time.sleep(intervalo)
+            rodada += 1
+            try:
+                with app.app_context():
+                    manutencao_sqlite(analisar=rodada % app.config['SQLITE_ANALYZE_A_CADA'] == 0)
+            except Exception as e:
+                print("❌ Falha na manutenção do SQLite:", str(e))
+
+    thread = threading.Thread(target=executar, name='manutencao-sqlite', daemon=True)
+    thread.start()
+    return thread
+
+# --- 4.10 MIGRAÇÕES DE SCHEMA (VERSIONADAS) ---
+# Cada passo roda uma vez, em ordem, e fica registrado em schema_version. Os passos são
+# idempotentes (conferem antes de alterar) porque bancos antigos podem já ter parte das
+# mudanças, feitas pelos scripts de correção de antes. Mudança nova de schema = passo novo
+# no fim da lista, nunca edição de um passo já publicado.
+
+def _colunas(tabela):
+    # Inspeciona pela conexão da sessão: enxerga o que a própria migração já alterou
+    return {c['name'] for c in db.inspect(db.session.connection()).get_columns(tabela)}
+
+def _adicionar_coluna(tabela, coluna, ddl):
+    if coluna in _colunas(tabela):
+        return False
+    db.session.execute(text(f"ALTER TABLE {tabela} ADD COLUMN {coluna} {ddl}"))
+    return True
+
+def criar_indice(nome, tabela, colunas):
+    """
+    CREATE INDEX idempotente. No PostgreSQL usa CONCURRENTLY (fora de transação, sem travar
+    escritas na tabela) e refaz o índice se um build concorrente anterior ficou inválido.
+    """
+    if db.engine.dialect.name != 'postgresql':
+        db.session.execute(text(f"CREATE INDEX IF NOT EXISTS {nome} ON {tabela} ({colunas})"))
+        return
+    db.session.commit()  # CONCURRENTLY espera as transações abertas, inclusive a nossa
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conexao:
+        invalido = conexao.execute(text(
+            "SELECT NOT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = :nome"
+        ), {'nome': nome}).scalar()
+        if invalido:
+            conexao.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {nome}"))
+        conexao.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {nome} ON {tabela} ({colunas})"))
+
+def _migracao_colunas_erro_responsavel():
+    _adicionar_coluna('erro', 'responsavel_id', 'INTEGER REFERENCES responsavel(id)')
+    _adicionar_coluna('erro', 'categoria_erro_id', 'INTEGER REFERENCES categoria_erro(id)')
+
+# Passo publicado não se edita (bancos que já o rodaram não rodam de novo): mudança de
+# comportamento entra como passo novo no fim de MIGRACOES_SCHEMA
+
+def _migracao_contadores_erro():
+    if garantir_colunas_contadores_erro():
+        recalcular_contadores_erro()
+
+# Nomes do passo 8 como publicado, antes do dicionário. O passo 9 renomeou os índices dos
+# modelos, então hoje ele só cria os que mantiveram o nome; o pacote atual é o passo 11
+INDICES_CONSULTA_PASSO_8 = {
+    'prontuario': {'ix_prontuario_status_data_criacao', 'ix_prontuario_convenio_data_criacao',
+                   'ix_prontuario_setor_data_criacao'},
+    'erro': {'ix_erro_tipo_data_criacao', 'ix_erro_responsavel_id'},
+    'prontuario_responsavel_association': {'ix_prontuario_responsavel_inverso'},
+    'responsavel_categoria_association': {'ix_responsavel_categoria_inverso'},
+}
+
+def _migracao_pacote_indices_passo_8():
+    # Mesmos nomes declarados nos modelos: banco novo já nasce com eles pelo create_all
+    for tabela, nomes in INDICES_CONSULTA_PASSO_8.items():
+        for indice in db.metadata.tables[tabela].indexes:
+            if indice.name in nomes:
+                criar_indice(indice.name, tabela, ', '.join(c.name for c in indice.columns))
+
+# Índices dos caminhos quentes (ver auditar_indices.py), por tabela
+INDICES_CONSULTA = {
+    'prontuario': {'ix_prontuario_status_id_data_criacao', 'ix_prontuario_convenio_id_data_criacao',
+                   'ix_prontuario_setor_id_data_criacao'},
+    'erro': {'ix_erro_tipo_erro_id_data_criacao', 'ix_erro_responsavel_id', 'ix_erro_causa_id'},
+    'causa': {'ix_causa_tipo_erro_descricao'},
+    'prontuario_responsavel_association': {'ix_prontuario_responsavel_inverso'},
+    'responsavel_categoria_association': {'ix_responsavel_categoria_inverso'},
+}
+
+def _migracao_pacote_indices():
+    # Mesmos nomes declarados nos modelos: banco novo já nasce com eles pelo create_all
+    for tabela, nomes in INDICES_CONSULTA.items():
+        existentes = _colunas(tabela)
+        for indice in db.metadata.tables[tabela].indexes:
+            # Colunas de FK do dicionário só existem depois do passo 9
+            if indice.name in nomes and all(c.name in existentes for c in indice.columns):
+                criar_indice(indice.name, tabela, ', '.join(c.name for c in indice.columns))
+
+def _migracao_resumo_diario():
+    # Bancos que já tinham dados antes do ResumoDiario existir
+    if not db.session.query(ResumoDiario.id).first() and db.session.query(Prontuario.id).first():
+        reconstruir_resumo_diario()
+
+# Coluna de texto antiga -> FK para o cadastro:
+# (tabela, coluna de texto, coluna do id, cadastro, coluna de texto do cadastro)
+COLUNAS_DICIONARIO = [
+    ('prontuario', 'convenio', 'convenio_id', 'convenio', 'nome'),
+    ('prontuario', 'setor', 'setor_id', 'setor', 'nome'),
+    ('prontuario', 'status', 'status_id', 'status_prontuario', 'nome'),
+    ('erro', 'tipo', 'tipo_erro_id', 'tipo_erro', 'nome'),
+    ('erro', 'causa', 'causa_id', 'causa', 'descricao'),  # depois do tipo: a causa é cadastrada por tipo
+]
+
+def _migracao_dicionario_catalogos():
+    postgres = db.engine.dialect.name == 'postgresql'
+    # A busca do id da causa pelo (tipo, texto) precisa do índice antes do backfill
+    criar_indice('ix_causa_tipo_erro_descricao', 'causa', 'tipo_erro_id, descricao')
+    if postgres:
+        db.session.execute(text("ALTER TABLE tipo_erro ALTER COLUMN nome TYPE VARCHAR(100)"))
+    StatusProntuario.__table__.create(db.session.connection(), checkfirst=True)
+    for nome in STATUS_OPCOES:
+        db.session.execute(text("INSERT INTO status_prontuario (nome) SELECT :nome WHERE NOT EXISTS "
+                                "(SELECT 1 FROM status_prontuario WHERE nome = :nome)"), {'nome': nome})
+
+    pendentes = [c for c in COLUNAS_DICIONARIO if c[1] in _colunas(c[0])]
+    if not pendentes:
+        return
+    agora = datetime.now()
+    for tabela, coluna, coluna_id, cadastro, texto in pendentes:
+        _adicionar_coluna(tabela, coluna_id, f'INTEGER REFERENCES {cadastro}(id)')
+        # Textos que não estão no cadastro entram como inativos (como o id_catalogo faz em cadastrando_novos)
+        if cadastro == 'status_prontuario':
+            db.session.execute(text(
+                f"INSERT INTO status_prontuario (nome) SELECT DISTINCT t.{coluna} FROM {tabela} t "
+                f"WHERE t.{coluna} IS NOT NULL AND NOT EXISTS "
+                f"(SELECT 1 FROM status_prontuario s WHERE s.nome = t.{coluna})"))
+        elif cadastro == 'causa':
+            db.session.execute(text(
+                "INSERT INTO causa (descricao, tipo_erro_id, status, data_criacao, data_atualizacao) "
+                "SELECT DISTINCT e.causa, t.id, 'inativo', :agora, :agora FROM erro e "
+                "JOIN tipo_erro t ON t.nome = e.tipo WHERE e.causa IS NOT NULL AND NOT EXISTS "
+                "(SELECT 1 FROM causa c WHERE c.tipo_erro_id = t.id AND c.descricao = e.causa)"),
+                {'agora': agora})
+        else:
+            extras = ", descricao, cor" if cadastro == 'tipo_erro' else ""
+            valores = f", t.{coluna}, '#6c757d'" if cadastro == 'tipo_erro' else ""
+            db.session.execute(text(
+                f"INSERT INTO {cadastro} (nome, status, data_criacao, data_atualizacao{extras}) "
+                f"SELECT DISTINCT t.{coluna}, 'inativo', :agora, :agora{valores} FROM {tabela} t "
+                f"WHERE t.{coluna} IS NOT NULL AND NOT EXISTS "
+                f"(SELECT 1 FROM {cadastro} c WHERE c.nome = t.{coluna})"), {'agora': agora})
+
+    # Um UPDATE por tabela (cada UPDATE reescreve todas as linhas e índices)
+    for tabela in dict.fromkeys(c[0] for c in pendentes):
+        atribuicoes = []
+        for _, coluna, coluna_id, cadastro, texto in (c for c in pendentes if c[0] == tabela):
+            if cadastro == 'causa':
+                atribuicoes.append(
+                    f"{coluna_id} = (SELECT MIN(c.id) FROM causa c JOIN tipo_erro t ON t.id = c.tipo_erro_id "
+                    f"WHERE c.descricao = {tabela}.causa AND t.nome = {tabela}.tipo)")
+            else:
+                atribuicoes.append(f"{coluna_id} = (SELECT MIN(c.id) FROM {cadastro} c "
+                                   f"WHERE c.{texto} = {tabela}.{coluna})")
+        atualizadas = db.session.execute(text(f"UPDATE {tabela} SET {', '.join(atribuicoes)}")).rowcount
+        print(f"📖 {tabela}: {atualizadas} linhas codificadas com os ids dos cadastros")
+
+    if not postgres:
+        # O SQLite não remove coluna usada por trigger ou índice: a busca textual é recriada no fim
+        for gatilho in re.findall(r'CREATE TRIGGER IF NOT EXISTS (\w+)', ' '.join(BUSCA_DDL)):
+            db.session.execute(text(f"DROP TRIGGER IF EXISTS {gatilho}"))
+    inspetor = db.inspect(db.session.connection())
+    for tabela in {c[0] for c in pendentes}:
+        antigas = {c[1] for c in pendentes if c[0] == tabela}
+        for indice in inspetor.get_indexes(tabela):
+            if antigas & set(indice['column_names']):
+                db.session.execute(text(f"DROP INDEX IF EXISTS {indice['name']}"))
+    for tabela, coluna, coluna_id, _, _ in pendentes:
+        db.session.execute(text(f"ALTER TABLE {tabela} DROP COLUMN {coluna}"))
+        if postgres and coluna != 'status':
+            db.session.execute(text(f"ALTER TABLE {tabela} ALTER COLUMN {coluna_id} SET NOT NULL"))
+    db.session.commit()
+
+    _migracao_pacote_indices()
+    # O resumo diário passa a ser chaveado pelos ids: recria a tabela e recalcula
+    ResumoDiario.__table__.drop(db.session.connection(), checkfirst=True)
+    ResumoDiario.__table__.create(db.session.connection())
+    reconstruir_resumo_diario()
+    if not postgres and db.inspect(db.session.connection()).has_table('prontuario_busca'):
+        _busca_fts['ativa'] = None
+        configurar_busca_textual()
+    cache_referencia.nova_versao()
+
+def _migracao_versao_cache():
+    VersaoCache.__table__.create(db.session.connection(), checkfirst=True)
+    if db.session.get(VersaoCache, cache_resultados.compartilhado) is None:
+        db.session.add(VersaoCache(nome=cache_resultados.compartilhado, versao=0))
+
+def _recriar_com_autoincrement(tabela):
+    """
+    Recria a tabela do modelo com AUTOINCREMENT (o SQLite não altera a chave no lugar),
+    mantendo ids e índices. Triggers da tabela somem com ela: quem chama recria.
+    """
+    conexao = db.session.connection()
+    ddl_atual = conexao.exec_driver_sql(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (tabela.name,)).scalar()
+    if 'AUTOINCREMENT' in ddl_atual.upper():
+        return False
+    indices = conexao.exec_driver_sql(
+        "SELECT sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL",
+        (tabela.name,)).scalars().all()
+    nova = f'{tabela.name}_nova'
+    ddl = str(CreateTable(tabela).compile(dialect=conexao.dialect))
+    conexao.exec_driver_sql(ddl.replace(f'CREATE TABLE {tabela.name} (', f'CREATE TABLE {nova} (', 1))
+    colunas = ', '.join(c.name for c in tabela.columns)
+    conexao.exec_driver_sql(f"INSERT INTO {nova} ({colunas}) SELECT {colunas} FROM {tabela.name}")
+    conexao.exec_driver_sql(f"DROP TABLE {tabela.name}")
+    conexao.exec_driver_sql(f"ALTER TABLE {nova} RENAME TO {tabela.name}")
+    for ddl_indice in indices:
+        conexao.exec_driver_sql(ddl_indice)
+    return True
+
+def _maiores_ids_arquivo():
+    """Maior id de prontuário e de erro no banco de arquivo ({} sem arquivo)"""
+    motor = motor_arquivo()
+    if motor is None:
+        return {}
+    try:
+        with motor.connect() as conexao:
+            return {t.name: conexao.scalar(db.select(func.max(t.c.id))) or 0
+                    for t in (Prontuario.__table__, Erro.__table__)}
+    except (OperationalError, ProgrammingError):
+        return {}  # arquivo ainda sem as tabelas
+
+def _migracao_ids_sem_reuso():
+    # Sem AUTOINCREMENT o SQLite dá ao próximo registro o maior rowid + 1: apagado o prontuário
+    # (ou erro) de maior id, um id que já está no arquivo voltava a ser usado no banco quente
+    if db.engine.dialect.name != 'sqlite':
+        return  # sequences do PostgreSQL não voltam atrás
+    recriadas = False
+    for gatilho in re.findall(r'CREATE TRIGGER IF NOT EXISTS (\w+)', ' '.join(BUSCA_DDL)):
+        db.session.execute(text(f"DROP TRIGGER IF EXISTS {gatilho}"))
+    for tabela in (Prontuario.__table__, Erro.__table__):
+        recriadas |= _recriar_com_autoincrement(tabela)
+    # A sequência começa depois do maior id já usado, aqui ou no arquivo
+    arquivados = _maiores_ids_arquivo()
+    for tabela in (Prontuario.__table__, Erro.__table__):
+        maior = max(db.session.scalar(db.select(func.max(tabela.c.id))) or 0,
+                    db.session.scalar(text("SELECT seq FROM sqlite_sequence WHERE name = :nome"),
+                                      {'nome': tabela.name}) or 0,
+                    arquivados.get(tabela.name, 0))
+        db.session.execute(text("DELETE FROM sqlite_sequence WHERE name = :nome"), {'nome': tabela.name})
+        db.session.execute(text("INSERT INTO sqlite_sequence (name, seq) VALUES (:nome, :seq)"),
+                           {'nome': tabela.name, 'seq': maior})
+    db.session.commit()
+    if db.inspect(db.session.connection()).has_table('prontuario_busca'):
+        _busca_fts['ativa'] = None
+        configurar_busca_textual()
+    if recriadas:
+        print("🔢 prontuario e erro recriados com AUTOINCREMENT")
+
+def _migracao_versao_cache_referencia():
+    if db.session.get(VersaoCache, cache_referencia.compartilhado) is None:
+        db.session.add(VersaoCache(nome=cache_referencia.compartilhado, versao=0))
+
+MIGRACOES_SCHEMA = [
+    (1, 'Tabelas do app (create_all)', db.create_all),
+    (2, 'erro.responsavel_id e erro.categoria_erro_id', _migracao_colunas_erro_responsavel),
+    (3, 'erro.quantidade', garantir_coluna_quantidade_erro),
+    (4, 'prontuario.erro_count e prontuario.has_erro', _migracao_contadores_erro),
+    (5, 'Índice erro(prontuario_id)', lambda: criar_indice('ix_erro_prontuario_id', 'erro', 'prontuario_id')),
+    (6, 'Índice prontuario(has_erro)', lambda: criar_indice('ix_prontuario_has_erro', 'prontuario', 'has_erro')),
+    (7, 'Carga inicial do resumo diário', _migracao_resumo_diario),
+    (8, 'Índices das consultas da listagem, relatórios e associações', _migracao_pacote_indices_passo_8),
+    (9, 'Convênio, setor, status, tipo e causa como FK para os cadastros (dicionário)',
+     _migracao_dicionario_catalogos),
+    (10, 'Versão do cache de resultados compartilhada entre processos (versao_cache)', _migracao_versao_cache),
+    (11, 'Índices das consultas pelas colunas do dicionário (convênio, setor, status, tipo e causa)',
+     _migracao_pacote_indices),
+    (12, 'prontuario e erro com AUTOINCREMENT no SQLite (id apagado ou arquivado não volta)', _migracao_ids_sem_reuso),
+    (13, 'Versão do cache dos cadastros compartilhada entre processos (versao_cache)',
+     _migracao_versao_cache_referencia),
+]
+VERSAO_SCHEMA_ATUAL = MIGRACOES_SCHEMA[-1][0]
+TRAVA_MIGRACAO_PG = 72500101  # pg_advisory_lock: um processo migra por vez
+
+def versao_schema():
+    """Versão registrada em schema_version (0 em banco que nunca passou pelas migrações)"""
+    if not db.inspect(db.engine).has_table(VersaoSchema.__tablename__):
+        return 0
+    return db.session.scalar(db.select(func.max(VersaoSchema.versao))) or 0
+
+def migrar_schema():
+    """Aplica em ordem as migrações pendentes; devolve as versões aplicadas"""
+    trava = None
+    if db.engine.dialect.name == 'postgresql':
+        trava = db.engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+        trava.execute(text("SELECT pg_advisory_lock(:chave)"), {'chave': TRAVA_MIGRACAO_PG})
+    try:
+        VersaoSchema.__table__.create(db.engine, checkfirst=True)
+        feitas = set(db.session.scalars(db.select(VersaoSchema.versao)))
+        db.session.commit()
+        aplicadas = []
+        for versao, descricao, passo in MIGRACOES_SCHEMA:
+            if versao in feitas:
+                continue
+            inicio = time.perf_counter()
+            try:
+                passo()
+                db.session.add(VersaoSchema(versao=versao, descricao=descricao))
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                print(f"❌ Migração {versao} falhou: {descricao}")
+                raise
+            aplicadas.append(versao)
+            print(f"🔧 Migração {versao} aplicada em {time.perf_counter() - inicio:.2f}s: {descricao}")
+        return aplicadas
+    finally:
+        if trava is not None:
+            trava.execute(text("SELECT pg_advisory_unlock(:chave)"), {'chave': TRAVA_MIGRACAO_PG})
+            trava.close()
+
+# --- 4.11 ARQUIVO (PRONTUÁRIOS ENTREGUES) ---
+# Prontuário entregue ao faturamento não muda mais. Passados ARQUIVO_IDADE_DIAS da entrega,
+# arquivar_prontuarios move o prontuário, seus erros e vínculos com responsáveis para o banco de
+# arquivo: mesmo schema (criado pelos próprios modelos), mesmos ids. Listagem, busca e lançamentos
+# leem só o banco quente; dashboard, relatórios e exportação consultam também o arquivo quando a
+# faixa de datas do filtro alcança os arquivados (arquivo_necessario). O ResumoDiario fica no
+# banco quente e continua contando os arquivados.
+
+CADASTROS_ARQUIVO = ('convenio', 'setor', 'status_prontuario', 'tipo_erro', 'causa', 'responsavel',
+                     'categoria_erro', 'responsavel_categoria_association')
+STATUS_ARQUIVAVEL = 'Entregue ao Faturamento'
+EstadoArquivo = namedtuple('EstadoArquivo', ['total', 'inicio', 'fim'])
+
+# O conteúdo do arquivo só muda quando o arquivamento roda: as entradas levam o EstadoArquivo
+# na chave e não dependem da versão das escritas do banco quente
+cache_arquivo = CacheResultados(max_itens=32, ttl_segundos=app.config['CACHE_REFERENCIA_TTL'])
+_motores_arquivo = {}
+_motores_arquivo_lock = threading.Lock()
+
+def motor_arquivo(criar=False):
+    """Engine do banco de arquivo; None sem ARQUIVO_DATABASE_URL ou, no SQLite, enquanto o arquivo não existe"""
+    url = app.config['ARQUIVO_DATABASE_URL']
+    if not url:
+        return None
+    if url.startswith('sqlite') and not criar and not os.path.exists(make_url(url).database or ''):
+        return None
+    with _motores_arquivo_lock:
+        if url not in _motores_arquivo:
+            opcoes = {'pool_pre_ping': True} if url.startswith('postgresql') else {}
+            _motores_arquivo[url] = create_engine(url, **opcoes)
+        return _motores_arquivo[url]
+
+def consultar_arquivo(consulta):
+    """Roda consulta(sessao) numa sessão própria do banco de arquivo"""
+    with Session(motor_arquivo()) as sessao:
+        return consulta(sessao)
+
+def estado_arquivo():
+    """Total de prontuários arquivados e a faixa de data_criacao deles (None sem arquivo ou arquivo vazio)"""
+    motor = motor_arquivo()
+    if motor is None:
+        return None
+    try:
+        with motor.connect() as conexao:
+            total, inicio, fim = conexao.execute(db.select(func.count(Prontuario.id),
+                                                           func.min(Prontuario.data_criacao),
+                                                           func.max(Prontuario.data_criacao))).one()
+    except (OperationalError, ProgrammingError):
+        return None  # banco de arquivo ainda sem as tabelas
+    return EstadoArquivo(total, inicio, fim) if total else None
+
+def faixa_datas(condicoes):
+    """
+    Faixa [inicio, fim) que as condições impõem a Prontuario.data_criacao (None = sem limite).
+    Só comparações diretas com um valor contam; as demais (extract, status...) não restringem.
+    """
+    coluna = Prontuario.__table__.c.data_criacao
+    inicio = fim = None
+    pendentes = [c for c in condicoes if c is not None]
+    while pendentes:
+        condicao = pendentes.pop()
+        if isinstance(condicao, BooleanClauseList) and condicao.operator is operators.and_:
+            pendentes.extend(condicao.clauses)
+            continue
+        if not isinstance(condicao, BinaryExpression) or not isinstance(condicao.right, BindParameter):
+            continue
+        if getattr(condicao.left, 'table', None) is not coluna.table or condicao.left.name != coluna.name:
+            continue
+        valor = condicao.right.effective_value
+        if isinstance(valor, date) and not isinstance(valor, datetime):
+            valor = _inicio_do_dia(valor)
+        if condicao.operator in (operators.ge, operators.gt):
+            inicio = valor if inicio is None else max(inicio, valor)
+        elif condicao.operator in (operators.lt, operators.le):
+            fim = valor if fim is None else min(fim, valor)
+    return inicio, fim
+
+def arquivo_necessario(condicoes):
+    """EstadoArquivo se a faixa de datas das condições alcança prontuários arquivados; None se o banco quente basta"""
+    estado = estado_arquivo()
+    if estado is None:
+        return None
+    inicio, fim = faixa_datas(condicoes)
+    if inicio is not None and estado.fim is not None and inicio > estado.fim:
+        return None
+    if fim is not None and estado.inicio is not None and fim <= estado.inicio:
+        return None
+    return estado
+
+def anos_com_prontuarios(limite=None):
+    """Anos de data_criacao com prontuários (quente e arquivo), do mais recente para o mais antigo"""
+    ano = db.extract('year', Prontuario.data_criacao)
+
+    def anos(sessao):
+        return {int(a) for (a,) in sessao.query(ano).distinct() if a is not None}
+
+    encontrados = anos(db.session)
+    estado = estado_arquivo()
+    if estado:
+        encontrados |= cache_arquivo.obter(('anos', estado), lambda: consultar_arquivo(anos))
+    encontrados = sorted(encontrados, reverse=True)
+    return encontrados[:limite] if limite else encontrados
+
+def prontuarios_com_arquivo(query, lote=500):
+    """
+    Prontuários de `query` (ordenada por data_criacao desc) lidos em lotes no banco quente e, se a
+    faixa de datas alcança o arquivo, também lá, intercalados na mesma ordem. Cada objeto sai da
+    sua sessão assim que o próximo é pedido, para a memória não crescer com o resultado.
+    """
+    def ler(q):
+        for p in q.yield_per(lote):
+            yield p
+            q.session.expunge(p)
+
+    if arquivo_necessario([query.whereclause]) is None:
+        yield from ler(query)
+        return
+    with Session(motor_arquivo()) as sessao:
+        yield from heapq.merge(ler(query), ler(query.with_session(sessao)),
+                               key=lambda p: (p.data_criacao or datetime.min, p.id), reverse=True)
+
+def prontuario_arquivado(prontuario_id, *opcoes):
+    """Prontuário do arquivo já convertido por prontuario_to_dict (None se não estiver arquivado)"""
+    if estado_arquivo() is None:
+        return None
+
+    def buscar(sessao):
+        p = sessao.query(Prontuario).options(*opcoes).get(prontuario_id)
+        return prontuario_to_dict(p) if p else None
+    return consultar_arquivo(buscar)
+
+def _insert_do_dialeto(conexao):
+    if conexao.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert
+
+def preparar_arquivo(motor):
+    """Cria no arquivo as tabelas que faltam e registra a versão do schema (recusa arquivo de versão antiga)"""
+    db.metadata.create_all(motor)
+    with motor.begin() as conexao:
+        versoes = set(conexao.scalars(db.select(VersaoSchema.versao)))
+        if versoes and max(versoes) < VERSAO_SCHEMA_ATUAL:
+            raise RuntimeError(f"Banco de arquivo na versão de schema {max(versoes)}, esperado {VERSAO_SCHEMA_ATUAL}")
+        novas = [{'versao': versao, 'descricao': descricao}
+                 for versao, descricao, _ in MIGRACOES_SCHEMA if versao not in versoes]
+        if novas:
+            conexao.execute(db.insert(VersaoSchema), novas)
+
+def _sincronizar_cadastros_arquivo(conexao):
+    """Upsert dos cadastros do banco quente no arquivo (os arquivados apontam para eles)"""
+    insert = _insert_do_dialeto(conexao)
+    for tabela in db.metadata.sorted_tables:
+        if tabela.name not in CADASTROS_ARQUIVO:
+            continue
+        linhas = [dict(linha) for linha in db.session.execute(db.select(tabela)).mappings()]
+        if not linhas:
+            continue
+        chave = [c.name for c in tabela.primary_key.columns]
+        # Cadastro excluído no banco quente e recriado com o mesmo nome: a cópia velha do
+        # arquivo (ainda usada por arquivados) ganha o id no nome para não violar o UNIQUE
+        for coluna in (c for c in tabela.columns if c.unique):
+            conexao.execute(tabela.update()
+                            .where(tabela.c.id.not_in([linha['id'] for linha in linhas]),
+                                   coluna.in_([linha[coluna.name] for linha in linhas]))
+                            .values({coluna.name: coluna + ' #' + db.cast(tabela.c.id, db.String)}))
+        stmt = insert(tabela)
+        demais = {c.name: stmt.excluded[c.name] for c in tabela.columns if c.name not in chave}
+        stmt = stmt.on_conflict_do_update(index_elements=chave, set_=demais) if demais else stmt.on_conflict_do_nothing()
+        conexao.execute(stmt, linhas)
+
+def _gravar_no_arquivo(conexao, prontuarios, erros, vinculos):
+    """
+    Grava um lote no arquivo. Refazer o mesmo lote (rodada interrompida entre o commit do
+    arquivo e o do banco quente) substitui a cópia anterior em vez de duplicar; id que já está
+    no arquivo com outro prontuário (id reaproveitado) é recusado sem tocar no arquivado.
+    """
+    tabela_p, tabela_e = Prontuario.__table__, Erro.__table__
+    vinculos_t = prontuario_responsavel_association
+    por_id = {p['id']: p for p in prontuarios}
+    ids = list(por_id)
+    for id_, atendimento, data_criacao in conexao.execute(
+            db.select(tabela_p.c.id, tabela_p.c.atendimento, tabela_p.c.data_criacao).where(tabela_p.c.id.in_(ids))):
+        p = por_id[id_]
+        if (atendimento, data_criacao) != (p['atendimento'], p['data_criacao']):
+            raise RuntimeError(f"Prontuário {id_} já está no arquivo com outro atendimento ({atendimento}); "
+                               f"id reaproveitado no banco quente, nada foi arquivado neste lote")
+    conexao.execute(tabela_e.delete().where(tabela_e.c.prontuario_id.in_(ids)))
+    conexao.execute(vinculos_t.delete().where(vinculos_t.c.prontuario_id.in_(ids)))
+    conexao.execute(tabela_p.delete().where(tabela_p.c.id.in_(ids)))
+    if erros:
+        ocupados = conexao.scalars(db.select(tabela_e.c.id).where(tabela_e.c.id.in_([e['id'] for e in erros]))).all()
+        if ocupados:
+            raise RuntimeError(f"Erros {sorted(ocupados)[:10]} já estão no arquivo em outro prontuário; "
+                               f"id reaproveitado no banco quente, nada foi arquivado neste lote")
+    conexao.execute(db.insert(tabela_p), prontuarios)
+    if erros:
+        conexao.execute(db.insert(tabela_e), erros)
+    if vinculos:
+        conexao.execute(db.insert(vinculos_t), vinculos)
+
+def data_entrega_prontuario(tabela):
+    """
+    Data em que o prontuário foi entregue: envio ao faturamento, senão fim da auditoria, senão a
+    última alteração (mudar o status grava data_atualizacao; recontagens e migrações não mexem nela)
+    """
+    return func.coalesce(tabela.c.enviado_faturamento, tabela.c.fim_auditoria,
+                         tabela.c.data_atualizacao, tabela.c.data_criacao)
+
+def arquivar_prontuarios(idade_dias=None, lote=None, simular=False):
+    """
+    Move para o arquivo os prontuários 'Entregue ao Faturamento' entregues há mais de
+    `idade_dias` dias (data_entrega_prontuario), em lotes. Cada lote é gravado e commitado no
+    arquivo antes de sair do banco quente; apagar os erros dispara os triggers da busca textual.
+    Devolve quantos saíram (com simular=True, só conta).
+    """
+    idade_dias = app.config['ARQUIVO_IDADE_DIAS'] if idade_dias is None else idade_dias
+    lote = lote or app.config['ARQUIVO_LOTE']
+    corte = datetime.now() - timedelta(days=idade_dias)
+    tabela_p, tabela_e = Prontuario.__table__, Erro.__table__
+    vinculos_t = prontuario_responsavel_association
+
+    status_id = db.session.scalar(db.select(StatusProntuario.id).where(StatusProntuario.nome == STATUS_ARQUIVAVEL))
+    arquivavel = db.and_(tabela_p.c.status_id == status_id, data_entrega_prontuario(tabela_p) < corte)
+
+    if simular:
+        return db.session.scalar(db.select(func.count()).select_from(tabela_p).where(arquivavel)) or 0
+
+    motor = motor_arquivo(criar=True)
+    if motor is None:
+        raise RuntimeError("Banco de arquivo não configurado: defina ARQUIVO_DATABASE_URL")
+    preparar_arquivo(motor)
+    with motor.begin() as conexao:
+        _sincronizar_cadastros_arquivo(conexao)
+    db.session.commit()
+
+    movidos, ultimo_id = 0, 0
+    while True:
+        ids = db.session.scalars(db.select(tabela_p.c.id)
+                                 .where(arquivavel, tabela_p.c.id > ultimo_id)
+                                 .order_by(tabela_p.c.id)
+                                 .limit(lote)).all()
+        db.session.commit()
+        if not ids:
+            break
+        ultimo_id = ids[-1]
+
+        # A condição é conferida de novo dentro da transação que apaga: prontuário que saiu do
+        # status de entregue desde a seleção fica no banco quente. No SQLite o primeiro DELETE já segura a trava
+        # de escrita; no PostgreSQL o FOR UPDATE trava as linhas do lote.
+        alvo = db.select(tabela_p.c.id).where(tabela_p.c.id.in_(ids), arquivavel)
+        try:
+            if db.engine.dialect.name == 'postgresql':
+                db.session.execute(alvo.with_for_update())
+            erros = [dict(e) for e in db.session.execute(
+                tabela_e.delete().where(tabela_e.c.prontuario_id.in_(alvo)).returning(*tabela_e.c)).mappings()]
+            vinculos = [dict(v) for v in db.session.execute(
+                vinculos_t.delete().where(vinculos_t.c.prontuario_id.in_(alvo)).returning(*vinculos_t.c)).mappings()]
+            prontuarios = [dict(p) for p in db.session.execute(
+                tabela_p.delete().where(tabela_p.c.id.in_(alvo)).returning(*tabela_p.c)).mappings()]
+            if not prontuarios:
+                db.session.rollback()
+                continue
+            with motor.begin() as conexao:
+                _gravar_no_arquivo(conexao, prontuarios, erros, vinculos)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        movidos += len(prontuarios)
+        print(f"   📦 {movidos} prontuários arquivados (até o id {ultimo_id})")
+
+    cache_resultados.nova_versao()
+    return movidos
+
+# --- ROTAS DE LOGIN/LOGOUT/REGISTRO ---
+
+@app.route('/login', methods=['GET', 'POST'])
+def login():
+    if request.method == 'POST':
+        username = request.form.get('username')
+        password = request.form.get('password')
+        
+        user = User.query.filter_by(username=username).first()
+        
+        # Verifica se usuário existe e a senha bate
+        if user and user.check_password(password):
+            login_user(user)
+            return redirect(url_for('index'))
+        
+        return render_template('login.html', error="Usuário ou senha incorretos")
+
+    return render_template('login.html')
+
+@app.route('/logout')
+@login_required
+def logout():
+    logout_user()
+    return redirect(url_for('login'))
+
+@app.route('/registrar_admin', methods=['GET', 'POST'])
+def registrar_admin():
+    if request.method == 'POST':
+        username = request.form.get('username')
+        password = request.form.get('password')
+        
+        if User.query.filter_by(username=username).first():
+            return "Usuário já existe!"
+            
+        novo_usuario = User(username=username)
+        novo_usuario.set_password(password)
+        db.session.add(novo_usuario)
+        db.session.commit()
+        
+        return redirect(url_for('login'))
+        
+    return render_template('register.html')
+
+
+@app.route('/debug/verificar_erros')
+@login_required
+def debug_verificar_erros():
+    """Rota para verificar rapidamente se os erros estão sendo salvos e carregados"""
+    try:
+        # Buscar o último prontuário salvo
+        ultimo_prontuario = Prontuario.query.options(
+            db.joinedload(Prontuario.erros)
+        ).order_by(Prontuario.id.desc()).first()
+        
+        if not ultimo_prontuario:
+            return jsonify({'erro': 'Nenhum prontuário encontrado'})
+        
+        resultado = {
+            'ultimo_prontuario': {
+                'id': ultimo_prontuario.id,
+                'beneficiario': ultimo_prontuario.beneficiario,
+                'atendimento': ultimo_prontuario.atendimento,
+                'total_erros': ultimo_prontuario.erro_count,
+                'erros': []
+            }
+        }
+        
+        for erro in ultimo_prontuario.erros:
+            resultado['ultimo_prontuario']['erros'].append({
+                'tipo': erro.tipo,
+                'causa': erro.causa,
+                'quantidade': erro.quantidade,
+                'responsavel_id': erro.responsavel_id
+            })
+        
+        # Verificar total de erros no sistema
+        total_erros_sistema = db.session.query(func.coalesce(func.sum(Erro.quantidade), 0)).scalar()
+        resultado['total_erros_sistema'] = total_erros_sistema
+        
+        return jsonify(resultado)
+        
+    except Exception as e:
+        return jsonify({'erro': str(e)}), 500
+
+@app.route('/debug/cache')
+@login_required
+def debug_cache():
+    """Estatísticas do cache de resultados (hits, misses, versão dos dados) e do cache de catálogos"""
+    return jsonify({**cache_resultados.estatisticas(), 'catalogos': cache_referencia.estatisticas()})
 
 @app.template_filter('format_date')
 def format_date(value):
@@ -885,7 +3277,117 @@ def format_date(value):
         return str(value)
 # --- 5. ROTAS PRINCIPAIS ---
 
+def _montar_dashboard(ano_filter, mes_filter, periodo_filter, data_inicio_filter, data_fim_filter):
+    """Calcula todos os números do dashboard para um conjunto de filtros (resultado cacheável)"""
+    # Filtros aplicados direto nas agregações SQL (nenhum Prontuario é materializado)
+    filtros = _filtros_dashboard(ano_filter, mes_filter, periodo_filter, data_inicio_filter, data_fim_filter)
+    # Sem filtro a produtividade sai do ResumoDiario, que já conta os arquivados
+    hoje = datetime.now()
+    mes_atual = (hoje.year, hoje.month) if filtros else None
+
+    contagens = contagens_dashboard(filtros, produtividade=mes_atual)
+    estado = arquivo_necessario(filtros)
+    if estado:
+        # O arquivo não muda entre rodadas do arquivamento: a parte dele fica em cache pelo estado
+        chave = ('dashboard', estado, chave_filtros('index', ano_filter, mes_filter, periodo_filter,
+                                                    data_inicio_filter, data_fim_filter))
+        somar_contagens_dashboard(contagens, cache_arquivo.obter(chave, lambda: consultar_arquivo(
+            lambda sessao: contagens_dashboard(filtros, sessao, mes_atual))))
+
+    status_count = _agg_contagem_status(contagens)
+    total = sum(status_count.values())
+    
+    print(f"📊 DADOS AGREGADOS: {total} prontuários")
+    
+    if total == 0:
+        print("⚠️  Nenhum dado encontrado")
+        # Dados de fallback
+        stats = {
+            "aguardando_auditoria": 0, "em_auditoria": 0, "aguardando_correcao": 0,
+            "entregue": 0, "taxa_erros": 0, "meta_taxa_erros": 10.0,
+            "total_registrados_mes": 0, "tempo_medio_auditoria": 0,
+            "taxa_conclusao": 0, "percentual_com_erros": 0,
+            "media_erros_por_prontuario": 0.0,
+            "total_prontuarios_com_erro": 0,
+            "total_erros_registrados": 0,
+            "total_tipos_erro": 0
+        }
+        
+        # Listas vazias para gráficos
+        stats_responsavel = []
+        stats_convenio = []
+        stats_top_motivos = []
+        stats_top_causas = []
+        stats_top_setores = []
+        stats_motivos_detalhados = []
+        stats_gerais_erros = {
+            'total_prontuarios_com_erro': 0,
+            'total_erros_registrados': 0, 
+            'total_tipos_erro': 0,
+            'media_erros_por_prontuario': 0.0
+        }
+        produtividade_mes = {"labels": [], "valores": [], "total_registrado": 0}
+        stats_erros_mensais = {"labels": [], "valores": []}
+        
+    else:
+        tipos_erro_mapa = get_tipos_erro_dict()
+        com_erro = contagens['com_erro']
+
+        # Estatísticas detalhadas primeiro: os cards usam os mesmos números
+        stats_motivos_detalhados, stats_gerais_erros = _agg_erros_por_motivo_detalhado(contagens, tipos_erro_mapa)
+        taxa_erros = round(100 * com_erro / total, 1) if total else 0
+
+        stats_top_setores = _agg_taxa_erros_setor(contagens)
+        stats_top_motivos, stats_top_causas = _agg_top_erros(contagens, tipos_erro_mapa, stats_motivos_detalhados)
+        stats_responsavel = _agg_taxa_erros_responsavel(contagens)
+        stats_convenio = _agg_taxa_erros_convenio(contagens)
+        if filtros:
+            produtividade_mes = _agg_produtividade_diaria_mes(contagens, *mes_atual)
+        else:
+            produtividade_mes = _resumo_produtividade_diaria_mes(hoje.year, hoje.month)
+        stats_erros_mensais = _calc_erros_timeline_mensal()
+        
+        entregues = status_count.get('Entregue ao Faturamento', 0)
+        stats = {
+            "aguardando_auditoria": status_count.get('Aguardando Auditoria', 0),
+            "em_auditoria": status_count.get('Em Auditoria', 0),
+            "aguardando_correcao": status_count.get('Aguardando Correção', 0) + status_count.get('Aguardando Revisão', 0),
+            "entregue": entregues,
+            "taxa_erros": taxa_erros,
+            "meta_taxa_erros": 10.0,
+            "total_registrados_mes": total,
+            "tempo_medio_auditoria": 0,
+            "taxa_conclusao": round(100 * entregues / total, 1) if total else 0,
+            "percentual_com_erros": taxa_erros,
+            "media_erros_por_prontuario": stats_gerais_erros.get('media_erros_por_prontuario', 0.0),
+            "total_prontuarios_com_erro": stats_gerais_erros.get('total_prontuarios_com_erro', 0),
+            "total_erros_registrados": stats_gerais_erros.get('total_erros_registrados', 0),
+            "total_tipos_erro": stats_gerais_erros.get('total_tipos_erro', 0)
+        }
+
+        print(f"📈 ESTATÍSTICAS: Total={total}, Com erro={com_erro}, Taxa={taxa_erros}%")
+        print(f"📊 GRÁFICOS: Motivos={len(stats_motivos_detalhados)}, Setores={len(stats_top_setores)}")
+    
+    # Anos disponíveis para filtro
+    anos_disponiveis = anos_com_prontuarios()
+
+    return {
+        'total': total,
+        'stats': stats,
+        'stats_responsavel': stats_responsavel,
+        'stats_convenio': stats_convenio,
+        'stats_top_motivos': stats_top_motivos,
+        'stats_top_causas': stats_top_causas,
+        'stats_top_setores': stats_top_setores,
+        'stats_motivos_detalhados': stats_motivos_detalhados,
+        'stats_gerais_erros': stats_gerais_erros,
+        'dados_grafico_produtividade': produtividade_mes,
+        'dados_erros_mensais': stats_erros_mensais,
+        'anos_disponiveis': anos_disponiveis
+    }
+
 @app.route('/')
+@limite_tempo_consulta('relatorio')
 def index():
     try:
         print("🚀 INICIANDO DASHBOARD COMPLETO...")
@@ -899,177 +3401,46 @@ def index():
         
         print(f"📋 FILTROS: periodo={periodo_filter}")
 
-        # Query com todos os relacionamentos
-        query = Prontuario.query.options(
-            db.joinedload(Prontuario.responsaveis),
-            db.joinedload(Prontuario.erros)
-        )
-
-        # Aplicar filtro de período
-        if periodo_filter == 'mes':
-            inicio_mes = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-            query = query.filter(Prontuario.data_criacao >= inicio_mes)
-        elif periodo_filter == 'semana':
-            inicio_semana = datetime.now() - timedelta(days=7)
-            query = query.filter(Prontuario.data_criacao >= inicio_semana)
-        elif periodo_filter == 'hoje':
-            inicio_hoje = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-            query = query.filter(Prontuario.data_criacao >= inicio_hoje)
-        # 'todos' não aplica filtro
-
-        # Aplicar outros filtros se existirem
-        if data_inicio_filter:
-            data_ini = _parse_any_date(data_inicio_filter)
-            if data_ini:
-                query = query.filter(Prontuario.data_criacao >= data_ini)
-        if data_fim_filter:
-            data_fim_dt = _parse_any_date(data_fim_filter)
-            if data_fim_dt:
-                data_fim_dt = data_fim_dt.replace(hour=23, minute=59, second=59)
-                query = query.filter(Prontuario.data_criacao <= data_fim_dt)
-        if ano_filter:
-            query = query.filter(db.extract('year', Prontuario.data_criacao) == int(ano_filter))
-        if mes_filter:
-            query = query.filter(db.extract('month', Prontuario.data_criacao) == int(mes_filter))
-
-        # Ordenar e executar
-        prontuarios_obj = query.order_by(Prontuario.data_criacao.desc()).all()
-        prontuarios_lista = [prontuario_to_dict(p) for p in prontuarios_obj]
-        
-        print(f"📊 DADOS CARREGADOS: {len(prontuarios_lista)} prontuários")
-
-        total = len(prontuarios_lista)
-        
-        if total == 0:
-            print("⚠️  Nenhum dado encontrado")
-            # Dados de fallback
-            stats = {
-                "aguardando_auditoria": 0, "em_auditoria": 0, "aguardando_correcao": 0,
-                "entregue": 0, "taxa_erros": 0, "meta_taxa_erros": 10.0,
-                "total_registrados_mes": 0, "tempo_medio_auditoria": 0,
-                "taxa_conclusao": 0, "percentual_com_erros": 0,
-                "media_erros_por_prontuario": 0.0,
-                "total_prontuarios_com_erro": 0,
-                "total_erros_registrados": 0,
-                "total_tipos_erro": 0
-            }
-            
-            # Listas vazias para gráficos
-            stats_responsavel = []
-            stats_convenio = []
-            stats_top_motivos = []
-            stats_top_causas = []
-            stats_top_setores = []
-            stats_motivos_detalhados = []
-            stats_gerais_erros = {
-                'total_prontuarios_com_erro': 0,
-                'total_erros_registrados': 0, 
-                'total_tipos_erro': 0,
-                'media_erros_por_prontuario': 0.0
-            }
-            produtividade_mes = {"labels": [], "valores": [], "total_registrado": 0}
-            stats_erros_mensais = {"labels": [], "valores": []}
-            
-        else:
-            # 🔥🔥🔥 CORREÇÃO CRÍTICA: CALCULAR PRIMEIRO AS ESTATÍSTICAS DETALHADAS
-            stats_motivos_detalhados, stats_gerais_erros = _calc_erros_por_motivo_detalhado(prontuarios_lista)
-            
-            # Contar status
-            status_count = {
-                'Aguardando Auditoria': 0, 
-                'Em Auditoria': 0, 
-                'Aguardando Correção': 0, 
-                'Aguardando Revisão': 0, 
-                'Entregue ao Faturamento': 0
-            }
-            
-            for p in prontuarios_lista:
-                status = p.get('status', '')
-                if status in status_count:
-                    status_count[status] += 1
-            
-            # 🔥🔥🔥 CORREÇÃO: USAR DADOS CONSISTENTES DAS ESTATÍSTICAS JÁ CALCULADAS
-            com_erro = stats_gerais_erros.get('total_prontuarios_com_erro', 0)
-            taxa_erros = round(100 * com_erro / total, 1) if total else 0
-
-            # Calcular outras estatísticas
-            stats_top_setores = _calc_taxa_erros_setor(prontuarios_lista)
-            stats_top_motivos, stats_top_causas = _calc_top_erros(prontuarios_lista)
-            stats_responsavel = _calc_taxa_erros_responsavel(prontuarios_lista)
-            stats_convenio = _calc_taxa_erros_convenio(prontuarios_lista)
-            produtividade_mes = _calc_produtividade_diaria_mes(prontuarios_lista, datetime.now().year, datetime.now().month)
-            stats_erros_mensais = _calc_erros_timeline_mensal()
-            
-            # 🔥🔥🔥 ESTATÍSTICAS COMPLETAS COM DADOS SINCRONIZADOS
-            stats = {
-                "aguardando_auditoria": status_count['Aguardando Auditoria'],
-                "em_auditoria": status_count['Em Auditoria'],
-                "aguardando_correcao": status_count['Aguardando Correção'] + status_count['Aguardando Revisão'],
-                "entregue": status_count['Entregue ao Faturamento'],
-                "taxa_erros": taxa_erros,
-                "meta_taxa_erros": 10.0,
-                "total_registrados_mes": total,
-                "tempo_medio_auditoria": 0,
-                "taxa_conclusao": round(100 * status_count['Entregue ao Faturamento'] / total, 1) if total else 0,
-                "percentual_com_erros": taxa_erros,
-                # 🔥 DADOS SINCRONIZADOS - USANDO OS MESMOS VALORES DE stats_gerais_erros
-                "media_erros_por_prontuario": stats_gerais_erros.get('media_erros_por_prontuario', 0.0),
-                "total_prontuarios_com_erro": stats_gerais_erros.get('total_prontuarios_com_erro', 0),
-                "total_erros_registrados": stats_gerais_erros.get('total_erros_registrados', 0),
-                "total_tipos_erro": stats_gerais_erros.get('total_tipos_erro', 0)
-            }
-
-            print(f"📈 ESTATÍSTICAS: Total={total}, Com erro={com_erro}, Taxa={taxa_erros}%")
-            print(f"📊 GRÁFICOS: Motivos={len(stats_motivos_detalhados)}, Setores={len(stats_top_setores)}")
-            print(f"🔍 VERIFICAÇÃO DE SINCRONIA:")
-            print(f"   - stats.total_prontuarios_com_erro: {stats['total_prontuarios_com_erro']}")
-            print(f"   - stats_gerais_erros.total_prontuarios_com_erro: {stats_gerais_erros.get('total_prontuarios_com_erro', 0)}")
-            print(f"   - stats.total_erros_registrados: {stats['total_erros_registrados']}")
-            print(f"   - stats_gerais_erros.total_erros_registrados: {stats_gerais_erros.get('total_erros_registrados', 0)}")
+        chave = chave_filtros('index', ano_filter, mes_filter, periodo_filter, data_inicio_filter, data_fim_filter)
+        dashboard = cache_resultados.obter(chave, lambda: _montar_dashboard(
+            ano_filter, mes_filter, periodo_filter, data_inicio_filter, data_fim_filter))
 
         # Carregar dados de configuração
         try:
-            convenios_lista = [c.nome for c in Convenio.query.filter_by(status='ativo').order_by(Convenio.nome).all()]
-            setores_lista = [s.nome for s in Setor.query.filter_by(status='ativo').order_by(Setor.nome).all()]
-            responsaveis_lista = [r.nome for r in Responsavel.query.filter_by(status='ativo').order_by(Responsavel.nome).all()]
+            convenios_lista = nomes_ativos(Convenio)
+            setores_lista = nomes_ativos(Setor)
+            responsaveis_lista = nomes_ativos(Responsavel)
             tipos_erro_dict = get_tipos_erro_dict()
-            categorias_erro_lista = [ce.to_dict() for ce in CategoriaErro.query.filter_by(status='ativo').order_by(CategoriaErro.nome).all()]
-            
-            # Anos disponíveis para filtro
-            anos_query = db.session.query(db.extract('year', Prontuario.data_criacao)).distinct().order_by(db.extract('year', Prontuario.data_criacao).desc()).all()
-            anos_disponiveis = [int(ano[0]) for ano in anos_query if ano[0] is not None]
+            categorias_erro_lista = categorias_erro_ativas()
             
         except Exception as e:
             print(f"⚠️  Erro em configurações: {e}")
             convenios_lista, setores_lista, responsaveis_lista = [], [], []
             tipos_erro_dict = {}
             categorias_erro_lista = []
-            anos_disponiveis = []
-            stats_erros_mensais = {"labels": [], "valores": []}
 
         periodo_info = gerar_texto_periodo(ano_filter, mes_filter, periodo_filter, data_inicio_filter, data_fim_filter)
         
-        print(f"✅ RENDERIZANDO TEMPLATE com {total} prontuários e {len(stats_motivos_detalhados)} tipos de erro")
+        print(f"✅ RENDERIZANDO TEMPLATE com {dashboard['total']} prontuários e {len(dashboard['stats_motivos_detalhados'])} tipos de erro")
 
         return render_template('index.html', 
             periodo_info=periodo_info,
-            stats=stats,
-            stats_responsavel=stats_responsavel,
-            stats_convenio=stats_convenio,
-            stats_top_motivos=stats_top_motivos,
-            stats_top_causas=stats_top_causas,
-            stats_top_setores=stats_top_setores,
-            stats_motivos_detalhados=stats_motivos_detalhados,
-            stats_gerais_erros=stats_gerais_erros,
-            dados_grafico_produtividade=produtividade_mes,
-            dados_erros_mensais=stats_erros_mensais,
+            stats=dashboard['stats'],
+            stats_responsavel=dashboard['stats_responsavel'],
+            stats_convenio=dashboard['stats_convenio'],
+            stats_top_motivos=dashboard['stats_top_motivos'],
+            stats_top_causas=dashboard['stats_top_causas'],
+            stats_top_setores=dashboard['stats_top_setores'],
+            stats_motivos_detalhados=dashboard['stats_motivos_detalhados'],
+            stats_gerais_erros=dashboard['stats_gerais_erros'],
+            dados_grafico_produtividade=dashboard['dados_grafico_produtividade'],
+            dados_erros_mensais=dashboard['dados_erros_mensais'],
             convenios=convenios_lista,
             setores=setores_lista,
             responsaveis=responsaveis_lista,
             tipos_erro=tipos_erro_dict,
             categorias_erro=categorias_erro_lista,
-            dados_raw=prontuarios_lista,
-            anos_disponiveis=anos_disponiveis,
+            anos_disponiveis=dashboard['anos_disponiveis'],
             ano_filter=ano_filter,
             mes_filter=mes_filter,
             periodo_filter=periodo_filter,
@@ -1083,51 +3454,120 @@ def index():
         traceback.print_exc()
         return f"Erro no servidor: {str(e)}", 500
     
+def _filtros_listagem(args):
+    """Condições da listagem de prontuários a partir dos parâmetros da URL"""
+    filtros = []
+    if args.get('status'):
+        filtros.append(Prontuario.status == args['status'])
+    if args.get('convenio'):
+        filtros.append(Prontuario.convenio == args['convenio'])
+    if args.get('setor'):
+        filtros.append(Prontuario.setor == args['setor'])
+    if args.get('responsavel'):
+        filtros.append(Prontuario.responsaveis.any(Responsavel.nome == args['responsavel']))
+    if args.get('erros') in ('com', 'sem'):
+        filtros.append(Prontuario.has_erro.is_(args['erros'] == 'com'))
+    if args.get('data_inicio'):
+        data_ini = _parse_any_date(args['data_inicio'])
+        if data_ini:
+            filtros.append(Prontuario.data_criacao >= _inicio_do_dia(data_ini))
+    if args.get('data_fim'):
+        data_fim_dt = _parse_any_date(args['data_fim'])
+        if data_fim_dt:
+            filtros.append(Prontuario.data_criacao < _inicio_do_dia(data_fim_dt) + timedelta(days=1))
+    return filtros
+
+def _codificar_cursor(p):
+    return f"{p.data_criacao.isoformat()}_{p.id}"
+
+def _decodificar_cursor(cursor):
+    try:
+        data_txt, id_txt = cursor.rsplit('_', 1)
+        return datetime.fromisoformat(data_txt), int(id_txt)
+    except (AttributeError, ValueError):
+        return None
+
+def paginar_prontuarios(filtros, por_pagina, cursor=None, direcao='proxima'):
+    """
+    Paginação por cursor (keyset) em (data_criacao, id), do mais recente para o mais antigo.
+    Cada página é um range scan no índice a partir do cursor, então o custo não depende de
+    quantas páginas já ficaram para trás. Retorna (prontuarios, cursor_anterior, cursor_proxima).
+    """
+    chave = db.tuple_(Prontuario.data_criacao, Prontuario.id)
+    query = Prontuario.query.options(
+        db.selectinload(Prontuario.responsaveis),
+        db.selectinload(Prontuario.erros).joinedload(Erro.responsavel),
+        db.selectinload(Prontuario.erros).joinedload(Erro.categoria_erro)
+    ).filter(*filtros)
+
+    posicao = _decodificar_cursor(cursor) if cursor else None
+    voltando = posicao is not None and direcao == 'anterior'
+    if voltando:
+        query = query.filter(chave > posicao).order_by(Prontuario.data_criacao.asc(), Prontuario.id.asc())
+    else:
+        if posicao:
+            query = query.filter(chave < posicao)
+        query = query.order_by(Prontuario.data_criacao.desc(), Prontuario.id.desc())
+
+    pagina = query.limit(por_pagina + 1).all()
+    tem_mais = len(pagina) > por_pagina
+    pagina = pagina[:por_pagina]
+    if voltando:
+        pagina.reverse()
+
+    if not pagina:
+        return [], None, None
+    tem_anterior = tem_mais if voltando else posicao is not None
+    tem_proxima = True if voltando else tem_mais
+    cursor_anterior = _codificar_cursor(pagina[0]) if tem_anterior else None
+    cursor_proxima = _codificar_cursor(pagina[-1]) if tem_proxima else None
+    return pagina, cursor_anterior, cursor_proxima
+
 @app.route('/prontuarios')
 @login_required
 def prontuarios():
     status_filter = request.args.get('status', '')
     convenio_filter = request.args.get('convenio', '')
     setor_filter = request.args.get('setor', '')
+    responsavel_filter = request.args.get('responsavel', '')
+    erros_filter = request.args.get('erros', '')
+    data_inicio_filter = request.args.get('data_inicio', '')
+    data_fim_filter = request.args.get('data_fim', '')
+    cursor = request.args.get('cursor', '')
+    direcao = request.args.get('direcao', 'proxima')
     
-    # 🔥 CORREÇÃO CRÍTICA: Carregar TODOS os relacionamentos necessários
-    query = Prontuario.query.options(
-        db.joinedload(Prontuario.responsaveis),
-        db.joinedload(Prontuario.erros).joinedload(Erro.responsavel),
-        db.joinedload(Prontuario.erros).joinedload(Erro.categoria_erro)
-    )
-    
-    if status_filter:
-        query = query.filter(Prontuario.status == status_filter)
-    if convenio_filter:
-        query = query.filter(Prontuario.convenio == convenio_filter)
-    if setor_filter:
-        query = query.filter(Prontuario.setor == setor_filter)
+    por_pagina = request.args.get('por_pagina', app.config['PRONTUARIOS_POR_PAGINA'], type=int)
+    por_pagina = max(1, min(por_pagina, app.config['PRONTUARIOS_POR_PAGINA_MAX']))
     
-    prontuarios_obj = query.order_by(Prontuario.data_criacao.desc()).all()
+    filtros = _filtros_listagem(request.args)
+    prontuarios_obj, cursor_anterior, cursor_proxima = paginar_prontuarios(filtros, por_pagina, cursor, direcao)
     prontuarios_filtrados = [prontuario_to_dict(p) for p in prontuarios_obj]
     
-    # 🔥 DEBUG: Verificar se os erros estão sendo carregados
-    total_erros = sum(len(p['erros']) for p in prontuarios_filtrados)
-    prontuarios_com_erro = sum(1 for p in prontuarios_filtrados if p['tem_erros'])
-    
-    print(f"📊 PRONTUARIOS CARREGADOS: {len(prontuarios_filtrados)}")
-    print(f"📊 TOTAL DE ERROS ENCONTRADOS: {total_erros}")
-    print(f"📊 PRONTUÁRIOS COM ERRO: {prontuarios_com_erro}")
+    # Total calculado à parte (COUNT sem carregar linhas), cacheado por filtro até a próxima escrita
+    chave_total = ('prontuarios_total', status_filter, convenio_filter, setor_filter, responsavel_filter,
+                   erros_filter, _to_iso_date(data_inicio_filter), _to_iso_date(data_fim_filter))
+    total_prontuarios = cache_resultados.obter(
+        chave_total, lambda: db.session.query(func.count(Prontuario.id)).filter(*filtros).scalar() or 0)
     
-    for p in prontuarios_filtrados:
-        if p['tem_erros']:
-            print(f"   ✅ Prontuário {p['id']}: {len(p['erros'])} erros")
-            for erro in p['erros']:
-                print(f"      - {erro['tipo']}: {erro['causa']}")
-        else:
-            print(f"   ❌ Prontuário {p['id']}: NENHUM ERRO")
+    print(f"📊 PRONTUARIOS: página com {len(prontuarios_filtrados)} de {total_prontuarios}")
     
-    convenios = [c.nome for c in Convenio.query.filter_by(status='ativo').order_by(Convenio.nome).all()]
-    setores = [s.nome for s in Setor.query.filter_by(status='ativo').order_by(Setor.nome).all()]
-    responsaveis = [r.nome for r in Responsavel.query.filter_by(status='ativo').order_by(Responsavel.nome).all()]
+    convenios = nomes_ativos(Convenio)
+    setores = nomes_ativos(Setor)
+    responsaveis = nomes_ativos(Responsavel)
     tipos_erro_dict = get_tipos_erro_dict()
     
+    # Filtros ativos, repassados nos links de paginação
+    filtros_url = {k: v for k, v in {
+        'status': status_filter,
+        'convenio': convenio_filter,
+        'setor': setor_filter,
+        'responsavel': responsavel_filter,
+        'erros': erros_filter,
+        'data_inicio': data_inicio_filter,
+        'data_fim': data_fim_filter,
+        'por_pagina': por_pagina if por_pagina != app.config['PRONTUARIOS_POR_PAGINA'] else None
+    }.items() if v}
+    
     return render_template('prontuarios.html',
                             prontuarios=prontuarios_filtrados,
                             status_opcoes=STATUS_OPCOES,
@@ -1137,7 +3577,16 @@ def prontuarios():
                             tipos_erro=tipos_erro_dict,
                             status_filter=status_filter,
                             convenio_filter=convenio_filter,
-                            setor_filter=setor_filter)
+                            setor_filter=setor_filter,
+                            responsavel_filter=responsavel_filter,
+                            erros_filter=erros_filter,
+                            data_inicio_filter=data_inicio_filter,
+                            data_fim_filter=data_fim_filter,
+                            total_prontuarios=total_prontuarios,
+                            por_pagina=por_pagina,
+                            cursor_anterior=cursor_anterior,
+                            cursor_proxima=cursor_proxima,
+                            filtros_url=filtros_url)
 
 @app.route('/debug/prontuarios_com_erros')
 @login_required
@@ -1154,7 +3603,7 @@ def debug_prontuarios_com_erros():
                 'id': p.id,
                 'beneficiario': p.beneficiario,
                 'atendimento': p.atendimento,
-                'total_erros': len(p.erros),
+                'total_erros': p.erro_count,
                 'erros': []
             }
             
@@ -1162,6 +3611,7 @@ def debug_prontuarios_com_erros():
                 p_dict['erros'].append({
                     'tipo': erro.tipo,
                     'causa': erro.causa,
+                    'quantidade': erro.quantidade,
                     'responsavel_id': erro.responsavel_id
                 })
             
@@ -1183,32 +3633,35 @@ def detalhes_prontuario(prontuario_id):
     """Página de detalhes de um prontuário específico"""
     try:
         # 🔥 CORREÇÃO CRÍTICA: Carregar TODOS os relacionamentos
-        prontuario = Prontuario.query.options(
-            db.joinedload(Prontuario.responsaveis),
+        # Responsáveis em consulta separada: no JOIN aninhado com a associação o SQLite
+        # materializa a tabela de associação inteira antes de filtrar pelo prontuário
+        opcoes = (
+            db.selectinload(Prontuario.responsaveis),
             db.joinedload(Prontuario.erros).joinedload(Erro.responsavel),  # 🔥 Carregar responsável do erro
             db.joinedload(Prontuario.erros).joinedload(Erro.categoria_erro)  # 🔥 Carregar categoria do erro
-        ).get(prontuario_id)
-        
-        if not prontuario:
-            return "Prontuário não encontrado", 404
+        )
+        prontuario = Prontuario.query.options(*opcoes).get(prontuario_id)
         
         # Converter para dicionário para o template
-        prontuario_dict = prontuario_to_dict(prontuario)
+        if prontuario:
+            prontuario_dict = prontuario_to_dict(prontuario)
+        else:
+            # Arquivado: mostra só para consulta (sem alterar status nem erros)
+            prontuario_dict = prontuario_arquivado(prontuario_id, *opcoes)
+            if not prontuario_dict:
+                return "Prontuário não encontrado", 404
         
-        # 🔥 DEBUG: Verificar se os erros estão sendo carregados
-        print(f"🔍 DETALHES PRONTUÁRIO {prontuario_id}:")
-        print(f"   📝 Total de erros carregados: {len(prontuario_dict['erros'])}")
-        for i, erro in enumerate(prontuario_dict['erros']):
-            print(f"   📝 Erro {i+1}: {erro['tipo']} - {erro['causa']}")
+        app.logger.debug("Detalhes do prontuário %s: %d erros carregados", prontuario_id, len(prontuario_dict['erros']))
         
         # Carregar dados adicionais para o template
-        convenios = [c.nome for c in Convenio.query.filter_by(status='ativo').order_by(Convenio.nome).all()]
-        setores = [s.nome for s in Setor.query.filter_by(status='ativo').order_by(Setor.nome).all()]
-        responsaveis = [r.nome for r in Responsavel.query.filter_by(status='ativo').order_by(Responsavel.nome).all()]
+        convenios = nomes_ativos(Convenio)
+        setores = nomes_ativos(Setor)
+        responsaveis = nomes_ativos(Responsavel)
         tipos_erro_dict = get_tipos_erro_dict()
         
         return render_template('detalhes_prontuario.html',
                               prontuario=prontuario_dict,
+                              arquivado=prontuario is None,
                               status_opcoes=STATUS_OPCOES,
                               convenios=convenios,
                               setores=setores,
@@ -1223,49 +3676,116 @@ def detalhes_prontuario(prontuario_id):
         
 @app.route('/api/dashboard_data')
 @login_required
+@limite_tempo_consulta('relatorio')
 def api_dashboard_data():
-    prontuarios_obj = Prontuario.query.all()
-    prontuarios_lista = [prontuario_to_dict(p) for p in prontuarios_obj]
+    def calcular():
+        acumulador = StatsAccumulator(linhas_estatistica_bd())
+        estado = estado_arquivo()
+        if estado:
+            acumulador.somar(cache_arquivo.obter(('api_dashboard_data', estado), lambda: consultar_arquivo(
+                lambda sessao: StatsAccumulator(linhas_estatistica_bd(sessao.query(Prontuario))))))
     
-    total = len(prontuarios_lista)
+        total = acumulador.total
 
-    c_status = Counter(_norm_status(p) for p in prontuarios_lista)
-    aguardando  = c_status.get("aguardando_auditoria", 0)
-    em_aud      = c_status.get("em_auditoria", 0)
-    para_corr   = c_status.get("aguardando_correcao", 0)
-    entregues   = c_status.get("entregue_faturamento", 0)
+        c_status = acumulador.contagem_status()
+        aguardando  = c_status.get("aguardando_auditoria", 0)
+        em_aud      = c_status.get("em_auditoria", 0)
+        para_corr   = c_status.get("aguardando_correcao", 0)
+        entregues   = c_status.get("entregue_faturamento", 0)
 
-    com_erro = sum(1 for p in prontuarios_lista if _tem_erro(p))
-    taxa_erros = round(100 * com_erro / total, 1) if total else 0.0
+        com_erro = acumulador.com_erro
+        taxa_erros = round(100 * com_erro / total, 1) if total else 0.0
 
-    META_TAXA_ERROS = 10.0
+        META_TAXA_ERROS = 10.0
 
-    hoje = datetime.now()
-    produtividade = _calc_produtividade_diaria_mes(prontuarios_lista, hoje.year, hoje.month)
-    tempos = _calc_tempos_medios(prontuarios_lista)
-    erros_por_setor = _calc_taxa_erros_setor(prontuarios_lista)
+        hoje = datetime.now()
+        produtividade = _resumo_produtividade_diaria_mes(hoje.year, hoje.month)
+        # Dias entre recebimento e envio ao faturamento, lidos das colunas de data. A versão que
+        # passava por prontuario_to_dict (datas dd/mm/aaaa, _parse_any_date só ISO) sempre dava 0
+        tempos = acumulador.tempos_medios()
+        erros_por_setor = acumulador.taxa_erros_setor()
     
-    payload = {
-        "stats": {
-            "aguardando_auditoria": aguardando,
-            "em_auditoria": em_aud,
-            "aguardando_correcao": para_corr,
-            "entregue": entregues,
-            "taxa_erros": taxa_erros,
-            "meta_taxa_erros": META_TAXA_ERROS,
-            "total_registrados_mes": produtividade["total_registrado"],
-            "tempo_medio_auditoria": tempos["auditoria"],
-            "taxa_conclusao": round(100 * entregues / total, 1) if total else 0.0,
-            "percentual_com_erros": taxa_erros,
-        },
-        "taxa_erros_setor": erros_por_setor,
-        "produtividade_diaria_mes": produtividade,
-        "tempos_medios": tempos,
-    }
+        payload = {
+            "stats": {
+                "aguardando_auditoria": aguardando,
+                "em_auditoria": em_aud,
+                "aguardando_correcao": para_corr,
+                "entregue": entregues,
+                "taxa_erros": taxa_erros,
+                "meta_taxa_erros": META_TAXA_ERROS,
+                "total_registrados_mes": produtividade["total_registrado"],
+                "tempo_medio_auditoria": tempos["auditoria"],
+                "taxa_conclusao": round(100 * entregues / total, 1) if total else 0.0,
+                "percentual_com_erros": taxa_erros,
+            },
+            "taxa_erros_setor": erros_por_setor,
+            "produtividade_diaria_mes": produtividade,
+            "tempos_medios": tempos,
+        }
+        return payload
+
+    payload = cache_resultados.obter(chave_filtros('api_dashboard_data'), calcular)
     return jsonify(payload)
 
+def filtrar_por_data_relatorio(q, ano, mes, periodo, data_inicio, data_fim, coluna=Prontuario.data_criacao):
+    """
+    Filtros de período da tela de relatórios (também usados na exportação).
+    Sem nenhum filtro, assume o mês atual. Retorna (query, periodo efetivo).
+    """
+    hoje = datetime.now()
+    
+    if not any([ano, mes, periodo, data_inicio, data_fim]):
+        periodo = 'mes'
+    
+    if periodo:
+        start_date = None
+        end_date = None
+        if periodo == 'hoje':
+            start_date = hoje.replace(hour=0, minute=0, second=0, microsecond=0)
+        elif periodo == 'ontem':
+            start_date = (hoje - timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+            end_date = hoje.replace(hour=0, minute=0, second=0, microsecond=0)
+        elif periodo == 'semana':
+            start_date = (hoje - timedelta(days=7)).replace(hour=0, minute=0, second=0, microsecond=0)
+        elif periodo == 'mes':
+            start_date = hoje.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        elif periodo == 'trimestre':
+            trimestre_atual = (hoje.month - 1) // 3 + 1
+            mes_inicio_trimestre = (trimestre_atual - 1) * 3 + 1
+            start_date = hoje.replace(month=mes_inicio_trimestre, day=1, hour=0, minute=0, second=0, microsecond=0)
+        elif periodo == 'ano':
+            start_date = hoje.replace(month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
+        
+        if start_date and end_date:
+            q = q.filter(coluna >= _limite_data(coluna, start_date), coluna < _limite_data(coluna, end_date))
+        elif start_date:
+            q = q.filter(coluna >= _limite_data(coluna, start_date))
+
+    if data_inicio:
+        data_ini = _parse_any_date(data_inicio)
+        if data_ini:
+            q = q.filter(coluna >= _limite_data(coluna, data_ini))
+            periodo = ''
+    if data_fim:
+        data_fim_dt = _parse_any_date(data_fim)
+        if data_fim_dt:
+            q = q.filter(coluna < _limite_data(coluna, _inicio_do_dia(data_fim_dt) + timedelta(days=1)))
+            periodo = ''
+
+    intervalo = _intervalo_ano_mes(ano, mes)
+    if intervalo:
+        q = q.filter(coluna >= _limite_data(coluna, intervalo[0]), coluna < _limite_data(coluna, intervalo[1]))
+        periodo = ''
+    elif mes:
+        q = q.filter(db.extract('month', coluna) == int(mes))
+    if mes:
+        periodo = ''
+        
+    return q, periodo
+
 @app.route('/relatorios')
 @login_required
+@limite_tempo_consulta('relatorio')
 def relatorios():
     ano_filter = request.args.get('ano', '')
     mes_filter = request.args.get('mes', '')
@@ -1273,77 +3793,44 @@ def relatorios():
     data_inicio_filter = request.args.get('data_inicio', '')
     data_fim_filter = request.args.get('data_fim', '')
     
-    # 🔥 CORREÇÃO: Carregar todos os relacionamentos
+    # 🔥 CORREÇÃO: Carregar todos os relacionamentos (selectin, para poder ler em lotes com yield_per)
     query = Prontuario.query.options(
-        db.joinedload(Prontuario.responsaveis),
-        db.joinedload(Prontuario.erros).joinedload(Erro.responsavel),
-        db.joinedload(Prontuario.erros).joinedload(Erro.categoria_erro)
+        db.selectinload(Prontuario.responsaveis),
+        db.selectinload(Prontuario.erros).selectinload(Erro.responsavel),
+        db.selectinload(Prontuario.erros).selectinload(Erro.categoria_erro)
     ).order_by(Prontuario.data_criacao.desc())
     
-    def filtrar_por_data_bd(q, ano, mes, periodo, data_inicio, data_fim):
-        hoje = datetime.now()
-        
-        nonlocal periodo_filter
-        if not any([ano, mes, periodo, data_inicio, data_fim]):
-            periodo = 'mes'
-            periodo_filter = 'mes'
-        
-        if periodo:
-            start_date = None
-            end_date = None
-            if periodo == 'hoje':
-                start_date = hoje.replace(hour=0, minute=0, second=0, microsecond=0)
-            elif periodo == 'ontem':
-                start_date = (hoje - timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
-                end_date = hoje.replace(hour=0, minute=0, second=0, microsecond=0)
-            elif periodo == 'semana':
-                start_date = (hoje - timedelta(days=7)).replace(hour=0, minute=0, second=0, microsecond=0)
-            elif periodo == 'mes':
-                start_date = hoje.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-            elif periodo == 'trimestre':
-                trimestre_atual = (hoje.month - 1) // 3 + 1
-                mes_inicio_trimestre = (trimestre_atual - 1) * 3 + 1
-                start_date = hoje.replace(month=mes_inicio_trimestre, day=1, hour=0, minute=0, second=0, microsecond=0)
-            elif periodo == 'ano':
-                start_date = hoje.replace(month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
-            
-            if start_date and end_date:
-                q = q.filter(Prontuario.data_criacao >= start_date, Prontuario.data_criacao < end_date)
-            elif start_date:
-                q = q.filter(Prontuario.data_criacao >= start_date)
-
-        if data_inicio:
-            data_ini = _parse_any_date(data_inicio)
-            if data_ini:
-                q = q.filter(Prontuario.data_criacao >= data_ini)
-                periodo_filter = ''
-        if data_fim:
-            data_fim_dt = _parse_any_date(data_fim)
-            if data_fim_dt:
-                data_fim_dt = data_fim_dt.replace(hour=23, minute=59, second=59)
-                q = q.filter(Prontuario.data_criacao <= data_fim_dt)
-                periodo_filter = ''
-
-        if ano:
-            q = q.filter(db.extract('year', Prontuario.data_criacao) == int(ano))
-            periodo_filter = ''
-        if mes:
-            q = q.filter(db.extract('month', Prontuario.data_criacao) == int(mes))
-            periodo_filter = ''
-            
-        return q
+    periodo_param = periodo_filter
+    query_filtrada, periodo_filter = filtrar_por_data_relatorio(query, ano_filter, mes_filter, periodo_param,
+                                                                data_inicio_filter, data_fim_filter)
+    chave = chave_filtros('relatorios', ano_filter, mes_filter, periodo_param, data_inicio_filter, data_fim_filter)
 
-    query_filtrada = filtrar_por_data_bd(query, ano_filter, mes_filter, periodo_filter, data_inicio_filter, data_fim_filter)
-    
-    prontuarios_filtrados_obj = query_filtrada.all()
-    prontuarios_filtrados = [prontuario_to_dict(p) for p in prontuarios_filtrados_obj]
-    
-    # 🔥 DEBUG: Verificar erros nos relatórios
-    total_erros_relatorio = sum(len(p['erros']) for p in prontuarios_filtrados)
-    print(f"📊 RELATÓRIO - Prontuários: {len(prontuarios_filtrados)}, Erros: {total_erros_relatorio}")
-    
-    anos_query = db.session.query(db.extract('year', Prontuario.data_criacao)).distinct().order_by(db.extract('year', Prontuario.data_criacao).desc()).limit(5)
-    anos_disponiveis = [int(ano[0]) for ano in anos_query.all() if ano[0] is not None]
+    def calcular():
+        # Os filtros de relatório são sempre por dia inteiro, então as estatísticas saem do ResumoDiario
+        query_resumo, _ = filtrar_por_data_relatorio(db.session.query(ResumoDiario), ano_filter, mes_filter, periodo_param,
+                                                     data_inicio_filter, data_fim_filter, coluna=ResumoDiario.dia)
+        # Taxas por responsável/convênio em SQL, com os mesmos filtros da listagem (e o arquivo, se alcançar)
+        filtros = [c for c in [query_filtrada.whereclause] if c is not None]
+        contagens = contagens_dashboard(filtros)
+        estado = arquivo_necessario(filtros)
+        if estado:
+            somar_contagens_dashboard(contagens, cache_arquivo.obter(('relatorios', estado, chave), lambda: (
+                consultar_arquivo(lambda sessao: contagens_dashboard(filtros, sessao)))))
+
+        return {
+            'stats': calcular_estatisticas_resumo(query_resumo),
+            'stats_responsavel': _agg_taxa_erros_responsavel(contagens),
+            'stats_convenio': _agg_taxa_erros_convenio(contagens),
+            'anos_disponiveis': anos_com_prontuarios(limite=5),
+        }
+
+    # Só os agregados vão para o cache; a lista dos gráficos sai da query a cada requisição,
+    # em lotes (no PostgreSQL o yield_per lê por cursor do lado do servidor)
+    relatorio = cache_resultados.obter(chave, calcular)
+    prontuarios_filtrados = [prontuario_to_dict(p) for p in prontuarios_com_arquivo(query_filtrada, EXPORTACAO_LOTE)]
+
+    app.logger.debug("Relatório: %d prontuários, %d erros", len(prontuarios_filtrados),
+                     sum(len(p['erros']) for p in prontuarios_filtrados))
     
     meses_disponiveis = [
         ('01', 'Janeiro'), ('02', 'Fevereiro'), ('03', 'Março'), ('04', 'Abril'),
@@ -1359,17 +3846,13 @@ def relatorios():
         data_fim_filter
     )
     
-    stats = calcular_estatisticas_bd(prontuarios_filtrados_obj)
-    stats_taxa_erro_responsavel = _calc_taxa_erros_responsavel(prontuarios_filtrados)
-    stats_taxa_erro_convenio = _calc_taxa_erros_convenio(prontuarios_filtrados)
-    
     tipos_erro_dict = get_tipos_erro_dict()
     
     return render_template('relatorios.html',
                             prontuarios=prontuarios_filtrados,
-                            stats=stats,
+                            stats=relatorio['stats'],
                             tipos_erro=tipos_erro_dict,
-                            anos_disponiveis=anos_disponiveis,
+                            anos_disponiveis=relatorio['anos_disponiveis'],
                             meses_disponiveis=meses_disponiveis,
                             periodo_info=periodo_info,
                             ano_filter=ano_filter,
@@ -1377,18 +3860,132 @@ def relatorios():
                             periodo_filter=periodo_filter,
                             data_inicio_filter=data_inicio_filter,
                             data_fim_filter=data_fim_filter,
-                            stats_responsavel=stats_taxa_erro_responsavel,
-                            stats_convenio=stats_taxa_erro_convenio)
+                            stats_responsavel=relatorio['stats_responsavel'],
+                            stats_convenio=relatorio['stats_convenio'])
+# Exportação do conjunto filtrado de /relatorios (mesmos filtros de período da tela)
+COLUNAS_EXPORTACAO = [
+    'ID', 'Beneficiário', 'Convênio', 'Setor', 'Atendimento', 'Admissão', 'Alta', 'Status',
+    'Responsáveis', 'Recebimento', 'Data Conta', 'Enviado Faturamento', 'Fim Auditoria',
+    'Diárias', 'Qtd Erros', 'Erros', 'Observação', 'Data Criação'
+]
+EXPORTACAO_LOTE = 500
+
+def _linhas_exportacao(query):
+    """
+    Gera uma linha por prontuário lendo em lotes (yield_per), sem materializar o resultado.
+    No PostgreSQL o yield_per usa cursor do lado do servidor (stream_results).
+    """
+    query = query.options(
+        db.selectinload(Prontuario.responsaveis),
+        db.selectinload(Prontuario.erros)
+    )
+    # Os objetos já escritos saem da sessão para a memória não crescer com o tamanho da exportação
+    for p in prontuarios_com_arquivo(query, EXPORTACAO_LOTE):
+        yield [
+            p.id, p.beneficiario, p.convenio, p.setor, p.atendimento,
+            _to_br_date(p.admissao), _to_br_date(p.alta), p.status,
+            ', '.join(r.nome for r in p.responsaveis),
+            _to_br_date(p.recebimento_prontuario), _to_br_date(p.data_conta),
+            _to_br_date(p.enviado_faturamento), _to_br_date(p.fim_auditoria),
+            p.diarias or 0, p.erro_count,
+            '; '.join(f"{e.tipo}: {e.causa}" + (f" (x{e.quantidade})" if e.quantidade > 1 else '') for e in p.erros),
+            p.observacao or '', _to_br_date(p.data_criacao)
+        ]
+
+def _gerar_csv(linhas):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write('\ufeff')  # BOM para o Excel reconhecer UTF-8
+    writer.writerow(COLUNAS_EXPORTACAO)
+    for i, linha in enumerate(linhas, 1):
+        writer.writerow(linha)
+        if i % EXPORTACAO_LOTE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def _gerar_xlsx(linhas):
+    """
+    Workbook em modo write-only: as linhas vão direto para o arquivo temporário do openpyxl.
+    O zip só fica completo no save(), então os bytes saem depois da última linha, em blocos.
+    """
+    from openpyxl import Workbook
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet('Prontuários')
+    ws.append(COLUNAS_EXPORTACAO)
+    for linha in linhas:
+        ws.append(linha)
+
+    with tempfile.TemporaryFile() as arquivo:
+        wb.save(arquivo)
+        arquivo.seek(0)
+        while True:
+            bloco = arquivo.read(64 * 1024)
+            if not bloco:
+                break
+            yield bloco
+
+@app.route('/relatorios/exportar/<formato>')
+@login_required
+@limite_tempo_consulta('relatorio')
+def exportar_relatorios(formato):
+    if formato not in ('csv', 'xlsx'):
+        return jsonify({'sucesso': False, 'erro': 'Formato inválido. Use csv ou xlsx.'}), 400
+    
+    query, _ = filtrar_por_data_relatorio(
+        Prontuario.query.order_by(Prontuario.data_criacao.desc(), Prontuario.id.desc()),
+        request.args.get('ano', ''),
+        request.args.get('mes', ''),
+        request.args.get('periodo', ''),
+        request.args.get('data_inicio', ''),
+        request.args.get('data_fim', '')
+    )
+    
+    nome_arquivo = f"relatorio_auditoria_{datetime.now().strftime('%Y%m%d_%H%M')}.{formato}"
+    if formato == 'csv':
+        corpo = _gerar_csv(_linhas_exportacao(query))
+        mimetype = 'text/csv; charset=utf-8'
+    else:
+        corpo = _gerar_xlsx(_linhas_exportacao(query))
+        mimetype = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    
+    print(f"📤 Exportando relatório ({formato}): {nome_arquivo}")
+    return Response(stream_with_context(corpo), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename="{nome_arquivo}"'})
+
 # --- 6. APIs DE PRONTUÁRIOS ---
+@app.route('/api/prontuarios/busca')
+@login_required
+def api_buscar_prontuarios():
+    texto = request.args.get('q', '').strip()
+    pagina = max(1, request.args.get('pagina', 1, type=int))
+    por_pagina = max(1, min(request.args.get('por_pagina', 20, type=int), 100))
+    
+    inicio = time.perf_counter()
+    resultados, total = buscar_prontuarios(texto, pagina, por_pagina)
+    return jsonify({
+        'resultados': resultados,
+        'total': total,
+        'pagina': pagina,
+        'por_pagina': por_pagina,
+        'tem_proxima': pagina * por_pagina < total,
+        'tempo_ms': round((time.perf_counter() - inicio) * 1000, 1)
+    })
+
 @app.route('/api/excluir_prontuario/<int:prontuario_id>', methods=['DELETE'])
 @login_required
+@invalida_cache
 def api_excluir_prontuario(prontuario_id):
     try:
         prontuario = Prontuario.query.get(prontuario_id)
         if not prontuario:
             return jsonify({'sucesso': False, 'erro': 'Prontuário não encontrado'}), 404
         
+        antes = _contribuicoes_resumo(prontuario)
         db.session.delete(prontuario)
+        _atualizar_resumo(antes, {})
         db.session.commit()
         
         print(f"✅ Prontuário {prontuario_id} excluído com sucesso!")
@@ -1401,6 +3998,7 @@ def api_excluir_prontuario(prontuario_id):
 
 @app.route('/api/atualizar_status/<int:prontuario_id>', methods=['POST'])
 @login_required
+@invalida_cache
 def atualizar_status(prontuario_id):
     dados = request.get_json()
     novo_status = dados.get('status')
@@ -1408,21 +4006,240 @@ def atualizar_status(prontuario_id):
     if not novo_status or novo_status not in STATUS_OPCOES:
         return jsonify({'erro': 'Status inválido'}), 400
     
-    prontuario = Prontuario.query.get(prontuario_id)
+    try:
+        if not executar_escrita(_gravar_status, prontuario_id, novo_status):
+            return jsonify({'erro': 'Prontuário não encontrado'}), 404
+        return jsonify({'sucesso': True, 'novo_status': novo_status})
+    except Exception as e:
+        return jsonify({'sucesso': False, 'erro': str(e)}), 500
+
+def _gravar_status(prontuario_id, novo_status):
+    prontuario = db.session.get(Prontuario, prontuario_id)
     if not prontuario:
-        return jsonify({'erro': 'Prontuário não encontrado'}), 404
-    
+        return False
+    antes = _contribuicoes_resumo(prontuario)
+    prontuario.status = novo_status
+    prontuario.data_atualizacao = datetime.now()
+    _registrar_escrita(prontuario, antes)
+    return True
+
+def _sincronizar_erros(p, quantidades, agora):
+    """
+    Leva p.erros às quantidades pedidas ({(tipo, causa, responsavel_id): quantidade}) mexendo só no que
+    mudou: linhas iguais ficam intactas (id, data_criacao, categoria), aumentos somam na linha de hoje ou
+    viram uma linha nova, reduções saem das linhas mais recentes. Chave com responsavel_id None casa
+    também com linhas já atribuídas, para não perder a atribuição quando o payload não a traz.
+    Devolve Counter com 'inseridos', 'atualizados' e 'removidos'.
+    """
+    tocados = Counter()
+    grupos = defaultdict(list)
+    for erro in p.erros:
+        chave = (erro.tipo, erro.causa, erro.responsavel_id)
+        if chave not in quantidades and (erro.tipo, erro.causa, None) in quantidades:
+            chave = (erro.tipo, erro.causa, None)
+        grupos[chave].append(erro)
+
+    for chave in set(grupos) | set(quantidades):
+        linhas = sorted(grupos.get(chave, []), key=lambda e: (e.data_criacao or datetime.min, e.id or 0))
+        diferenca = quantidades.get(chave, 0) - sum(e.quantidade for e in linhas)
+        if diferenca > 0:
+            ultima = linhas[-1] if linhas else None
+            if ultima and _dia(ultima.data_criacao) == agora.date():
+                ultima.quantidade += diferenca
+                tocados['atualizados'] += 1
+            else:
+                tipo, causa, responsavel_id = chave
+                p.erros.append(Erro(tipo=tipo, causa=causa, quantidade=diferenca, responsavel_id=responsavel_id,
+                                    categoria_erro_id=categoria_id_por_tipo(tipo), data_criacao=agora))
+                tocados['inseridos'] += 1
+        elif diferenca < 0:
+            excesso = -diferenca
+            for erro in reversed(linhas):
+                if excesso <= 0:
+                    break
+                if erro.quantidade <= excesso:
+                    excesso -= erro.quantidade
+                    p.erros.remove(erro)
+                    tocados['removidos'] += 1
+                else:
+                    erro.quantidade -= excesso
+                    excesso = 0
+                    tocados['atualizados'] += 1
+    return tocados
+
+# --- Operações em lote (status / responsáveis) ---
+# Alvo: lista de ids ou um filtro com os mesmos parâmetros da listagem de prontuários.
+# Cada operação é um UPDATE/DELETE/INSERT ... WHERE id IN (...) por bloco de ids, tudo
+# numa transação só.
+
+LOTE_IDS_IN = 500  # ids por comando IN
+
+def _blocos_ids(ids, tamanho=LOTE_IDS_IN):
+    for i in range(0, len(ids), tamanho):
+        yield ids[i:i + tamanho]
+
+def _ids_operacao_lote(dados):
+    """Resolve o alvo de uma operação em lote: devolve (ids encontrados, ids não encontrados). Levanta ValueError."""
+    if 'ids' in dados:
+        ids = dados['ids']
+        if not isinstance(ids, list) or not ids or not all(str(i).isdigit() for i in ids):
+            raise ValueError('ids deve ser uma lista de números')
+        pedidos = sorted({int(i) for i in ids})
+        encontrados = set()
+        for bloco in _blocos_ids(pedidos):
+            encontrados.update(db.session.scalars(db.select(Prontuario.id).where(Prontuario.id.in_(bloco))))
+        return sorted(encontrados), [i for i in pedidos if i not in encontrados]
+    filtro = dados.get('filtro')
+    filtros = _filtros_listagem(filtro) if isinstance(filtro, dict) else []
+    if not filtros:
+        raise ValueError('Informe ids ou ao menos um filtro')
+    return db.session.scalars(db.select(Prontuario.id).where(*filtros).order_by(Prontuario.id)).all(), []
+
+@app.route('/api/prontuarios/status', methods=['POST'])
+@login_required
+@limite_tempo_consulta('lote')
+@invalida_cache
+def api_atualizar_status_lote():
+    """Muda o status de vários prontuários de uma vez (ex.: lote entregue ao faturamento)"""
+    dados = request.get_json(silent=True) or {}
+    novo_status = dados.get('status')
+    if not novo_status or novo_status not in STATUS_OPCOES:
+        return jsonify({'sucesso': False, 'erro': 'Status inválido'}), 400
     try:
-        prontuario.status = novo_status
-        prontuario.data_atualizacao = datetime.now()
+        ids, nao_encontrados = _ids_operacao_lote(dados)
+    except ValueError as e:
+        return jsonify({'sucesso': False, 'erro': str(e)}), 400
+
+    tabela = Prontuario.__table__
+    agora = datetime.now()
+    afetados = 0
+    try:
+        status_id = id_catalogo(StatusProntuario, novo_status)
+        for bloco in _blocos_ids(ids):
+            # O status faz parte da chave do ResumoDiario: aplica a diferença antes/depois do bloco
+            antes = _totais_resumo(bloco)
+            afetados += db.session.execute(
+                tabela.update()
+                .where(tabela.c.id.in_(bloco), db.or_(tabela.c.status_id != status_id, tabela.c.status_id.is_(None)))
+                .values(status_id=status_id, data_atualizacao=agora)
+            ).rowcount
+            _atualizar_resumo(antes, _totais_resumo(bloco))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'sucesso': False, 'erro': str(e)}), 500
+
+    print(f"✅ Status '{novo_status}' aplicado em {afetados} de {len(ids)} prontuários")
+    return jsonify({'sucesso': True, 'novo_status': novo_status, 'selecionados': len(ids),
+                    'afetados': afetados, 'nao_encontrados': nao_encontrados})
+
+@app.route('/api/prontuarios/responsaveis', methods=['POST'])
+@login_required
+@limite_tempo_consulta('lote')
+@invalida_cache
+def api_substituir_responsaveis_lote():
+    """Substitui os responsáveis de vários prontuários pela lista de ids em 'responsaveis'"""
+    dados = request.get_json(silent=True) or {}
+    responsaveis = dados.get('responsaveis')
+    if not isinstance(responsaveis, list) or not all(str(r).isdigit() for r in responsaveis):
+        return jsonify({'sucesso': False, 'erro': 'responsaveis deve ser uma lista de ids'}), 400
+    responsaveis_ids = sorted({int(r) for r in responsaveis})
+    encontrados = set(db.session.scalars(db.select(Responsavel.id).where(Responsavel.id.in_(responsaveis_ids))))
+    faltantes = [r for r in responsaveis_ids if r not in encontrados]
+    if faltantes:
+        return jsonify({'sucesso': False, 'erro': f'Responsável não encontrado: {faltantes}'}), 400
+    try:
+        ids, nao_encontrados = _ids_operacao_lote(dados)
+    except ValueError as e:
+        return jsonify({'sucesso': False, 'erro': str(e)}), 400
+
+    assoc = prontuario_responsavel_association
+    tabela = Prontuario.__table__
+    agora = datetime.now()
+    try:
+        for bloco in _blocos_ids(ids):
+            db.session.execute(assoc.delete().where(assoc.c.prontuario_id.in_(bloco)))
+            if responsaveis_ids:
+                db.session.execute(assoc.insert().from_select(
+                    ['prontuario_id', 'responsavel_id'],
+                    db.select(Prontuario.id, Responsavel.id)
+                    .join(Responsavel, db.true())  # produto cartesiano proposital
+                    .where(Prontuario.id.in_(bloco), Responsavel.id.in_(responsaveis_ids))
+                ))
+            db.session.execute(tabela.update().where(tabela.c.id.in_(bloco)).values(data_atualizacao=agora))
         db.session.commit()
-        return jsonify({'sucesso': True, 'novo_status': novo_status})
     except Exception as e:
         db.session.rollback()
         return jsonify({'sucesso': False, 'erro': str(e)}), 500
 
+    print(f"✅ Responsáveis {responsaveis_ids} atribuídos a {len(ids)} prontuários")
+    return jsonify({'sucesso': True, 'responsaveis': responsaveis_ids, 'afetados': len(ids),
+                    'nao_encontrados': nao_encontrados})
+
+CAMPOS_OBRIGATORIOS_LANCAMENTO = ['beneficiario', 'convenio', 'setor', 'atendimento', 'admissao']
+CAMPOS_DATA_LANCAMENTO = ['admissao', 'alta', 'recebimento_prontuario', 'data_conta',
+                          'enviado_faturamento', 'fim_auditoria']
+
+def _ler_lancamento(dados, novo=True):
+    """
+    Valida um payload de lançamento (formato de /api/adicionar_prontuario) e devolve
+    (campos do prontuário, ids dos responsáveis, Counter {(tipo, causa, responsavel_id): quantidade}).
+    Com novo=False (atualização) só os campos presentes no payload entram. Levanta ValueError,
+    inclusive para convênio, setor, status, tipo ou causa fora dos cadastros.
+    """
+    if not isinstance(dados, dict):
+        raise ValueError('Lançamento inválido')
+    if novo:
+        for campo in CAMPOS_OBRIGATORIOS_LANCAMENTO:
+            if not dados.get(campo):
+                raise ValueError(f'Campo {campo} é obrigatório')
+
+    responsaveis_ids = []
+    if isinstance(dados.get('responsaveis'), list):
+        responsaveis_ids = [int(r) for r in dados['responsaveis'] if str(r).isdigit()]
+    elif isinstance(dados.get('responsaveis'), str) and dados['responsaveis'].isdigit():
+        responsaveis_ids = [int(dados['responsaveis'])]
+
+    # Erros iguais (tipo, causa, responsável) viram uma linha só, somando a quantidade
+    quantidades = Counter()
+    for erro in dados.get('erros') if isinstance(dados.get('erros'), list) else []:
+        if isinstance(erro, dict) and erro.get('tipo') and erro.get('causa') and erro.get('responsavel_id'):
+            try:
+                chave = (erro['tipo'], erro['causa'], int(erro['responsavel_id']))
+                quantidades[chave] += max(1, int(erro.get('quantidade') or 1))
+            except (TypeError, ValueError):
+                raise ValueError(f"Erro inválido: {erro['tipo']} - {erro['causa']}")
+
+    campos = {}
+    for campo in ('beneficiario', 'atendimento'):
+        if campo in dados:
+            campos[campo] = str(dados[campo] or '').strip()
+    for campo in ('convenio', 'setor', 'status', 'observacao'):
+        if campo in dados:
+            campos[campo] = dados[campo]
+    if 'diarias' in dados:
+        try:
+            campos['diarias'] = int(dados['diarias'] or 0)
+        except (TypeError, ValueError):
+            raise ValueError('Campo diarias deve ser um número')
+    for campo in CAMPOS_DATA_LANCAMENTO:
+        if campo in dados:
+            campos[campo] = _parse_any_date(dados[campo])
+    if novo:
+        campos.setdefault('status', 'Aguardando Auditoria')
+        campos.setdefault('observacao', '')
+        campos.setdefault('diarias', 0)
+    elif any(campos.get(c) == '' for c in ('beneficiario', 'atendimento')):
+        raise ValueError('Beneficiário e atendimento não podem ficar em branco')
+    # Convênio, setor, status, tipo e causa têm de estar nos cadastros (nada é cadastrado aqui)
+    colunas_prontuario({c: campos[c] for c in CAMPOS_CATALOGO_PRONTUARIO if c in campos})
+    for tipo, causa, _ in quantidades:
+        ids_erro(tipo, causa)
+    return campos, responsaveis_ids, quantidades
+
 @app.route('/api/adicionar_prontuario', methods=['POST'])
 @login_required
+@invalida_cache
 def adicionar_prontuario():
     try:
         dados = request.get_json()
@@ -1430,143 +4247,195 @@ def adicionar_prontuario():
         print("=== 🚀 NOVO SISTEMA DE LANÇAMENTO ===")
         print(f"📥 Dados recebidos: {list(dados.keys())}")
         
-        # 🔥 DEBUG DETALHADO DOS ERROS
         if 'erros' in dados:
-            print(f"🔍 TIPO DE 'erros': {type(dados['erros'])}")
-            print(f"🔍 CONTEÚDO DE 'erros': {dados['erros']}")
-            
-            if isinstance(dados['erros'], list):
-                print(f"📝 LISTA COM {len(dados['erros'])} ERROS:")
-                for i, erro in enumerate(dados['erros']):
-                    print(f"  Erro {i}: {erro}")
-        
-        # 🔥 CORREÇÃO 1: Validação de campos obrigatórios
-        campos_obrigatorios = ['beneficiario', 'convenio', 'setor', 'atendimento', 'admissao']
-        for campo in campos_obrigatorios:
-            if not dados.get(campo):
-                return jsonify({'sucesso': False, 'erro': f'Campo {campo} é obrigatório'}), 400
+            app.logger.debug("Erros recebidos: %r", dados['erros'])
         
-        # 🔥 CORREÇÃO 2: Processamento de responsáveis
-        responsaveis_ids = []
-        if 'responsaveis' in dados:
-            if isinstance(dados['responsaveis'], list):
-                responsaveis_ids = [int(r) for r in dados['responsaveis'] if str(r).isdigit()]
-            elif isinstance(dados['responsaveis'], str):
-                responsaveis_ids = [int(dados['responsaveis'])]
+        # 🔥 CORREÇÃO 1-3: Validação de campos obrigatórios, responsáveis e erros
+        try:
+            campos, responsaveis_ids, quantidades = _ler_lancamento(dados)
+        except ValueError as e:
+            return jsonify({'sucesso': False, 'erro': str(e)}), 400
         
         print(f"👥 RESPONSÁVEIS RECEBIDOS (IDs): {responsaveis_ids}")
+        print(f"🔍 ERROS PROCESSADOS: {len(quantidades)}")
         
-        # 🔥 CORREÇÃO 3: Processamento de erros - ESTRUTURA CORRIGIDA
-        erros_processados = []
-        responsaveis_dos_erros = set()
+        prontuario_id, nomes_responsaveis = executar_escrita(_gravar_novo_prontuario, campos, responsaveis_ids, quantidades)
         
-        if 'erros' in dados and isinstance(dados['erros'], list):
-            for erro in dados['erros']:
-                if (isinstance(erro, dict) and 
-                    erro.get('tipo') and 
-                    erro.get('causa') and 
-                    erro.get('responsavel_id')):
-                    
-                    # 🔥 CORREÇÃO: Garantir que os campos estão com nomes corretos
-                    erro_processado = {
-                        'tipo': erro['tipo'],
-                        'causa': erro['causa'],
-                        'quantidade': erro.get('quantidade', 1),
-                        'responsavel_id': int(erro['responsavel_id'])  # Converter para int
-                    }
-                    
-                    erros_processados.append(erro_processado)
-                    responsaveis_dos_erros.add(int(erro['responsavel_id']))
-        
-        print(f"🔍 ERROS PROCESSADOS: {len(erros_processados)}")
-        print(f"👥 RESPONSÁVEIS DOS ERROS: {responsaveis_dos_erros}")
-        
-        # 🔥 CORREÇÃO 4: Validação de responsáveis vs erros
-        todos_responsaveis = set(responsaveis_ids) | responsaveis_dos_erros
-        print(f"👥 TODOS RESPONSÁVEIS ENVOLVIDOS: {todos_responsaveis}")
-        
-        if len(erros_processados) > 0 and len(todos_responsaveis) == 0:
-            return jsonify({
-                'sucesso': False, 
-                'erro': 'Cada erro deve estar vinculado a um responsável válido.'
-            }), 400
-
-        # 🔥 CORREÇÃO 5: Criação do prontuário
-        novo_prontuario = Prontuario(
-            beneficiario=dados['beneficiario'].strip(),
-            convenio=dados['convenio'],
-            setor=dados['setor'],
-            atendimento=dados['atendimento'].strip(),
-            status=dados.get('status', 'Aguardando Auditoria'),
-            observacao=dados.get('observacao', ''),
-            diarias=int(dados.get('diarias', 0)),
-            
-            # Processamento de datas
-            admissao=_parse_any_date(dados['admissao']),
-            alta=_parse_any_date(dados.get('alta')),
-            recebimento_prontuario=_parse_any_date(dados.get('recebimento_prontuario')),
-            data_conta=_parse_any_date(dados.get('data_conta')),
-            enviado_faturamento=_parse_any_date(dados.get('enviado_faturamento')),
-            fim_auditoria=_parse_any_date(dados.get('fim_auditoria')),
+        print(f"✅ PRONTUÁRIO SALVO NO BD! ID: {prontuario_id}")
+        print(f"📝 RESPONSÁVEIS ASSOCIADOS: {nomes_responsaveis}")
+        print(f"📝 TOTAL DE ERROS ASSOCIADOS: {len(quantidades)} registros")
+        
+        return jsonify({
+            'sucesso': True, 
+            'prontuario_id': prontuario_id,
+            'mensagem': f'Prontuário salvo com {len(nomes_responsaveis)} responsável(eis) e {len(quantidades)} tipo(s) de erro'
+        })
+        
+    except Exception as e:
+        print("❌ ERRO AO ADICIONAR PRONTUÁRIO NO BD:", str(e))
+        traceback.print_exc()
+        return jsonify({'sucesso': False, 'erro': str(e)}), 500
+
+def _gravar_novo_prontuario(campos, responsaveis_ids, quantidades):
+    """Grava um lançamento já validado por _ler_lancamento; devolve (id, nomes dos responsáveis)"""
+    # 🔥 CORREÇÃO 4: Responsáveis do prontuário = os informados + os dos erros
+    todos_responsaveis = set(responsaveis_ids) | {responsavel_id for _, _, responsavel_id in quantidades}
+    print(f"👥 TODOS RESPONSÁVEIS ENVOLVIDOS: {todos_responsaveis}")
+
+    # 🔥 CORREÇÃO 5: Criação do prontuário
+    novo_prontuario = Prontuario(**campos)
+    
+    db.session.add(novo_prontuario)
+    db.session.flush()  # Para obter o ID
+
+    # 🔥 CORREÇÃO 6: Associar responsáveis ao prontuário
+    responsaveis_encontrados = []
+    if todos_responsaveis:
+        responsaveis_encontrados = Responsavel.query.filter(
+            Responsavel.id.in_(list(todos_responsaveis))
+        ).all()
+        
+        if responsaveis_encontrados:
+            novo_prontuario.responsaveis.extend(responsaveis_encontrados)
+            print(f"✅ {len(responsaveis_encontrados)} responsável(eis) associado(s) ao prontuário")
+        else:
+            print("⚠️  Nenhum responsável encontrado com os IDs fornecidos")
+
+    # 🔥 CORREÇÃO 7: Adição de erros com quantidade (uma linha por tipo/causa/responsável)
+    for (tipo, causa, responsavel_id), quantidade in quantidades.items():
+        novo_erro = Erro(
+            prontuario_id=novo_prontuario.id,
+            tipo=tipo,
+            causa=causa,
+            quantidade=quantidade,
+            responsavel_id=responsavel_id,
+            categoria_erro_id=categoria_id_por_tipo(tipo)
         )
+        db.session.add(novo_erro)
         
-        db.session.add(novo_prontuario)
-        db.session.flush()  # Para obter o ID
+        print(f"✅ Adicionado {quantidade} erro(s) do tipo: {tipo}")
+    
+    _registrar_escrita(novo_prontuario, {})
+    return novo_prontuario.id, [r.nome for r in responsaveis_encontrados]
+
+@app.route('/api/prontuarios/batch', methods=['POST'])
+@login_required
+@limite_tempo_consulta('lote')
+@invalida_cache
+def api_prontuarios_batch():
+    """
+    Lançamento em lote: lista de payloads no formato de /api/adicionar_prontuario (itens com
+    'id' atualizam o prontuário existente). Tudo é validado antes de gravar e gravado numa
+    única transação; se algum item for inválido, nada é gravado.
+    """
+    dados = request.get_json(silent=True)
+    itens = dados.get('prontuarios') if isinstance(dados, dict) else dados
+    if not isinstance(itens, list) or not itens:
+        return jsonify({'sucesso': False, 'erro': 'Envie uma lista de prontuários'}), 400
+    if len(itens) > app.config['LOTE_PRONTUARIOS_MAX']:
+        return jsonify({'sucesso': False,
+                        'erro': f"Máximo de {app.config['LOTE_PRONTUARIOS_MAX']} prontuários por lote"}), 400
+
+    # 1. Validação de todos os itens antes de tocar no banco
+    lancamentos, resultados = [], []
+    for indice, item in enumerate(itens):
+        resultado = {'indice': indice, 'sucesso': True}
+        try:
+            prontuario_id = item.get('id') if isinstance(item, dict) else None
+            if prontuario_id is not None and not str(prontuario_id).isdigit():
+                raise ValueError('id inválido')
+            prontuario_id = int(prontuario_id) if prontuario_id is not None else None
+            lancamentos.append((indice, prontuario_id, *_ler_lancamento(item, novo=prontuario_id is None)))
+        except ValueError as e:
+            resultado.update(sucesso=False, erro=str(e))
+        resultados.append(resultado)
+
+    # 2. Referências com uma consulta IN cada: responsáveis e prontuários a atualizar
+    ids_responsaveis = {r for _, _, _, responsaveis_ids, quantidades in lancamentos
+                        for r in [*responsaveis_ids, *(chave[2] for chave in quantidades)]}
+    responsaveis = {r.id: r for r in Responsavel.query.filter(Responsavel.id.in_(ids_responsaveis))}
+    existentes = {p.id: p for p in Prontuario.query.options(
+        db.selectinload(Prontuario.erros), db.selectinload(Prontuario.responsaveis)
+    ).filter(Prontuario.id.in_([pid for _, pid, *_ in lancamentos if pid is not None]))}
+    for indice, prontuario_id, _, _, quantidades in lancamentos:
+        faltantes = sorted({chave[2] for chave in quantidades} - set(responsaveis))
+        if prontuario_id is not None and prontuario_id not in existentes:
+            resultados[indice].update(sucesso=False, erro=f'Prontuário {prontuario_id} não encontrado')
+        elif faltantes:
+            resultados[indice].update(sucesso=False, erro=f'Responsável não encontrado: {faltantes}')
+    if not all(r['sucesso'] for r in resultados):
+        return jsonify({'sucesso': False, 'erro': 'Nenhum prontuário gravado: há itens inválidos',
+                        'resultados': resultados}), 400
+
+    try:
+        agora = datetime.now()
+        novos = [l for l in lancamentos if l[1] is None]
+        atualizados = [l for l in lancamentos if l[1] is not None]
+        antes, depois = defaultdict(lambda: [0, 0, 0]), defaultdict(lambda: [0, 0, 0])
 
-        # 🔥 CORREÇÃO 6: Associar responsáveis ao prontuário
-        responsaveis_encontrados = []
-        if todos_responsaveis:
-            responsaveis_encontrados = Responsavel.query.filter(
-                Responsavel.id.in_(list(todos_responsaveis))
+        # 3. Inserções em massa: prontuários (com RETURNING dos ids), erros e vínculos
+        if novos:
+            ids_novos = db.session.scalars(
+                db.insert(Prontuario).returning(Prontuario.id, sort_by_parameter_order=True),
+                [{**colunas_prontuario(campos), 'data_criacao': agora, 'data_atualizacao': agora,
+                  'erro_count': sum(quantidades.values()), 'has_erro': bool(quantidades)}
+                 for _, _, campos, _, quantidades in novos]
             ).all()
-            
-            if responsaveis_encontrados:
-                novo_prontuario.responsaveis.extend(responsaveis_encontrados)
-                print(f"✅ {len(responsaveis_encontrados)} responsável(eis) associado(s) ao prontuário")
+            erros, vinculos = [], set()
+            for (indice, _, _, responsaveis_ids, quantidades), pid in zip(novos, ids_novos):
+                resultados[indice].update(prontuario_id=pid, acao='inserido')
+                vinculos.update((pid, r) for r in responsaveis_ids if r in responsaveis)
+                for (tipo, causa, responsavel_id), quantidade in quantidades.items():
+                    vinculos.add((pid, responsavel_id))
+                    tipo_erro_id, causa_id = ids_erro(tipo, causa)
+                    erros.append({'prontuario_id': pid, 'tipo_erro_id': tipo_erro_id, 'causa_id': causa_id,
+                                  'quantidade': quantidade, 'responsavel_id': responsavel_id,
+                                  'categoria_erro_id': categoria_id_por_tipo(tipo), 'data_criacao': agora})
+            if erros:
+                db.session.execute(Erro.__table__.insert(), erros)
+            if vinculos:
+                db.session.execute(prontuario_responsavel_association.insert(),
+                                   [{'prontuario_id': p, 'responsavel_id': r} for p, r in sorted(vinculos)])
+            for p in Prontuario.query.options(db.selectinload(Prontuario.erros)).filter(Prontuario.id.in_(ids_novos)):
+                _somar_contribuicoes(depois, _contribuicoes_resumo(p))
+
+        # 4. Atualizações: só os campos enviados; 'erros' e 'responsaveis', se vierem, substituem os atuais
+        for indice, prontuario_id, campos, responsaveis_ids, quantidades in atualizados:
+            p = existentes[prontuario_id]
+            item = itens[indice]
+            _somar_contribuicoes(antes, _contribuicoes_resumo(p))
+            for campo, valor in campos.items():
+                setattr(p, campo, valor)
+            p.data_atualizacao = agora
+            ids = {chave[2] for chave in quantidades}
+            if 'responsaveis' in item:
+                ids |= set(responsaveis_ids)
+                p.responsaveis = [responsaveis[r] for r in sorted(ids) if r in responsaveis]
             else:
-                print("⚠️  Nenhum responsável encontrado com os IDs fornecidos")
-
-        # 🔥 CORREÇÃO 7: Adição de erros com quantidade
-        for erro_data in erros_processados:
-            # Buscar categoria pelo tipo de erro
-            categoria = CategoriaErro.query.filter_by(
-                nome=erro_data['tipo'], 
-                status='ativo'
-            ).first()
-            
-            # Criar múltiplos registros baseado na quantidade
-            quantidade = erro_data.get('quantidade', 1)
-            for _ in range(quantidade):
-                novo_erro = Erro(
-                    prontuario_id=novo_prontuario.id,
-                    tipo=erro_data['tipo'],
-                    causa=erro_data['causa'],
-                    responsavel_id=erro_data['responsavel_id'],
-                    categoria_erro_id=categoria.id if categoria else None
-                )
-                db.session.add(novo_erro)
-            
-            print(f"✅ Adicionado {quantidade} erro(s) do tipo: {erro_data['tipo']}")
-        
+                p.responsaveis.extend(responsaveis[r] for r in sorted(ids) if responsaveis[r] not in p.responsaveis)
+            if 'erros' in item:
+                _sincronizar_erros(p, quantidades, agora)
+            resultados[indice].update(prontuario_id=prontuario_id, acao='atualizado')
+        if atualizados:
+            db.session.flush()
+            for _, prontuario_id, *_ in atualizados:
+                p = existentes[prontuario_id]
+                db.session.expire(p, ['erros'])
+                _sincronizar_contadores_erro(p)
+                _somar_contribuicoes(depois, _contribuicoes_resumo(p))
+
+        _atualizar_resumo(antes, depois)
         db.session.commit()
-        
-        print(f"✅ PRONTUÁRIO SALVO NO BD! ID: {novo_prontuario.id}")
-        print(f"📝 RESPONSÁVEIS ASSOCIADOS: {[r.nome for r in responsaveis_encontrados]}")
-        print(f"📝 TOTAL DE ERROS ASSOCIADOS: {len(erros_processados)} registros")
-        
-        return jsonify({
-            'sucesso': True, 
-            'prontuario_id': novo_prontuario.id,
-            'mensagem': f'Prontuário salvo com {len(responsaveis_encontrados)} responsável(eis) e {len(erros_processados)} tipo(s) de erro'
-        })
-        
     except Exception as e:
         db.session.rollback()
-        print("❌ ERRO AO ADICIONAR PRONTUÁRIO NO BD:", str(e))
-        import traceback
+        print("❌ ERRO NO LANÇAMENTO EM LOTE:", str(e))
         traceback.print_exc()
         return jsonify({'sucesso': False, 'erro': str(e)}), 500
 
+    print(f"✅ Lote gravado: {len(novos)} inseridos, {len(atualizados)} atualizados")
+    return jsonify({'sucesso': True, 'inseridos': len(novos), 'atualizados': len(atualizados),
+                    'resultados': resultados})
+
 # 🔥 FUNÇÃO AUXILIAR PARA PROCESSAR DATAS
 def _parse_any_date(date_str):
     """Converte string de data para objeto date, lidando com vários formatos"""
@@ -1600,8 +4469,7 @@ def _parse_any_date(date_str):
 def api_categorias_erro():
     """Retorna todas as categorias de erro"""
     try:
-        categorias = CategoriaErro.query.filter_by(status='ativo').order_by(CategoriaErro.nome).all()
-        return jsonify([cat.to_dict() for cat in categorias])
+        return jsonify(categorias_erro_ativas())
     except Exception as e:
         return jsonify({'erro': str(e)}), 500
 
@@ -1634,7 +4502,7 @@ def api_prontuario_dados(prontuario_id):
             return jsonify({'erro': 'Prontuário não encontrado'}), 404
         
         return jsonify({
-            'erros': [{'tipo': e.tipo, 'causa': e.causa} for e in prontuario.erros],
+            'erros': [{'tipo': e.tipo, 'causa': e.causa, 'quantidade': e.quantidade} for e in prontuario.erros],
             'responsaveis': [r.nome for r in prontuario.responsaveis]
         })
     except Exception as e:
@@ -1642,6 +4510,7 @@ def api_prontuario_dados(prontuario_id):
 
 @app.route('/api/atualizar_erros_responsavel/<int:prontuario_id>', methods=['POST'])
 @login_required
+@invalida_cache
 def api_atualizar_erros_responsavel(prontuario_id):
     try:
         prontuario = Prontuario.query.get(prontuario_id)
@@ -1649,40 +4518,53 @@ def api_atualizar_erros_responsavel(prontuario_id):
             return jsonify({'sucesso': False, 'erro': 'Prontuário não encontrado'}), 404
 
         dados = request.get_json()
+        antes = _contribuicoes_resumo(prontuario)
+        agora = datetime.now()
+        tocados = Counter()
         
         if 'responsaveis' in dados:
             nomes_responsaveis = dados.get('responsaveis', [])
             if not isinstance(nomes_responsaveis, list):
                  nomes_responsaveis = [nomes_responsaveis]
             
-            prontuario.responsaveis.clear() 
-            if nomes_responsaveis:
-                responsaveis_encontrados = Responsavel.query.filter(Responsavel.nome.in_(nomes_responsaveis)).all()
-                prontuario.responsaveis.extend(responsaveis_encontrados)
+            desejados = Responsavel.query.filter(Responsavel.nome.in_(nomes_responsaveis)).all() if nomes_responsaveis else []
+            for r in [r for r in prontuario.responsaveis if r not in desejados]:
+                prontuario.responsaveis.remove(r)
+                tocados['responsaveis'] += 1
+            for r in desejados:
+                if r not in prontuario.responsaveis:
+                    prontuario.responsaveis.append(r)
+                    tocados['responsaveis'] += 1
         
         if 'erros' in dados:
-            Erro.query.filter_by(prontuario_id=prontuario_id).delete()
-            
+            # Diff contra as linhas atuais: só grava inserções, alterações e remoções reais
+            quantidades = Counter()
             for erro_data in dados['erros']:
                 if erro_data.get('tipo') and erro_data.get('causa'):
-                    novo_erro = Erro(
-                        prontuario_id=prontuario_id,
-                        tipo=erro_data['tipo'],
-                        causa=erro_data['causa']
-                    )
-                    db.session.add(novo_erro)
+                    ids_erro(erro_data['tipo'], erro_data['causa'])  # ValueError fora dos cadastros
+                    responsavel_id = erro_data.get('responsavel_id')
+                    chave = (erro_data['tipo'], erro_data['causa'], int(responsavel_id) if responsavel_id else None)
+                    quantidades[chave] += max(1, int(erro_data.get('quantidade') or 1))
+            tocados.update(_sincronizar_erros(prontuario, quantidades, agora))
         
-        prontuario.data_atualizacao = datetime.now()
-        db.session.commit()
+        if tocados:
+            prontuario.data_atualizacao = agora
+            _registrar_escrita(prontuario, antes)
+            db.session.commit()
         
-        return jsonify({'sucesso': True})
+        return jsonify({'sucesso': True, 'inseridos': tocados['inseridos'], 'atualizados': tocados['atualizados'],
+                        'removidos': tocados['removidos'], 'responsaveis_alterados': tocados['responsaveis']})
         
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'sucesso': False, 'erro': str(e)}), 400
     except Exception as e:
         db.session.rollback()
         return jsonify({'sucesso': False, 'erro': str(e)}), 500
 
 @app.route('/api/adicionar_erro_unico/<int:prontuario_id>', methods=['POST'])
 @login_required
+@invalida_cache
 def api_adicionar_erro_unico(prontuario_id):
     try:
         dados = request.get_json()
@@ -1691,60 +4573,114 @@ def api_adicionar_erro_unico(prontuario_id):
         
         if not tipo_erro or not causa:
             return jsonify({'sucesso': False, 'erro': 'Tipo e causa são obrigatórios'}), 400
+        try:
+            ids_erro(tipo_erro, causa)
+        except ValueError as e:
+            return jsonify({'sucesso': False, 'erro': str(e)}), 400
         
-        prontuario = Prontuario.query.get(prontuario_id)
-        if not prontuario:
+        if not executar_escrita(_gravar_erro_unico, prontuario_id, tipo_erro, causa):
             return jsonify({'sucesso': False, 'erro': 'Prontuário não encontrado'}), 404
         
+        return jsonify({'sucesso': True})
+        
+    except Exception as e:
+        return jsonify({'sucesso': False, 'erro': str(e)}), 500
+
+def _gravar_erro_unico(prontuario_id, tipo_erro, causa):
+    prontuario = db.session.get(Prontuario, prontuario_id)
+    if not prontuario:
+        return False
+    
+    antes = _contribuicoes_resumo(prontuario)
+    # Mesmo erro já lançado hoje: só soma a ocorrência
+    existente = next((e for e in prontuario.erros
+                      if e.tipo == tipo_erro and e.causa == causa and e.responsavel_id is None
+                      and _dia(e.data_criacao) == date.today()), None)
+    if existente:
+        existente.quantidade += 1
+    else:
         novo_erro = Erro(
             prontuario_id=prontuario_id,
             tipo=tipo_erro,
             causa=causa
         )
         db.session.add(novo_erro)
-        
-        prontuario.data_atualizacao = datetime.now()
-        db.session.commit()
-        
-        return jsonify({'sucesso': True})
-        
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({'sucesso': False, 'erro': str(e)}), 500
+    
+    prontuario.data_atualizacao = datetime.now()
+    _registrar_escrita(prontuario, antes)
+    return True
 
 @app.route('/api/remover_erro_unico/<int:prontuario_id>', methods=['POST'])
 @login_required
+@invalida_cache
 def api_remover_erro_unico(prontuario_id):
     try:
         dados = request.get_json()
         tipo_erro = dados.get('tipo_erro')
         causa = dados.get('causa')
         
-        prontuario = Prontuario.query.get(prontuario_id)
-        if not prontuario:
+        resultado = executar_escrita(_remover_erro_unico, prontuario_id, tipo_erro, causa)
+        if resultado is None:
             return jsonify({'sucesso': False, 'erro': 'Prontuário não encontrado'}), 404
-            
-        erro = Erro.query.filter_by(
-            prontuario_id=prontuario_id,
-            tipo=tipo_erro,
-            causa=causa
-        ).first()
-        
-        if erro:
-            db.session.delete(erro)
-            prontuario.data_atualizacao = datetime.now()
-            db.session.commit()
-            return jsonify({'sucesso': True})
-        else:
+        if not resultado:
             return jsonify({'sucesso': False, 'erro': 'Erro não encontrado para remover'}), 404
+        return jsonify({'sucesso': True})
             
     except Exception as e:
-        db.session.rollback()
+        return jsonify({'sucesso': False, 'erro': str(e)}), 500
+
+def _remover_erro_unico(prontuario_id, tipo_erro, causa):
+    """Remove uma ocorrência; None se o prontuário não existe, False se o erro não existe"""
+    prontuario = db.session.get(Prontuario, prontuario_id)
+    if not prontuario:
+        return None
+        
+    erro = Erro.query.filter_by(
+        prontuario_id=prontuario_id,
+        tipo=tipo_erro,
+        causa=causa
+    ).first()
+    if not erro:
+        return False
+    
+    antes = _contribuicoes_resumo(prontuario)
+    # A linha só sai quando era a última ocorrência
+    if erro.quantidade > 1:
+        erro.quantidade -= 1
+    else:
+        db.session.delete(erro)
+    prontuario.data_atualizacao = datetime.now()
+    _registrar_escrita(prontuario, antes)
+    return True
+
+@app.route('/api/importar_planilha', methods=['POST'])
+@login_required
+@limite_tempo_consulta('lote')
+@invalida_cache
+@invalida_catalogos
+def api_importar_planilha():
+    arquivo = request.files.get('arquivo')
+    if not arquivo or not arquivo.filename:
+        return jsonify({'sucesso': False, 'erro': 'Nenhum arquivo enviado'}), 400
+    if not arquivo.filename.lower().endswith('.xlsx'):
+        return jsonify({'sucesso': False, 'erro': 'Envie um arquivo .xlsx'}), 400
+    
+    try:
+        resumo = importar_planilha(arquivo.stream, aba=request.form.get('aba') or None,
+                                   criar_cadastros=request.form.get('criar_cadastros') in ('1', 'on', 'true'))
+        return jsonify({'sucesso': True, 'resumo': resumo})
+    except ValueError as e:
+        return jsonify({'sucesso': False, 'erro': str(e)}), 400
+    except Exception as e:
+        print(f"❌ Erro ao importar planilha {arquivo.filename}: {e}")
+        traceback.print_exc()
         return jsonify({'sucesso': False, 'erro': str(e)}), 500
 
 # --- 7. APIs DE CONFIGURAÇÕES ---
 @app.route('/api/configuracoes/<string:tipo>', methods=['GET', 'POST'])
 @login_required
+@invalida_cache
+@invalida_catalogos
 def api_configuracoes(tipo):
     model_map = {
         'convenios': Convenio,
@@ -1777,6 +4713,12 @@ def api_configuracoes(tipo):
                 if tipo == 'responsaveis':
                     item.funcao = dados.get('funcao', '')
                     item.setor_resp = dados.get('setor', '') 
+            elif tipo != 'responsaveis' and Model.query.filter_by(nome=dados['nome']).first():
+                # Nome que já veio de uma importação ou da migração (cadastrado como inativo): reaproveita o item
+                item = Model.query.filter_by(nome=dados['nome']).first()
+                item.status = dados.get('status', 'ativo')
+                if tipo == 'setores':
+                    item.descricao = dados.get('descricao', '')
             else:
                 if tipo == 'convenios':
                     item = Convenio(nome=dados['nome'], status=dados.get('status', 'ativo'))
@@ -1794,6 +4736,8 @@ def api_configuracoes(tipo):
 
 @app.route('/api/configuracoes/<string:tipo>/<int:item_id>', methods=['DELETE'])
 @login_required
+@invalida_cache
+@invalida_catalogos
 def api_excluir_configuracao(tipo, item_id):
     model_map = {
         'convenios': Convenio,
@@ -1811,6 +4755,8 @@ def api_excluir_configuracao(tipo, item_id):
         item = Model.query.get(item_id)
         if not item:
             return jsonify({'sucesso': False, 'erro': 'Item não encontrado'}), 404
+        if _cadastro_em_uso(item):
+            return jsonify({'sucesso': False, 'erro': 'Item usado em prontuários/erros: inative-o em vez de excluir'}), 409
         
         db.session.delete(item)
         db.session.commit()
@@ -1819,8 +4765,29 @@ def api_excluir_configuracao(tipo, item_id):
         db.session.rollback()
         return jsonify({'sucesso': False, 'erro': str(e)}), 500
 
+def _cadastro_em_uso(item):
+    """Convênio, setor, tipo de erro ou causa referenciado por algum prontuário/erro (FK do dicionário)"""
+    if isinstance(item, Convenio):
+        uso = db.select(Prontuario.id).where(Prontuario.convenio_id == item.id)
+    elif isinstance(item, Setor):
+        uso = db.select(Prontuario.id).where(Prontuario.setor_id == item.id)
+    elif isinstance(item, TipoErro):
+        # As causas do tipo saem junto (cascade), então contam também
+        uso = db.select(Erro.id).where(db.or_(Erro.tipo_erro_id == item.id,
+                                              Erro.causa_id.in_(db.select(Causa.id).where(Causa.tipo_erro_id == item.id))))
+    elif isinstance(item, Causa):
+        uso = db.select(Erro.id).where(Erro.causa_id == item.id)
+    else:
+        return False
+    if db.session.scalar(uso.limit(1)) is not None:
+        return True
+    # Os arquivados leem o texto do cadastro pelo dicionário do banco quente
+    return estado_arquivo() is not None and consultar_arquivo(lambda sessao: sessao.scalar(uso.limit(1))) is not None
+
 @app.route('/api/configuracoes/causas', methods=['GET', 'POST'])
 @login_required
+@invalida_cache
+@invalida_catalogos
 def api_causas():
     if request.method == 'GET':
         items = Causa.query.join(TipoErro).order_by(TipoErro.nome, Causa.descricao).all()
@@ -1840,12 +4807,16 @@ def api_causas():
                 item.tipo_erro_id = dados['tipo_erro_id']
                 item.status = dados.get('status', 'ativo')
             else:
-                item = Causa(
-                    descricao=dados['descricao'],
-                    tipo_erro_id=dados['tipo_erro_id'],
-                    status=dados.get('status', 'ativo')
-                )
-                db.session.add(item)
+                item = Causa.query.filter_by(descricao=dados['descricao'], tipo_erro_id=dados['tipo_erro_id']).first()
+                if item:
+                    item.status = dados.get('status', 'ativo')  # já cadastrada por uma importação
+                else:
+                    item = Causa(
+                        descricao=dados['descricao'],
+                        tipo_erro_id=dados['tipo_erro_id'],
+                        status=dados.get('status', 'ativo')
+                    )
+                    db.session.add(item)
             
             db.session.commit()
             return jsonify({'sucesso': True, 'item': item.to_dict()})
@@ -1855,6 +4826,8 @@ def api_causas():
 
 @app.route('/api/configuracoes/tipos_erro', methods=['GET', 'POST'])
 @login_required
+@invalida_cache
+@invalida_catalogos
 def api_tipos_erro():
     if request.method == 'GET':
         items = TipoErro.query.order_by(TipoErro.nome).all()
@@ -1876,15 +4849,14 @@ def api_tipos_erro():
                 item.status = dados.get('status', 'ativo')
             else:
                 existente = TipoErro.query.filter_by(nome=dados['nome']).first()
-                if existente:
+                if existente and existente.status == 'ativo':
                     return jsonify({'sucesso': False, 'erro': 'Já existe um motivo com este código.'}), 409
                     
-                item = TipoErro(
-                    nome=dados['nome'],
-                    descricao=dados.get('descricao', ''),
-                    cor=dados.get('cor', '#dc3545'),
-                    status=dados.get('status', 'ativo')
-                )
+                # Código inativo (ex.: cadastrado por uma importação): reaproveita o item
+                item = existente or TipoErro(nome=dados['nome'])
+                item.descricao = dados.get('descricao', '')
+                item.cor = dados.get('cor', '#dc3545')
+                item.status = dados.get('status', 'ativo')
                 db.session.add(item)
             
             db.session.commit()
@@ -1895,6 +4867,8 @@ def api_tipos_erro():
 
 @app.route('/api/popular_causas', methods=['POST'])
 @login_required
+@invalida_cache
+@invalida_catalogos
 def popular_causas_padrao():
     DADOS_PADRAO = {
         '01.01': {
@@ -1915,26 +4889,27 @@ def popular_causas_padrao():
     }
 
     try:
-        db.session.query(Causa).delete()
-        db.session.query(TipoErro).delete()
+        # Tipos e causas referenciados por erros não podem sair (são FK): ficam inativos
+        causas_usadas = db.select(Erro.causa_id)
+        tipos_usados = db.select(Erro.tipo_erro_id).union(db.select(Causa.tipo_erro_id).where(Causa.id.in_(causas_usadas)))
+        db.session.query(Causa).filter(Causa.id.not_in(causas_usadas)).delete(synchronize_session=False)
+        db.session.query(TipoErro).filter(TipoErro.id.not_in(tipos_usados)).delete(synchronize_session=False)
+        db.session.query(Causa).update({'status': 'inativo'}, synchronize_session=False)
+        db.session.query(TipoErro).update({'status': 'inativo'}, synchronize_session=False)
         db.session.commit()
 
         for codigo, info in DADOS_PADRAO.items():
-            tipo_erro = TipoErro(
-                nome=codigo,
-                descricao=info['nome'],
-                cor=info['cor'],
-                status='ativo'
-            )
+            tipo_erro = TipoErro.query.filter_by(nome=codigo).first() or TipoErro(nome=codigo)
+            tipo_erro.descricao = info['nome']
+            tipo_erro.cor = info['cor']
+            tipo_erro.status = 'ativo'
             db.session.add(tipo_erro)
             db.session.flush()
 
             for desc_causa in info['causas']:
-                causa = Causa(
-                    descricao=desc_causa,
-                    status='ativo',
-                    tipo_erro_id=tipo_erro.id
-                )
+                causa = (Causa.query.filter_by(descricao=desc_causa, tipo_erro_id=tipo_erro.id).first()
+                         or Causa(descricao=desc_causa, tipo_erro_id=tipo_erro.id))
+                causa.status = 'ativo'
                 db.session.add(causa)
         
         db.session.commit()
@@ -1947,19 +4922,15 @@ def popular_causas_padrao():
 @app.route('/configuracoes')
 @login_required
 def configuracoes():
-    convenios = [c.to_dict() for c in Convenio.query.order_by(Convenio.nome).all()]
-    setores = [s.to_dict() for s in Setor.query.order_by(Setor.nome).all()]
-    responsaveis = [r.to_dict() for r in Responsavel.query.order_by(Responsavel.nome).all()]
-    
-    tipos_erro_lista = [t.to_dict() for t in TipoErro.query.order_by(TipoErro.nome).all()]
+    catalogo = catalogo_configuracoes()
     tipos_erro_dict = get_tipos_erro_dict() 
     
     return render_template(
         'configuracoes.html',
-        convenios=convenios,
-        setores=setores,
-        responsaveis=responsaveis,
-        tipos_erro_lista=tipos_erro_lista,
+        convenios=catalogo['convenios'],
+        setores=catalogo['setores'],
+        responsaveis=catalogo['responsaveis'],
+        tipos_erro_lista=catalogo['tipos_erro_lista'],
         tipos_erro=tipos_erro_dict
     )
 
@@ -1971,16 +4942,15 @@ def alimentacao():
         print("🔍 Carregando dados para a página de alimentação...")
         
         # Carregar convenios
-        convenios = [c.nome for c in Convenio.query.filter_by(status='ativo').order_by(Convenio.nome).all()]
+        convenios = nomes_ativos(Convenio)
         print(f"✅ Convenios carregados: {len(convenios)}")
         
         # Carregar setores
-        setores = [s.nome for s in Setor.query.filter_by(status='ativo').order_by(Setor.nome).all()]
+        setores = nomes_ativos(Setor)
         print(f"✅ Setores carregados: {len(setores)}")
         
         # Carregar responsáveis como OBJETOS (id, nome)
-        responsaveis_db = Responsavel.query.filter_by(status='ativo').order_by(Responsavel.nome).all()
-        responsaveis = [{'id': r.id, 'nome': r.nome} for r in responsaveis_db]
+        responsaveis = responsaveis_ativos()
         
         print(f"✅ Responsáveis carregados: {len(responsaveis)}")
         
@@ -2013,19 +4983,31 @@ def alimentacao():
 # --- 8. INICIALIZAÇÃO DA APLICAÇÃO ---
 if __name__ == '__main__':
     with app.app_context():
-        print("Verificando e criando banco de dados se necessário...")
+        print("Verificando versão do schema do banco de dados...")
         try:
-            db.create_all()
-            print(f"Banco de dados está em: {db_path}")
+            print(f"Banco de dados está em: {db.engine.url.render_as_string(hide_password=True)}")
+            
+            # Só compara a versão; o schema só é mexido se houver migração pendente
+            versao = versao_schema()
+            if versao >= VERSAO_SCHEMA_ATUAL:
+                print(f"Schema na versão {versao}, nada a migrar.")
+            elif app.config['MIGRAR_SCHEMA_AO_INICIAR']:
+                print(f"Schema na versão {versao}, aplicando migrações até a {VERSAO_SCHEMA_ATUAL}...")
+                migrar_schema()
+            else:
+                print(f"ALERTA: schema na versão {versao}, o app espera a {VERSAO_SCHEMA_ATUAL}. "
+                      f"Rode 'python atualizar_banco.py'.")
+            
+            # Índice FTS5 da busca (cria triggers e faz a carga inicial se preciso)
+            configurar_busca_textual()
             
-            inspector = db.inspect(db.engine)
-            tabelas = inspector.get_table_names()
-            print(f"Tabelas encontradas: {tabelas}")
-            if 'prontuario' not in tabelas:
-                 print("ALERTA: Tabela 'prontuario' não foi criada. Verifique as permissões.")
+            manutencao_sqlite(analisar=True)
                  
         except Exception as e:
             print(f"ERRO CRÍTICO AO INICIAR O BANCO DE DADOS: {e}")
             print("Verifique se o diretório 'data' tem permissão de escrita.")
     
+    # Com o reloader do debug, só o processo que serve as requisições agenda a manutenção
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        iniciar_manutencao_sqlite()
     app.run(debug=True, host='0.0.0.0', port=5006)
\ No newline at end of file
@@ -0,0 +1,34 @@
+import sys
+import time
+import argparse
+from app import app, migrar_schema, arquivar_prontuarios, estado_arquivo
+
+# Move para o banco de arquivo (data/arquivo.db ou ARQUIVO_DATABASE_URL) os prontuários
+# 'Entregue ao Faturamento' entregues há mais de ARQUIVO_IDADE_DIAS dias. Seguro rodar
+# de novo (inclusive depois de uma rodada interrompida); bom para agendar no cron.
+#   python arquivar_prontuarios.py
+#   python arquivar_prontuarios.py --idade-dias 365 --simular
+
+parser = argparse.ArgumentParser(description="Arquiva prontuários entregues ao faturamento")
+parser.add_argument('--idade-dias', type=int, default=app.config['ARQUIVO_IDADE_DIAS'],
+                    help="dias desde a entrega para arquivar (padrão: ARQUIVO_IDADE_DIAS)")
+parser.add_argument('--lote', type=int, default=app.config['ARQUIVO_LOTE'], help="prontuários por transação")
+parser.add_argument('--simular', action='store_true', help="só conta quantos seriam arquivados")
+args = parser.parse_args()
+
+with app.app_context():
+    migrar_schema()
+    if args.simular:
+        total = arquivar_prontuarios(args.idade_dias, args.lote, simular=True)
+        print(f"{total} prontuários seriam arquivados (entregues há mais de {args.idade_dias} dias).")
+    else:
+        print(f"Arquivando prontuários entregues há mais de {args.idade_dias} dias...")
+        inicio = time.perf_counter()
+        try:
+            total = arquivar_prontuarios(args.idade_dias, args.lote)
+        except RuntimeError as e:
+            print(f"❌ {e}")
+            sys.exit(1)
+        estado = estado_arquivo()
+        print(f"Sucesso! {total} prontuários arquivados em {time.perf_counter() - inicio:.1f}s; "
+              f"arquivo com {estado.total if estado else 0} prontuários.")
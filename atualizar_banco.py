@@ -1,10 +1,22 @@
-from app import app, db
-# O Flask é inteligente: o create_all só cria o que está faltando.
-# Ele vai ignorar as tabelas que já existem e criar apenas a tabela de usuário.
+import argparse
+from app import app, migrar_schema, versao_schema, MIGRACOES_SCHEMA, VERSAO_SCHEMA_ATUAL
 
-print("Iniciando atualização do banco de dados...")
+# Aplica as migrações de schema pendentes (tabela schema_version). Seguro rodar várias vezes:
+# cada migração roda uma vez só. Use --status para só ver a versão atual e o que falta.
+#   python atualizar_banco.py
+#   python atualizar_banco.py --status
+
+parser = argparse.ArgumentParser(description="Migrações de schema do banco do app")
+parser.add_argument('--status', action='store_true', help="só mostra a versão atual e as migrações pendentes")
+args = parser.parse_args()
 
 with app.app_context():
-    db.create_all()
-    print("Sucesso! As tabelas novas foram criadas.")
-    print("Seus dados antigos continuam lá.")
\ No newline at end of file
+    versao = versao_schema()
+    pendentes = [(v, d) for v, d, _ in MIGRACOES_SCHEMA if v > versao]
+    print(f"Schema na versão {versao} (app espera a {VERSAO_SCHEMA_ATUAL}).")
+    if args.status:
+        for v, descricao in pendentes:
+            print(f"  pendente: {v} - {descricao}")
+    else:
+        aplicadas = migrar_schema()
+        print(f"Sucesso! {len(aplicadas)} migrações aplicadas, schema na versão {versao_schema()}.")
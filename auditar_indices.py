@@ -0,0 +1,217 @@
+# auditar_indices.py
+# Auditoria de índices: chama cada rota GET do app (com o test client, sem login), captura os
+# SELECTs que ela manda ao banco e roda EXPLAIN QUERY PLAN (SQLite) ou EXPLAIN (PostgreSQL) em
+# cada um, apontando as leituras que varrem a tabela inteira.
+#
+#   python auditar_indices.py                    # todas as rotas, banco do app (ou DATABASE_URL)
+#   python auditar_indices.py --rota /prontuarios --sql
+#   python auditar_indices.py --min-linhas 0     # aponta varredura até em tabela pequena
+#
+# Varreduras em tabelas com menos de --min-linhas linhas (cadastros) saem como aviso, sem
+# contar como problema. Sai com código 1 se alguma rota fizer varredura completa em tabela
+# grande, então serve também para conferir o banco depois de uma migração de schema.
+import io
+import re
+import sys
+import argparse
+import contextlib
+from collections import defaultdict
+from urllib.parse import urlencode, urlsplit
+from sqlalchemy import event, text, func
+from app import (app, db, cache_resultados, cache_referencia, Prontuario, Responsavel,
+                 CategoriaErro, Convenio, Setor, STATUS_OPCOES, migrar_schema)
+
+MIN_LINHAS = 1000
+ROTAS_IGNORADAS = {'/login', '/logout', '/registrar_admin'}
+# Endpoints que leem a tabela inteira de propósito quando chamados sem filtro: a varredura sai
+# como aviso, não como problema
+VARREDURAS_ESPERADAS = {
+    'index': "painel sem filtro de período agrega a base toda",
+    'api_dashboard_data': "estatísticas da base toda (StatsAccumulator)",
+    'debug_verificar_erros': "dump de diagnóstico",
+    'debug_prontuarios_com_erros': "dump de diagnóstico",
+}
+
+
+def _exemplos():
+    """Valores reais do banco para preencher os parâmetros das rotas e os filtros"""
+    primeiro = lambda coluna: (db.session.query(coluna).filter(func.trim(coluna) != '')
+                               .order_by(coluna).limit(1).scalar())
+    return {
+        'prontuario_id': db.session.query(Prontuario.id).order_by(Prontuario.id.desc()).limit(1).scalar() or 1,
+        'responsavel_id': db.session.query(func.min(Responsavel.id)).scalar() or 1,
+        'categoria_codigo': primeiro(CategoriaErro.codigo) or 'X',
+        'responsavel': primeiro(Responsavel.nome) or '',
+        'convenio': primeiro(Convenio.nome) or '',
+        'setor': primeiro(Setor.nome) or '',
+    }
+
+
+def rotas_auditadas(exemplos):
+    """URLs a chamar: toda rota GET, mais as variações de filtro das telas de listagem"""
+    valores = {
+        'prontuario_id': exemplos['prontuario_id'],
+        'responsavel_id': exemplos['responsavel_id'],
+        'categoria_codigo': exemplos['categoria_codigo'],
+        'formato': ['csv', 'xlsx'],
+        'tipo': ['convenios', 'setores', 'responsaveis'],
+    }
+    urls = []
+    with app.test_request_context():
+        from flask import url_for
+        for regra in sorted(app.url_map.iter_rules(), key=lambda r: r.rule):
+            if 'GET' not in regra.methods or regra.endpoint == 'static' or regra.rule in ROTAS_IGNORADAS:
+                continue
+            argumentos = sorted(regra.arguments)
+            if any(a not in valores for a in argumentos):
+                print(f"⚠️  {regra.rule}: sem valor de exemplo para {argumentos}, rota ignorada")
+                continue
+            combinacoes = [{}]
+            for a in argumentos:
+                opcoes = valores[a] if isinstance(valores[a], list) else [valores[a]]
+                combinacoes = [dict(c, **{a: v}) for c in combinacoes for v in opcoes]
+            urls.extend(url_for(regra.endpoint, **c) for c in combinacoes)
+
+    filtros = [
+        {'status': STATUS_OPCOES[0]},
+        {'convenio': exemplos['convenio']},
+        {'setor': exemplos['setor']},
+        {'responsavel': exemplos['responsavel']},
+        {'erros': 'com'},
+        {'status': STATUS_OPCOES[-1], 'data_inicio': '2024-01-01', 'data_fim': '2024-12-31'},
+    ]
+    for filtro in filtros:
+        consulta = urlencode({k: v for k, v in filtro.items() if v.strip()})
+        if consulta:
+            urls.append(f'/prontuarios?{consulta}')
+    urls += ['/?ano=2024', '/?periodo=mes', '/relatorios?ano=2024', '/relatorios?ano=2024&mes=6',
+             '/api/prontuarios/busca?q=ab']
+    return urls
+
+
+def capturar_consultas(cliente, motor, url):
+    """Chama a rota e devolve (status, [(sql, parâmetros)]) dos SELECTs que ela executou"""
+    consultas = []
+
+    def _registrar(conn, cursor, statement, parameters, context, executemany):
+        inicio = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ''
+        if inicio in ('SELECT', 'WITH') and not executemany:
+            consultas.append((statement, parameters))
+
+    cache_resultados.limpar()
+    cache_referencia.limpar()
+    event.listen(motor, 'before_cursor_execute', _registrar)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            resposta = cliente.get(url)
+    finally:
+        event.remove(motor, 'before_cursor_execute', _registrar)
+    unicas = {}
+    for statement, parameters in consultas:
+        unicas.setdefault(statement, parameters)
+    return resposta.status_code, list(unicas.items())
+
+
+def plano(conexao, statement, parameters):
+    """Linhas do plano de execução da consulta"""
+    if conexao.dialect.name == 'sqlite':
+        return [linha[-1] for linha in conexao.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters)]
+    return [linha[0] for linha in conexao.exec_driver_sql('EXPLAIN ' + statement, parameters)]
+
+
+_VARREDURA_SQLITE = re.compile(r'^SCAN (\S+)(.*)$')
+_VARREDURA_PG = re.compile(r'Seq Scan on (\S+)')
+
+
+def varreduras(dialeto, linhas_plano):
+    """Tabelas lidas por inteiro no plano (SCAN sem índice / Seq Scan); subconsultas (anon_N) não contam"""
+    tabelas = []
+    for linha in linhas_plano:
+        if dialeto == 'sqlite':
+            achado = _VARREDURA_SQLITE.match(linha.strip())
+            if achado and 'USING' not in achado.group(2) and 'VIRTUAL TABLE' not in achado.group(2) \
+                    and not achado.group(1).startswith(('(', 'anon_')) and achado.group(1) != 'CONSTANT':
+                tabelas.append(achado.group(1))
+        else:
+            tabelas += _VARREDURA_PG.findall(linha)
+    return tabelas
+
+
+def _tabela_real(nome, tamanhos):
+    """O plano pode trazer o alias do SQLAlchemy (prontuario_1, anon_1); volta ao nome da tabela"""
+    if nome in tamanhos:
+        return nome
+    sem_sufixo = re.sub(r'_\d+$', '', nome)
+    return sem_sufixo if sem_sufixo in tamanhos else nome
+
+
+def main(filtro_rota=None, min_linhas=MIN_LINHAS, mostrar_sql=False):
+    app.config['LOGIN_DISABLED'] = True
+    with app.app_context():
+        migrar_schema()
+        motor = db.engine
+        dialeto = motor.dialect.name
+        tamanhos = {t.name: db.session.execute(text(f'SELECT COUNT(*) FROM {t.name}')).scalar()
+                    for t in db.metadata.sorted_tables}
+        exemplos = _exemplos()
+        db.session.commit()
+
+    urls = [u for u in rotas_auditadas(exemplos) if not filtro_rota or u.startswith(filtro_rota)]
+    print(f"=== AUDITORIA DE ÍNDICES ({dialeto}, {len(urls)} rotas) ===")
+    cliente = app.test_client()
+    rotas = app.url_map.bind('localhost')
+    problemas = defaultdict(set)
+    total_consultas = 0
+    for url in urls:
+        status, consultas = capturar_consultas(cliente, motor, url)
+        total_consultas += len(consultas)
+        endpoint, _ = rotas.match(urlsplit(url).path)
+        esperada = VARREDURAS_ESPERADAS.get(endpoint) if urlsplit(url).query == '' else None
+        achados = []
+        with motor.connect() as conexao:
+            for statement, parameters in consultas:
+                try:
+                    linhas = plano(conexao, statement, parameters)
+                except Exception as e:
+                    conexao.rollback()
+                    achados.append(('❓', f"plano indisponível: {str(e).splitlines()[0]}", statement, []))
+                    continue
+                for nome in varreduras(dialeto, linhas):
+                    tabela = _tabela_real(nome, tamanhos)
+                    linhas_tabela = tamanhos.get(tabela)
+                    grande = (linhas_tabela is None or linhas_tabela >= min_linhas) and not esperada
+                    if grande:
+                        problemas[tabela].add(url)
+                    mensagem = f"varredura completa em {tabela} ({linhas_tabela if linhas_tabela is not None else '?'} linhas)"
+                    if esperada:
+                        mensagem += f" - esperada: {esperada}"
+                    achados.append(('❌' if grande else 'ℹ️ ', mensagem, statement, linhas))
+            conexao.rollback()
+
+        marcador = '❌' if any(a[0] == '❌' for a in achados) else '✅'
+        print(f"{marcador} {url} [{status}] {len(consultas)} consultas")
+        for icone, mensagem, statement, linhas in achados:
+            print(f"     {icone} {mensagem}")
+            if mostrar_sql:
+                print('        ' + ' '.join(statement.split())[:400])
+                for linha in linhas:
+                    print(f"          | {linha}")
+
+    print(f"📊 {total_consultas} consultas em {len(urls)} rotas")
+    if not problemas:
+        print(f"✅ Nenhuma varredura completa em tabela com {min_linhas}+ linhas")
+        return 0
+    print("❌ Varreduras completas em tabelas grandes:")
+    for tabela, rotas in sorted(problemas.items()):
+        print(f"   {tabela} ({tamanhos.get(tabela, '?')} linhas): {', '.join(sorted(rotas))}")
+    return 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Roda EXPLAIN nos SELECTs de cada rota e aponta varreduras completas")
+    parser.add_argument('--rota', help="só as URLs que começam com este prefixo (ex.: /prontuarios)")
+    parser.add_argument('--min-linhas', type=int, default=MIN_LINHAS,
+                        help="tabelas menores que isso só geram aviso (padrão: 1000)")
+    parser.add_argument('--sql', action='store_true', help="mostra o SQL e o plano de cada varredura")
+    args = parser.parse_args()
+    sys.exit(main(args.rota, args.min_linhas, args.sql))
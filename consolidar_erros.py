@@ -0,0 +1,12 @@
+from app import app, migrar_schema, consolidar_erros_duplicados
+
+# Junta as linhas repetidas da tabela erro (o mesmo erro lançado N vezes) numa linha com
+# quantidade = N. Rode uma vez em bancos criados antes da coluna erro.quantidade, ou depois
+# de cargas do migrar_dados.py. Totais do dashboard e contadores não mudam.
+
+print("Iniciando consolidação dos erros repetidos...")
+
+with app.app_context():
+    migrar_schema()
+    removidas = consolidar_erros_duplicados()
+    print(f"Sucesso! {removidas} linhas removidas.")
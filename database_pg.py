@@ -1,9 +1,11 @@
-import os
 from sqlalchemy import create_engine, text
 
-DATABASE_URL = os.getenv("DATABASE_URL")  # Vem do Vercel
+from app import app
 
-engine = create_engine(DATABASE_URL, future=True)
+# Mesma URL e mesmo pool (QueuePool, pre_ping, recycle, statement_timeout) do app.py
+DATABASE_URL = app.config['SQLALCHEMY_DATABASE_URI']  # DATABASE_URL vem do Vercel
+
+engine = create_engine(DATABASE_URL, **app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
 
 def query(sql, params=None):
     with engine.connect() as conn:
@@ -0,0 +1,25 @@
+import argparse
+from app import app, migrar_schema, importar_planilha
+
+# Importa uma planilha .xlsx de auditoria (uma linha por erro) para o banco do app.
+# Reimportar a mesma planilha atualiza os prontuários e não duplica erros.
+#   python importar_planilha.py "Auditoria unique jeiza.xlsx" --aba "OUTUBRO 2025 HU"
+
+parser = argparse.ArgumentParser(description="Importa planilha de auditoria (.xlsx)")
+parser.add_argument('arquivo', help="Caminho do arquivo .xlsx")
+parser.add_argument('--aba', help="Nome da aba (padrão: 'OUTUBRO 2025 HU' se existir, senão a primeira)")
+parser.add_argument('--lote', type=int, default=1000, help="Linhas por transação (padrão: 1000)")
+parser.add_argument('--status', default='Aguardando Auditoria',
+                    help="Status dos prontuários novos quando a planilha não tiver a coluna STATUS")
+parser.add_argument('--criar-cadastros', action='store_true',
+                    help="cadastra como inativos convênios, setores, tipos e causas que não existem "
+                         "(sem isso, a linha é rejeitada)")
+args = parser.parse_args()
+
+with app.app_context():
+    migrar_schema()
+    resumo = importar_planilha(args.arquivo, aba=args.aba, tamanho_lote=args.lote, status_padrao=args.status,
+                               criar_cadastros=args.criar_cadastros)
+    for problema in resumo['problemas']:
+        print(f"⚠️ Linha {problema['linha']}: {problema['erro']}")
+    print(f"Sucesso! {resumo['linhas_lidas']} linhas lidas da aba '{resumo['aba']}'.")
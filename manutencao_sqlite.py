@@ -0,0 +1,11 @@
+from app import app, manutencao_sqlite
+
+# Roda PRAGMA optimize, ANALYZE e um checkpoint TRUNCATE do WAL (zera o arquivo -wal).
+# Bom para agendar no cron fora do horário de uso, ou depois de cargas grandes
+# (migrar_dados.py, alimentar_bd.py, importar_planilha.py).
+
+print("Iniciando manutenção do banco SQLite...")
+
+with app.app_context():
+    tempos = manutencao_sqlite(analisar=True, checkpoint='TRUNCATE')
+    print(f"Sucesso! Tempos: {tempos}")
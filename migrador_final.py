@@ -1,64 +1,20 @@
 import os
 import sqlite3
-from app import app, db
+from app import app, db, migrar_schema
 
 def migrate_database():
-    """Migra o banco de dados para a nova estrutura"""
+    """Migra o banco de dados para a nova estrutura e popula as categorias padrão"""
     print("🚀 INICIANDO MIGRAÇÃO DO BANCO DE DADOS...")
     
     with app.app_context():
+        # 1-4. Colunas e tabelas novas: migrações versionadas do app (schema_version)
+        migrar_schema()
         try:
             # Conectar diretamente ao SQLite
             db_path = os.path.join(os.path.dirname(__file__), 'data', 'auditoria.db')
             conn = sqlite3.connect(db_path)
             cursor = conn.cursor()
             
-            # 1. Verificar se as colunas já existem
-            cursor.execute("PRAGMA table_info(erro)")
-            columns = [col[1] for col in cursor.fetchall()]
-            
-            # 2. Adicionar colunas se não existirem
-            if 'responsavel_id' not in columns:
-                print("📝 Adicionando coluna responsavel_id...")
-                cursor.execute("ALTER TABLE erro ADD COLUMN responsavel_id INTEGER")
-            
-            if 'categoria_erro_id' not in columns:
-                print("📝 Adicionando coluna categoria_erro_id...")
-                cursor.execute("ALTER TABLE erro ADD COLUMN categoria_erro_id INTEGER")
-            
-            # 3. Verificar se a tabela categoria_erro existe
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='categoria_erro'")
-            if not cursor.fetchone():
-                print("📝 Criando tabela categoria_erro...")
-                cursor.execute("""
-                    CREATE TABLE categoria_erro (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        codigo VARCHAR(20) UNIQUE NOT NULL,
-                        nome VARCHAR(100) NOT NULL,
-                        descricao TEXT,
-                        cor VARCHAR(7) DEFAULT '#3498db',
-                        status VARCHAR(20) DEFAULT 'ativo',
-                        data_criacao DATETIME DEFAULT CURRENT_TIMESTAMP,
-                        data_atualizacao DATETIME DEFAULT CURRENT_TIMESTAMP
-                    )
-                """)
-            
-            # 4. Verificar se a tabela de relacionamento existe
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='responsavel_categoria_association'")
-            if not cursor.fetchone():
-                print("📝 Criando tabela responsavel_categoria_association...")
-                cursor.execute("""
-                    CREATE TABLE responsavel_categoria_association (
-                        responsavel_id INTEGER NOT NULL,
-                        categoria_erro_id INTEGER NOT NULL,
-                        data_inicio DATETIME DEFAULT CURRENT_TIMESTAMP,
-                        data_fim DATETIME NULL,
-                        PRIMARY KEY (responsavel_id, categoria_erro_id),
-                        FOREIGN KEY (responsavel_id) REFERENCES responsavel(id),
-                        FOREIGN KEY (categoria_erro_id) REFERENCES categoria_erro(id)
-                    )
-                """)
-            
             # 5. Popular categorias padrão
             cursor.execute("SELECT COUNT(*) FROM categoria_erro")
             if cursor.fetchone()[0] == 0:
@@ -2,6 +2,9 @@ import pandas as pd
 import sqlite3
 from datetime import datetime
 import os
+import time
+from collections import Counter
+from app import VERSAO_SCHEMA_ATUAL
 
 # ==============================================================================
 # CONFIGURAÇÕES DE CAMINHOS (Ajuste se necessário)
@@ -9,64 +12,31 @@ import os
 ARQUIVO_EXCEL = r"C:\Users\LUCIANO\Desktop\Auditoria unique jeiza.xlsx"
 CAMINHO_BD = r"C:\Users\LUCIANO\Desktop\auditoria_hospitalar\data\auditoria.db"
 NOME_PLANILHA = 'OUTUBRO 2025 HU'
+TAMANHO_LOTE = 500  # atendimentos gravados por commit
+CAMPOS_DATA = ['Admissão', 'Alta', 'Recebimento do Prontuário', 'Envio para Correção']
 
-def corrigir_estrutura_banco(conn):
+def _parse_date(val, padrao):
+    """Converte a célula para 'YYYY-MM-DD'; vazia ou inválida vira a data padrão."""
+    if pd.isna(val) or val == '' or str(val).lower() == 'nat':
+        return padrao
+    try:
+        return pd.to_datetime(val).strftime('%Y-%m-%d')
+    except:
+        return padrao
+
+def verificar_schema(conn):
     """
-    Verifica e corrige a estrutura do banco de dados automaticamente
-    antes de tentar inserir dados.
+    A estrutura do banco é das migrações versionadas do app (schema_version): aqui só confere
+    se o banco está na versão que este script espera.
     """
-    cursor = conn.cursor()
-    print("🔧 Verificando estrutura do banco de dados...")
-
-    # 1. Criar tabela categoria_erro se não existir
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS categoria_erro (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        codigo VARCHAR(20) UNIQUE NOT NULL,
-        nome VARCHAR(100) NOT NULL,
-        descricao VARCHAR(200),
-        cor VARCHAR(7),
-        status VARCHAR(20) DEFAULT 'ativo',
-        data_criacao DATETIME,
-        data_atualizacao DATETIME
-    )
-    ''')
-
-    # 2. Criar tabela de associação se não existir
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS responsavel_categoria_association (
-        responsavel_id INTEGER NOT NULL,
-        categoria_erro_id INTEGER NOT NULL,
-        data_inicio DATETIME,
-        data_fim DATETIME,
-        PRIMARY KEY (responsavel_id, categoria_erro_id),
-        FOREIGN KEY(responsavel_id) REFERENCES responsavel (id),
-        FOREIGN KEY(categoria_erro_id) REFERENCES categoria_erro (id)
-    )
-    ''')
-
-    # 3. Verificar e Adicionar colunas na tabela ERRO
-    cursor.execute("PRAGMA table_info(erro)")
-    colunas_existentes = [col[1] for col in cursor.fetchall()]
-
-    if 'responsavel_id' not in colunas_existentes:
-        print("⚠️ Coluna 'responsavel_id' faltando. Adicionando...")
-        try:
-            cursor.execute("ALTER TABLE erro ADD COLUMN responsavel_id INTEGER REFERENCES responsavel(id)")
-            print("✅ Coluna 'responsavel_id' adicionada.")
-        except Exception as e:
-            print(f"❌ Erro ao adicionar responsavel_id: {e}")
-
-    if 'categoria_erro_id' not in colunas_existentes:
-        print("⚠️ Coluna 'categoria_erro_id' faltando. Adicionando...")
-        try:
-            cursor.execute("ALTER TABLE erro ADD COLUMN categoria_erro_id INTEGER REFERENCES categoria_erro(id)")
-            print("✅ Coluna 'categoria_erro_id' adicionada.")
-        except Exception as e:
-            print(f"❌ Erro ao adicionar categoria_erro_id: {e}")
-
-    conn.commit()
-    print("🏁 Estrutura do banco verificada e pronta!")
+    try:
+        versao = conn.execute("SELECT MAX(versao) FROM schema_version").fetchone()[0] or 0
+    except sqlite3.OperationalError:
+        versao = 0
+    if versao < VERSAO_SCHEMA_ATUAL:
+        raise RuntimeError(f"schema na versão {versao}, esperado {VERSAO_SCHEMA_ATUAL}: "
+                           f"rode 'python atualizar_banco.py' antes")
+    print(f"🏁 Estrutura do banco na versão {versao}, pronta!")
 
 def popular_dados_excel_no_bd_estruturado():
     """
@@ -92,8 +62,8 @@ def popular_dados_excel_no_bd_estruturado():
         cursor = conn.cursor()
         print("✅ Conexão com BD estabelecida.")
         
-        # 🔥 CHAMA A CORREÇÃO DE ESTRUTURA AQUI
-        corrigir_estrutura_banco(conn)
+        # 🔥 CONFERE A VERSÃO DO SCHEMA AQUI
+        verificar_schema(conn)
         
     except Exception as e:
         print(f"❌ Erro ao conectar com BD: {e}")
@@ -168,46 +138,131 @@ def popular_dados_excel_no_bd_estruturado():
     # Inicializar contadores e auxiliares
     prontuarios_inseridos = 0
     erros_inseridos = 0
-    atendimentos_processados = set()
+    linhas_processadas = 0
     data_atual = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    data_padrao = data_atual.split()[0]
+    inicio = time.perf_counter()
     
     # Garantir Tipos de Erro
     tipos_erro_necessarios = ['ERRO FATURAMENTO', 'ERRO ENFERMAGEM', 'ERRO MÉDICO', 'ERRO RECEPÇÃO']
-    for tipo_erro in tipos_erro_necessarios:
-        cursor.execute('INSERT OR IGNORE INTO tipo_erro (nome, descricao, status, data_criacao, data_atualizacao) VALUES (?, ?, ?, ?, ?)', 
-                       (tipo_erro, tipo_erro.replace("ERRO ", ""), 'ativo', data_atual, data_atual))
+    cursor.executemany('INSERT OR IGNORE INTO tipo_erro (nome, descricao, status, data_criacao, data_atualizacao) VALUES (?, ?, ?, ?, ?)', 
+                       [(tipo_erro, tipo_erro.replace("ERRO ", ""), 'ativo', data_atual, data_atual)
+                        for tipo_erro in tipos_erro_necessarios])
+
+    # Mapas em memória: carregados uma vez e estendidos a cada inserção
+    tipos_ids = dict(cursor.execute('SELECT nome, id FROM tipo_erro').fetchall())
+    responsaveis_ids = dict(cursor.execute('SELECT nome, id FROM responsavel').fetchall())
+    prontuarios_ids = dict(cursor.execute(
+        'SELECT atendimento, MIN(id) FROM prontuario GROUP BY atendimento').fetchall())
+    # Convênio, setor, status e causa são FK para os cadastros (dicionário): nome -> id
+    cadastros_ids = {tabela: dict(cursor.execute(f'SELECT nome, MIN(id) FROM {tabela} GROUP BY nome').fetchall())
+                     for tabela in ('convenio', 'setor', 'status_prontuario')}
+    causas_ids = {(tipo_id, descricao): id_ for tipo_id, descricao, id_ in cursor.execute(
+        'SELECT tipo_erro_id, descricao, MIN(id) FROM causa GROUP BY tipo_erro_id, descricao').fetchall()}
+
+    def id_responsavel(nome):
+        responsavel_id = responsaveis_ids.get(nome)
+        if responsavel_id is None:
+            cat_resp = mapeamento_responsaveis_categorias.get(nome, 'ERRO FATURAMENTO')
+            cursor.execute('''
+                INSERT INTO responsavel (nome, funcao, status, data_criacao, data_atualizacao)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (nome, cat_resp, 'ativo', data_atual, data_atual))
+            responsavel_id = responsaveis_ids[nome] = cursor.lastrowid
+        return responsavel_id
+
+    def id_cadastro(tabela, nome):
+        """id do convênio/setor/status; nome fora do cadastro entra como inativo (igual ao app)"""
+        id_ = cadastros_ids[tabela].get(nome)
+        if id_ is None:
+            if tabela == 'status_prontuario':
+                cursor.execute('INSERT INTO status_prontuario (nome) VALUES (?)', (nome,))
+            else:
+                cursor.execute(f'INSERT INTO {tabela} (nome, status, data_criacao, data_atualizacao) VALUES (?, ?, ?, ?)',
+                               (nome, 'inativo', data_atual, data_atual))
+            id_ = cadastros_ids[tabela][nome] = cursor.lastrowid
+        return id_
+
+    def id_causa(tipo_erro_id, descricao):
+        id_ = causas_ids.get((tipo_erro_id, descricao))
+        if id_ is None:
+            cursor.execute('''
+                INSERT INTO causa (descricao, tipo_erro_id, status, data_criacao, data_atualizacao)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (descricao, tipo_erro_id, 'inativo', data_atual, data_atual))
+            id_ = causas_ids[(tipo_erro_id, descricao)] = cursor.lastrowid
+        return id_
+
+    def gravar_lote(lote):
+        """Grava um lote de atendimentos com executemany e faz o commit."""
+        nonlocal prontuarios_inseridos, erros_inseridos
+        novos = [dados for atendimento, dados, _ in lote if atendimento not in prontuarios_ids]
+        if novos:
+            cursor.executemany('''
+                INSERT INTO prontuario 
+                (beneficiario, convenio_id, setor_id, atendimento, admissao, alta, 
+                 recebimento_prontuario, data_conta, enviado_faturamento, diarias, 
+                 fim_auditoria, observacao, status_id, data_criacao, data_atualizacao)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', novos)
+            prontuarios_inseridos += len(novos)
+            atendimentos_novos = [dados[3] for dados in novos]
+            for i in range(0, len(atendimentos_novos), 500):
+                parte = atendimentos_novos[i:i + 500]
+                marcadores = ','.join('?' * len(parte))
+                prontuarios_ids.update(cursor.execute(
+                    f'SELECT atendimento, MIN(id) FROM prontuario WHERE atendimento IN ({marcadores}) GROUP BY atendimento',
+                    parte).fetchall())
+
+        vinculos, erros = set(), []
+        for atendimento, _, erros_do_atendimento in lote:
+            prontuario_id = prontuarios_ids[atendimento]
+            # Erros repetidos no atendimento viram uma linha com quantidade
+            for (tipo_erro_nome, causa_desc, responsavel_id), quantidade in Counter(erros_do_atendimento).items():
+                vinculos.add((prontuario_id, responsavel_id))
+                tipo_erro_id = tipos_ids[tipo_erro_nome]
+                erros.append((prontuario_id, responsavel_id, tipo_erro_id, id_causa(tipo_erro_id, causa_desc),
+                              quantidade, data_atual, tipos_ids.get(tipo_erro_nome, 1)))
+                erros_inseridos += quantidade
+
+        cursor.executemany('''
+            INSERT OR IGNORE INTO prontuario_responsavel_association (prontuario_id, responsavel_id)
+            VALUES (?, ?)
+        ''', sorted(vinculos))
+        cursor.executemany('''
+            INSERT INTO erro 
+            (prontuario_id, responsavel_id, tipo_erro_id, causa_id, quantidade, data_criacao, categoria_erro_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', erros)
+        conn.commit()
 
     print("🔄 Iniciando processamento das linhas...")
 
-    # Loop principal
-    for index, row in df.iterrows():
+    # Uma única passada: cada grupo é um atendimento, a primeira linha traz os dados do prontuário
+    df['_atendimento'] = df['Atendimento'].astype(str).str.strip()
+    df = df[df['_atendimento'].str.lower() != 'nan'].reset_index(drop=True)
+    for coluna in CAMPOS_DATA:
+        # Datas se repetem muito: cada valor distinto é convertido uma única vez
+        convertidas = {valor: _parse_date(valor, data_padrao) for valor in df[coluna].unique()}
+        df[coluna] = df[coluna].map(convertidas)
+    registros = df.to_dict('records')
+    grupos = sorted(df.groupby('_atendimento', sort=False).indices.items(), key=lambda item: item[1][0])
+    lote = []
+
+    for atendimento, posicoes in grupos:
+        linhas_processadas += len(posicoes)
         try:
             # Dados do Prontuário
+            row = registros[posicoes[0]]
             beneficiario = str(row['Beneficiario']).strip()
             convenio_nome = str(row['Convênio']).strip()
             setor_nome = str(row['Setor']).strip()
-            atendimento = str(row['Atendimento']).strip()
             observacoes = str(row.get('Observações', ''))
-            
-            # Ignora linhas inválidas
-            if atendimento in atendimentos_processados or atendimento.lower() == 'nan':
-                continue
-                
-            atendimentos_processados.add(atendimento)
-            
-            # Função auxiliar de data
-            def parse_date(val):
-                if pd.isna(val) or val == '' or str(val).lower() == 'nat':
-                    return data_atual.split()[0] # Retorna string YYYY-MM-DD
-                try:
-                    return pd.to_datetime(val).strftime('%Y-%m-%d')
-                except:
-                    return data_atual.split()[0]
 
-            admissao = parse_date(row['Admissão'])
-            alta = parse_date(row['Alta'])
-            recebimento = parse_date(row['Recebimento do Prontuário'])
-            envio = parse_date(row['Envio para Correção'])
+            admissao = row['Admissão']
+            alta = row['Alta']
+            recebimento = row['Recebimento do Prontuário']
+            envio = row['Envio para Correção']
             
             # Cálculo de Diárias
             diarias = 1
@@ -218,86 +273,44 @@ def popular_dados_excel_no_bd_estruturado():
             except:
                 pass
 
-            # Inserir Prontuário
-            cursor.execute('''
-                INSERT OR IGNORE INTO prontuario 
-                (beneficiario, convenio, setor, atendimento, admissao, alta, 
-                 recebimento_prontuario, data_conta, enviado_faturamento, diarias, 
-                 fim_auditoria, observacao, status, data_criacao, data_atualizacao)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (beneficiario, convenio_nome, setor_nome, atendimento, admissao, alta,
-                  recebimento, admissao, envio, diarias,
-                  envio, observacoes, 'Entregue ao Faturamento', data_atual, data_atual))
-            
-            if cursor.rowcount > 0:
-                prontuarios_inseridos += 1
+            dados_prontuario = (beneficiario, id_cadastro('convenio', convenio_nome), id_cadastro('setor', setor_nome),
+                                atendimento, admissao, alta, recebimento, admissao, envio, diarias, envio,
+                                observacoes, id_cadastro('status_prontuario', 'Entregue ao Faturamento'),
+                                data_atual, data_atual)
 
-            # Pegar ID do Prontuário (Existente ou Novo)
-            cursor.execute('SELECT id FROM prontuario WHERE atendimento = ?', (atendimento,))
-            prontuario_id = cursor.fetchone()[0]
-            
             # Processar Erros deste atendimento
-            erros_do_atendimento = df[df['Atendimento'] == row['Atendimento']]
-            
-            for _, erro_row in erros_do_atendimento.iterrows():
+            erros_do_atendimento = []
+            for posicao in posicoes:
+                erro_row = registros[posicao]
                 causa_desc = str(erro_row['Causa']).strip()
-                responsavel_nome = str(erro_row['Responsavel']).strip()
-                
                 if causa_desc.lower() == 'nan': continue
 
                 # Determinar Tipo Macro
                 tipo_erro_nome = mapeamento_causas_tipos.get(causa_desc, 'ERRO FATURAMENTO')
-                
-                # Pegar ID do Tipo
-                cursor.execute('SELECT id FROM tipo_erro WHERE nome = ?', (tipo_erro_nome,))
-                tipo_res = cursor.fetchone()
-                tipo_erro_id = tipo_res[0] if tipo_res else 1 # Fallback
-                
-                # Gerenciar Responsável
-                cursor.execute('SELECT id FROM responsavel WHERE nome = ?', (responsavel_nome,))
-                resp_res = cursor.fetchone()
-                
-                if resp_res:
-                    responsavel_id = resp_res[0]
-                else:
-                    cat_resp = mapeamento_responsaveis_categorias.get(responsavel_nome, 'ERRO FATURAMENTO')
-                    cursor.execute('''
-                        INSERT INTO responsavel (nome, funcao, status, data_criacao, data_atualizacao)
-                        VALUES (?, ?, ?, ?, ?)
-                    ''', (responsavel_nome, cat_resp, 'ativo', data_atual, data_atual))
-                    responsavel_id = cursor.lastrowid
-                
-                # Vincular Responsável ao Prontuário
-                cursor.execute('''
-                    INSERT OR IGNORE INTO prontuario_responsavel_association (prontuario_id, responsavel_id)
-                    VALUES (?, ?)
-                ''', (prontuario_id, responsavel_id))
-                
-                # Inserir o Erro (Agora com as colunas garantidas)
-                cursor.execute('''
-                    INSERT INTO erro 
-                    (prontuario_id, responsavel_id, tipo, causa, data_criacao, categoria_erro_id)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                ''', (prontuario_id, responsavel_id, tipo_erro_nome, causa_desc, data_atual, tipo_erro_id))
-                
-                erros_inseridos += 1
+                erros_do_atendimento.append((tipo_erro_nome, causa_desc, id_responsavel(str(erro_row['Responsavel']).strip())))
 
-            if prontuarios_inseridos % 50 == 0:
-                print(f"⏳ Processados: {prontuarios_inseridos} prontuários...")
-                conn.commit()
+            lote.append((atendimento, dados_prontuario, erros_do_atendimento))
 
         except Exception as e:
-            print(f"⚠️ Erro na linha {index}: {e}")
+            print(f"⚠️ Erro no atendimento {atendimento}: {e}")
             continue
 
-    conn.commit()
+        if len(lote) >= TAMANHO_LOTE:
+            gravar_lote(lote)
+            lote = []
+            print(f"⏳ Processados: {linhas_processadas} linhas...")
+
+    if lote:
+        gravar_lote(lote)
     conn.close()
+    duracao = max(time.perf_counter() - inicio, 1e-9)
     
     print("\n" + "="*40)
     print("📊 RELATÓRIO FINAL")
     print("="*40)
     print(f"✅ Prontuários Processados: {prontuarios_inseridos}")
     print(f"✅ Erros Inseridos: {erros_inseridos}")
+    print(f"⚡ Vazão: {linhas_processadas / duracao:.0f} linhas/s ({linhas_processadas} linhas em {duracao:.1f}s)")
     print("="*40)
 
 if __name__ == "__main__":
@@ -0,0 +1,12 @@
+from app import app, migrar_schema, recalcular_contadores_erro
+
+# Recalcula erro_count/has_erro de todos os prontuários a partir da tabela erro.
+# Use depois de importações em lote feitas fora do app (migrar_dados.py, alimentar_bd.py)
+# ou se suspeitar que os contadores ficaram divergentes.
+
+print("Iniciando recontagem dos erros por prontuário...")
+
+with app.app_context():
+    migrar_schema()
+    corrigidos = recalcular_contadores_erro()
+    print(f"Sucesso! {corrigidos} prontuários corrigidos.")
@@ -0,0 +1,12 @@
+from app import app, migrar_schema, reconstruir_resumo_diario
+
+# Recalcula a tabela resumo_diario (rollup do dashboard) a partir de prontuario/erro.
+# Use depois de importações em lote feitas fora do app (migrar_dados.py, alimentar_bd.py)
+# ou se suspeitar que o resumo ficou divergente.
+
+print("Iniciando reconstrução do resumo diário...")
+
+with app.app_context():
+    migrar_schema()
+    linhas = reconstruir_resumo_diario()
+    print(f"Sucesso! {linhas} linhas de resumo gravadas.")
@@ -0,0 +1,54 @@
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+
+# O app lê o banco das variáveis de ambiente na importação: aponta para bancos descartáveis
+_pasta = tempfile.mkdtemp(prefix='auditoria-testes-')
+atexit.register(shutil.rmtree, _pasta, True)
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(_pasta, 'auditoria.db')}"
+os.environ['ARQUIVO_DATABASE_URL'] = f"sqlite:///{os.path.join(_pasta, 'arquivo.db')}"
+os.environ['SQLITE_MANUTENCAO_INTERVALO'] = '0'
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+from app import (app, db, Convenio, Setor, TipoErro, Causa, Responsavel, ResumoDiario, CHAVE_RESUMO,
+                 CONTADORES_RESUMO, cache_resultados, cache_referencia, migrar_schema, motor_arquivo)
+
+
+@pytest.fixture
+def banco():
+    """Banco migrado com um cadastro mínimo (os lançamentos só aceitam valores cadastrados)."""
+    with app.app_context():
+        migrar_schema()
+        cache_resultados.nova_versao()
+        cache_referencia.nova_versao()
+        db.session.add_all([
+            Convenio(nome='Convênio A'), Convenio(nome='Convênio B'), Setor(nome='Setor A'),
+            TipoErro(nome='Assinatura', causas=[Causa(descricao='Falta assinatura'),
+                                                Causa(descricao='Falta carimbo')]),
+            TipoErro(nome='Documentação', causas=[Causa(descricao='Folha faltando')]),
+            Responsavel(nome='Ana'), Responsavel(nome='Bruno'),
+        ])
+        db.session.commit()
+        yield db
+        db.session.remove()
+        db.drop_all()
+        if motor_arquivo() is not None:
+            db.metadata.drop_all(motor_arquivo())
+
+
+@pytest.fixture
+def cliente(banco, monkeypatch):
+    """Cliente HTTP do app sem a tela de login"""
+    monkeypatch.setitem(app.config, 'LOGIN_DISABLED', True)
+    return app.test_client()
+
+
+def resumo_gravado():
+    """Linhas não zeradas do ResumoDiario, no formato de _totais_resumo"""
+    return {tuple(getattr(r, c) for c in CHAVE_RESUMO): [getattr(r, c) for c in CONTADORES_RESUMO]
+            for r in db.session.query(ResumoDiario) if any(getattr(r, c) for c in CONTADORES_RESUMO)}
@@ -0,0 +1,98 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import (db, Prontuario, Erro, VersaoSchema, STATUS_ARQUIVAVEL, migrar_schema,
+                 recalcular_contadores_erro, arquivar_prontuarios, estado_arquivo, consultar_arquivo)
+
+
+def _prontuario(atendimento, status, **campos):
+    p = Prontuario(beneficiario=f'Paciente {atendimento}', atendimento=atendimento,
+                   convenio='Convênio A', setor='Setor A', status=status, **campos)
+    db.session.add(p)
+    return p
+
+
+def test_entregue_continua_arquivavel_depois_da_recontagem_e_da_migracao(banco):
+    agora = datetime.now()
+    antigo = agora - timedelta(days=200)
+    entregue = _prontuario('A1', STATUS_ARQUIVAVEL)
+    entregue.erros.append(Erro(tipo='Assinatura', causa='Falta assinatura', quantidade=2))
+    enviado = _prontuario('A2', STATUS_ARQUIVAVEL, enviado_faturamento=antigo)
+    recente = _prontuario('A3', STATUS_ARQUIVAVEL)
+    pendente = _prontuario('A4', 'Aguardando Auditoria')
+    db.session.commit()
+
+    tabela = Prontuario.__table__
+    ids_antigos = [entregue.id, recente.id, pendente.id]
+    db.session.execute(tabela.update().where(tabela.c.id.in_(ids_antigos))
+                       .values(data_atualizacao=antigo, erro_count=0))
+    db.session.execute(tabela.update().where(tabela.c.id.in_([enviado.id, recente.id]))
+                       .values(data_atualizacao=agora - timedelta(days=1)))
+    db.session.commit()
+
+    # A recontagem corrige os contadores divergentes sem mexer na data de atualização
+    assert recalcular_contadores_erro() == 1
+    db.session.execute(db.delete(VersaoSchema).where(VersaoSchema.versao == 4))
+    db.session.commit()
+    assert migrar_schema() == [4]
+
+    db.session.expire_all()
+    assert db.session.get(Prontuario, entregue.id).erro_count == 2
+    assert db.session.get(Prontuario, entregue.id).data_atualizacao == antigo
+
+    # Entrega pelo enviado_faturamento conta mesmo com alteração recente
+    assert arquivar_prontuarios(180, simular=True) == 2
+    assert arquivar_prontuarios(180) == 2
+    restantes = set(db.session.scalars(db.select(Prontuario.id)))
+    assert restantes == {recente.id, pendente.id}
+    assert estado_arquivo().total == 2
+
+
+def _arquivados(consulta):
+    return consultar_arquivo(lambda sessao: sessao.execute(consulta).all())
+
+
+def test_id_apagado_depois_do_arquivamento_nao_volta(banco):
+    antigo = datetime.now() - timedelta(days=200)
+    primeiro = _prontuario('B1', STATUS_ARQUIVAVEL, enviado_faturamento=antigo)
+    primeiro.erros.append(Erro(tipo='Assinatura', causa='Falta assinatura'))
+    maior = _prontuario('B2', 'Aguardando Auditoria')
+    maior.erros.append(Erro(tipo='Assinatura', causa='Falta carimbo'))
+    db.session.commit()
+    id_primeiro, id_maior = primeiro.id, maior.id
+    assert arquivar_prontuarios(180) == 1
+
+    # Apagado o de maior id, o próximo prontuário (e o próximo erro) não reaproveitam ids
+    db.session.delete(maior)
+    db.session.commit()
+    segundo = _prontuario('B3', STATUS_ARQUIVAVEL, enviado_faturamento=antigo)
+    segundo.erros.append(Erro(tipo='Assinatura', causa='Falta assinatura'))
+    db.session.commit()
+    id_segundo = segundo.id
+    assert id_segundo > id_maior
+    assert arquivar_prontuarios(180) == 1
+
+    tabela_p, tabela_e = Prontuario.__table__, Erro.__table__
+    assert _arquivados(db.select(tabela_p.c.id, tabela_p.c.atendimento).order_by(tabela_p.c.id)) == [
+        (id_primeiro, 'B1'), (id_segundo, 'B3')]
+    assert sorted(p for (p,) in _arquivados(db.select(tabela_e.c.prontuario_id))) == [id_primeiro, id_segundo]
+
+
+def test_id_reaproveitado_nao_sobrescreve_o_arquivado(banco):
+    antigo = datetime.now() - timedelta(days=200)
+    arquivado = _prontuario('C1', STATUS_ARQUIVAVEL, enviado_faturamento=antigo)
+    db.session.commit()
+    id_arquivado = arquivado.id
+    assert arquivar_prontuarios(180) == 1
+
+    # Banco de antes do AUTOINCREMENT: outro prontuário com o mesmo id no banco quente
+    db.session.add(Prontuario(id=id_arquivado, beneficiario='Outro', atendimento='C2', convenio='Convênio A',
+                              setor='Setor A', status=STATUS_ARQUIVAVEL, enviado_faturamento=antigo))
+    db.session.commit()
+    with pytest.raises(RuntimeError, match='reaproveitado'):
+        arquivar_prontuarios(180)
+
+    tabela_p = Prontuario.__table__
+    assert _arquivados(db.select(tabela_p.c.atendimento).where(tabela_p.c.id == id_arquivado)) == [('C1',)]
+    assert db.session.get(Prontuario, id_arquivado).atendimento == 'C2'
@@ -0,0 +1,60 @@
+from app import db, Convenio, VersaoCache, cache_resultados, cache_referencia, nomes_ativos
+
+
+def test_escrita_de_outro_processo_invalida_o_cache(banco):
+    calculos = []
+
+    def calcular():
+        calculos.append(1)
+        return len(calculos)
+
+    assert cache_resultados.obter(('teste',), calcular) == 1
+    assert cache_resultados.obter(('teste',), calcular) == 1
+
+    # Outro worker gravou: só a versão no banco muda, a local continua a mesma
+    db.session.execute(db.update(VersaoCache).where(VersaoCache.nome == cache_resultados.compartilhado)
+                       .values(versao=VersaoCache.versao + 1))
+    db.session.commit()
+    assert cache_resultados.obter(('teste',), calcular) == 2
+    assert cache_resultados.obter(('teste',), calcular) == 2
+
+
+def test_nova_versao_grava_no_banco(banco):
+    antes = db.session.get(VersaoCache, cache_resultados.compartilhado).versao
+    db.session.commit()
+    cache_resultados.nova_versao()
+    assert db.session.get(VersaoCache, cache_resultados.compartilhado).versao == antes + 1
+
+
+def test_cadastro_alterado_em_outro_processo_invalida_os_catalogos(banco, monkeypatch):
+    monkeypatch.setattr(cache_referencia, 'releitura_segundos', 0)
+    assert nomes_ativos(Convenio) == ['Convênio A', 'Convênio B']
+
+    # Outro worker renomeou pela tela de configurações: muda o banco e a versão 'referencia'
+    db.session.execute(db.update(Convenio).where(Convenio.nome == 'Convênio A').values(nome='Convênio C'))
+    db.session.execute(db.update(VersaoCache).where(VersaoCache.nome == cache_referencia.compartilhado)
+                       .values(versao=VersaoCache.versao + 1))
+    db.session.commit()
+    assert nomes_ativos(Convenio) == ['Convênio B', 'Convênio C']
+
+
+def test_so_escrita_aceita_invalida_o_cache(cliente):
+    versao = cache_resultados.versao
+    lancamento = {'beneficiario': 'Paciente', 'atendimento': 'V1', 'convenio': 'Convênio X',
+                  'setor': 'Setor A', 'admissao': '2024-03-01'}
+    assert cliente.post('/api/adicionar_prontuario', json=lancamento).status_code == 400
+    assert cliente.delete('/api/excluir_prontuario/999999').status_code == 404
+    assert cache_resultados.versao == versao
+
+    assert cliente.post('/api/adicionar_prontuario', json={**lancamento, 'convenio': 'Convênio A'}).status_code == 200
+    assert cache_resultados.versao == versao + 1
+
+
+def test_so_cadastro_aceito_invalida_os_catalogos(cliente):
+    versao = cache_referencia.versao
+    assert cliente.post('/api/configuracoes/convenios', json={}).status_code >= 400
+    assert cache_referencia.versao == versao
+
+    assert cliente.post('/api/configuracoes/convenios', json={'nome': 'Convênio C'}).status_code == 200
+    assert cache_referencia.versao > versao
+    assert 'Convênio C' in nomes_ativos(Convenio)
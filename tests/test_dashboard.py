@@ -0,0 +1,77 @@
+from datetime import datetime, timedelta
+
+from app import (db, Prontuario, Erro, Responsavel, ResumoDiario, StatsAccumulator, Setor, cache_resultados,
+                 calcular_estatisticas_bd, calcular_estatisticas_resumo, contagens_dashboard, get_tipos_erro_dict,
+                 linhas_estatistica_bd, reconstruir_resumo_diario, recalcular_contadores_erro, _agg_contagem_status,
+                 _agg_erros_por_motivo_detalhado, _agg_produtividade_diaria_mes, _agg_taxa_erros_convenio,
+                 _agg_taxa_erros_responsavel, _agg_taxa_erros_setor, _agg_top_erros, _norm_status)
+
+
+def _carregar_empates():
+    """Empates em convênio, setor, responsável, tipo e causa; o primeiro lançado é o último no nome"""
+    db.session.add(Setor(nome='Setor 0'))
+    ana, bruno = (db.session.query(Responsavel).filter_by(nome=n).one() for n in ('Ana', 'Bruno'))
+    dia = datetime(2024, 3, 5, 9)
+    for atendimento, convenio, setor, responsavel, erros in (
+            ('A1', 'Convênio B', 'Setor A', bruno, [('Documentação', 'Folha faltando', 1)]),
+            ('A2', 'Convênio A', 'Setor 0', ana, [('Assinatura', 'Falta carimbo', 1)]),
+            ('A3', 'Convênio B', 'Setor A', None, []),
+            ('A4', 'Convênio A', 'Setor A', None, [('Assinatura', 'Falta assinatura', 1)]),
+            ('A5', 'Convênio B', 'Setor 0', None, [('Documentação', 'Folha faltando', 2)])):
+        p = Prontuario(beneficiario=f'Paciente {atendimento}', atendimento=atendimento, convenio=convenio,
+                       setor=setor, status='Em Auditoria', data_criacao=dia, recebimento_prontuario=dia.date())
+        p.erros = [Erro(tipo=t, causa=c, quantidade=q, data_criacao=dia) for t, c, q in erros]
+        p.responsaveis = [responsavel] if responsavel else []
+        db.session.add(p)
+    db.session.commit()
+    recalcular_contadores_erro()
+
+
+def test_widgets_do_dashboard_iguais_aos_da_lista_e_com_empates_pelo_nome(banco):
+    _carregar_empates()
+    contagens = contagens_dashboard([], produtividade=(2024, 3))
+    lista = StatsAccumulator(linhas_estatistica_bd())
+    tipos = get_tipos_erro_dict()
+
+    # A lista devolve o status normalizado (_norm_status); o SQL, o nome do cadastro
+    assert {_norm_status({'status': s}): q for s, q in _agg_contagem_status(contagens).items()} == \
+        lista.contagem_status()
+    motivos, gerais = _agg_erros_por_motivo_detalhado(contagens, tipos)
+    assert (motivos, gerais) == lista.erros_por_motivo_detalhado(tipos)
+    assert _agg_taxa_erros_setor(contagens) == lista.taxa_erros_setor()
+    assert _agg_taxa_erros_convenio(contagens) == lista.taxa_erros_convenio()
+    assert _agg_taxa_erros_responsavel(contagens) == lista.taxa_erros_responsavel()
+    assert _agg_top_erros(contagens, tipos, motivos) == lista.top_erros(tipos)
+    assert _agg_produtividade_diaria_mes(contagens, 2024, 3) == lista.produtividade_diaria_mes(2024, 3)
+
+    # Empatados saem em ordem alfabética, não na ordem do GROUP BY nem na do lançamento
+    assert [m['tipo'] for m in motivos] == ['Assinatura', 'Documentação']
+    assert [c['nome'] for c in _agg_taxa_erros_convenio(contagens)] == ['Convênio A', 'Convênio B']
+    assert [s['nome'] for s in _agg_taxa_erros_setor(contagens)] == ['Setor 0', 'Setor A']
+    assert [r['nome'] for r in _agg_taxa_erros_responsavel(contagens)] == ['Ana', 'Bruno']
+    top_causas = _agg_top_erros(contagens, tipos, motivos)[1]
+    assert [c['nome'] for c in top_causas] == ['Folha faltando', 'Falta assinatura', 'Falta carimbo']
+
+    # Rollup: os mesmos totais da versão que percorre os objetos
+    reconstruir_resumo_diario()
+    assert calcular_estatisticas_resumo(db.session.query(ResumoDiario)) == \
+        calcular_estatisticas_bd(db.session.query(Prontuario).all())
+
+
+def test_dashboard_data_calcula_o_tempo_medio_de_auditoria_e_usa_o_cache(cliente):
+    recebido = datetime(2024, 3, 1)
+    for atendimento, dias in (('T1', 1), ('T2', 2), ('T3', None)):
+        db.session.add(Prontuario(beneficiario='Paciente', atendimento=atendimento, convenio='Convênio A',
+                                  setor='Setor A', recebimento_prontuario=recebido.date(),
+                                  enviado_faturamento=recebido + timedelta(days=dias) if dias else None))
+    db.session.commit()
+    cache_resultados.nova_versao()
+
+    dados = cliente.get('/api/dashboard_data').get_json()
+    # Só quem tem as duas datas entra na média; a versão antiga devolvia 0
+    assert dados['stats']['tempo_medio_auditoria'] == 1.5
+    assert dados['tempos_medios']['auditoria'] == 1.5
+
+    acertos = cache_resultados.hits
+    assert cliente.get('/api/dashboard_data').get_json() == dados
+    assert cache_resultados.hits == acertos + 1
@@ -0,0 +1,123 @@
+from datetime import datetime
+from io import BytesIO
+
+import pytest
+from openpyxl import Workbook
+from sqlalchemy import text
+
+from app import (db, Prontuario, Erro, Convenio, Causa, ResumoDiario, VersaoSchema, _busca_fts, _totais_resumo,
+                 buscar_prontuarios, configurar_busca_textual, importar_planilha, migrar_schema)
+from conftest import resumo_gravado
+
+
+def _planilha(*linhas):
+    wb = Workbook()
+    wb.active.append(['Atendimento', 'Beneficiário', 'Convênio', 'Setor', 'Tipo', 'Causa'])
+    for linha in linhas:
+        wb.active.append(list(linha))
+    arquivo = BytesIO()
+    wb.save(arquivo)
+    arquivo.seek(0)
+    return arquivo
+
+
+def test_valor_fora_do_cadastro_nao_e_gravado(banco):
+    p = Prontuario(beneficiario='Paciente', atendimento='A1', convenio='Convênio A', setor='Setor A')
+    with pytest.raises(ValueError, match="Convênio 'Convênio X' não está no cadastro"):
+        p.convenio = 'Convênio X'
+    with pytest.raises(ValueError, match="Causa 'Rasura' não está no cadastro"):
+        Erro(tipo='Assinatura', causa='Rasura')
+    assert db.session.query(Convenio).filter_by(nome='Convênio X').count() == 0
+
+
+def test_lancamento_com_valor_fora_do_cadastro_responde_400(cliente):
+    lancamento = {'beneficiario': 'Paciente', 'atendimento': 'A1', 'convenio': 'Convênio A',
+                  'setor': 'Setor A', 'admissao': '2024-03-01',
+                  'erros': [{'tipo': 'Assinatura', 'causa': 'Falta assinatura', 'responsavel_id': 1}]}
+
+    resposta = cliente.post('/api/adicionar_prontuario', json={**lancamento, 'convenio': 'Convênio X'})
+    assert resposta.status_code == 400
+    assert 'Convênio X' in resposta.get_json()['erro']
+    erros = [{'tipo': 'Assinatura', 'causa': 'Rasura', 'responsavel_id': 1}]
+    assert cliente.post('/api/adicionar_prontuario', json={**lancamento, 'erros': erros}).status_code == 400
+    assert db.session.query(Prontuario).count() == 0
+    assert db.session.query(Causa).filter_by(descricao='Rasura').count() == 0
+
+    assert cliente.post('/api/adicionar_prontuario', json=lancamento).status_code == 200
+    assert db.session.query(Prontuario).count() == 1
+
+
+def test_importacao_rejeita_a_linha_sem_o_opt_in(banco):
+    linhas = [('A1', 'Paciente 1', 'Convênio A', 'Setor A', 'Assinatura', 'Falta assinatura'),
+              ('A2', 'Paciente 2', 'Convênio X', 'Setor A', None, None),
+              ('A3', 'Paciente 3', 'Convênio A', 'Setor A', 'Assinatura', 'Rasura')]
+
+    resumo = importar_planilha(_planilha(*linhas))
+    assert resumo['prontuarios_inseridos'] == 1
+    assert [p['linha'] for p in resumo['problemas']] == [3, 4]
+    assert "Convênio 'Convênio X' não está no cadastro" in resumo['problemas'][0]['erro']
+    assert db.session.query(Convenio).filter_by(nome='Convênio X').count() == 0
+
+    resumo = importar_planilha(_planilha(*linhas), criar_cadastros=True)
+    assert resumo['prontuarios_inseridos'] == 2
+    assert db.session.query(Convenio).filter_by(nome='Convênio X').one().status == 'inativo'
+    assert db.session.query(Causa).filter_by(descricao='Rasura').one().status == 'inativo'
+
+
+def test_passo_9_converte_os_textos_em_ids_e_refaz_busca_e_resumo(banco):
+    _busca_fts['ativa'] = None
+    assert configurar_busca_textual()
+    try:
+        dia = datetime(2024, 3, 1, 10)
+        for atendimento, convenio, causas in (('A1', 'Convênio A', ['Falta assinatura', 'Falta carimbo']),
+                                              ('A2', 'Convênio B', [])):
+            p = Prontuario(beneficiario=f'Paciente {atendimento}', atendimento=atendimento, convenio=convenio,
+                           setor='Setor A', status='Aguardando Auditoria', data_criacao=dia)
+            p.erros = [Erro(tipo='Assinatura', causa=c, data_criacao=dia) for c in causas]
+            db.session.add(p)
+        db.session.commit()
+        esperado = {p.atendimento: (p.convenio_id, p.setor_id, p.status_id) for p in db.session.query(Prontuario)}
+        esperado_erros = sorted((e.tipo_erro_id, e.causa_id) for e in db.session.query(Erro))
+
+        # Banco de antes do passo 9: os textos nas próprias tabelas, ids ainda por preencher
+        for tabela, coluna, origem in (('prontuario', 'convenio', 'convenio c ON c.id = t.convenio_id'),
+                                       ('prontuario', 'setor', 'setor c ON c.id = t.setor_id'),
+                                       ('prontuario', 'status', 'status_prontuario c ON c.id = t.status_id'),
+                                       ('erro', 'tipo', 'tipo_erro c ON c.id = t.tipo_erro_id'),
+                                       ('erro', 'causa', 'causa c ON c.id = t.causa_id')):
+            campo = 'descricao' if coluna == 'causa' else 'nome'
+            db.session.execute(text(f"ALTER TABLE {tabela} ADD COLUMN {coluna} VARCHAR(300)"))
+            db.session.execute(text(f"UPDATE {tabela} SET {coluna} = (SELECT c.{campo} FROM {tabela} t "
+                                    f"JOIN {origem} WHERE t.id = {tabela}.id)"))
+        db.session.execute(text("UPDATE prontuario SET convenio = 'Convênio Legado' WHERE atendimento = 'A2'"))
+        db.session.execute(text("UPDATE prontuario SET convenio_id = 0, setor_id = 0, status_id = 0"))
+        db.session.execute(text("UPDATE erro SET tipo_erro_id = 0, causa_id = 0"))
+        db.session.execute(db.delete(VersaoSchema).where(VersaoSchema.versao >= 9))
+        db.session.execute(db.delete(ResumoDiario))
+        db.session.commit()
+
+        assert 9 in migrar_schema()
+        db.session.expire_all()
+
+        legado = db.session.query(Convenio).filter_by(nome='Convênio Legado').one()
+        assert legado.status == 'inativo'
+        esperado['A2'] = (legado.id,) + esperado['A2'][1:]
+        assert {p.atendimento: (p.convenio_id, p.setor_id, p.status_id)
+                for p in db.session.query(Prontuario)} == esperado
+        assert sorted((e.tipo_erro_id, e.causa_id) for e in db.session.query(Erro)) == esperado_erros
+        assert 'convenio' not in {c['name'] for c in db.inspect(db.engine).get_columns('prontuario')}
+        assert 'causa' not in {c['name'] for c in db.inspect(db.engine).get_columns('erro')}
+        assert resumo_gravado() == {c: v for c, v in _totais_resumo().items() if any(v)}
+        assert {c[2] for c in resumo_gravado()} == {esperado['A1'][0], legado.id}
+
+        # Triggers da busca recriados: erro lançado depois da migração já é encontrado pela causa
+        gatilhos = set(db.session.scalars(text("SELECT name FROM sqlite_master WHERE type = 'trigger'")))
+        assert {'prontuario_busca_ai', 'erro_busca_ai', 'erro_busca_ad'} <= gatilhos
+        a2 = db.session.query(Prontuario).filter_by(atendimento='A2').one()
+        a2.erros.append(Erro(tipo='Documentação', causa='Folha faltando', data_criacao=dia))
+        db.session.commit()
+        assert [r['atendimento'] for r in buscar_prontuarios('folha')[0]] == ['A2']
+    finally:
+        db.session.execute(text("DROP TABLE IF EXISTS prontuario_busca"))
+        db.session.commit()
+        _busca_fts['ativa'] = None
@@ -0,0 +1,82 @@
+from datetime import datetime, timedelta
+
+from app import (db, Prontuario, Erro, ResumoDiario, StatsAccumulator, contagens_dashboard, linhas_estatistica_bd,
+                 _agg_erros_por_motivo_detalhado, _agg_top_erros, _totais_resumo)
+from conftest import resumo_gravado
+
+
+def _lancar(cliente, atendimento, erros):
+    resposta = cliente.post('/api/adicionar_prontuario', json={
+        'beneficiario': f'Paciente {atendimento}', 'atendimento': atendimento, 'convenio': 'Convênio A',
+        'setor': 'Setor A', 'admissao': '2024-03-01', 'responsaveis': [1], 'erros': erros})
+    assert resposta.status_code == 200, resposta.get_json()
+    return resposta.get_json()['prontuario_id']
+
+
+def test_quantidade_pesa_nas_contagens_e_no_resumo(cliente):
+    # O mesmo erro repetido no formulário vira uma linha só, somando a quantidade
+    prontuario_id = _lancar(cliente, 'Q1', [
+        {'tipo': 'Assinatura', 'causa': 'Falta assinatura', 'responsavel_id': 1, 'quantidade': 2},
+        {'tipo': 'Assinatura', 'causa': 'Falta assinatura', 'responsavel_id': 1},
+    ])
+    _lancar(cliente, 'Q2', [{'tipo': 'Documentação', 'causa': 'Folha faltando', 'responsavel_id': 2}])
+    assert [e.quantidade for e in db.session.query(Erro).filter_by(prontuario_id=prontuario_id)] == [3]
+    assert db.session.get(Prontuario, prontuario_id).erro_count == 3
+
+    # Erro avulso soma uma ocorrência e a remoção tira uma (a linha só sai com a última)
+    avulso = {'tipo_erro': 'Documentação', 'causa': 'Folha faltando'}
+    for _ in range(2):
+        assert cliente.post(f'/api/adicionar_erro_unico/{prontuario_id}', json=avulso).status_code == 200
+    assert cliente.post(f'/api/remover_erro_unico/{prontuario_id}',
+                        json={'tipo_erro': 'Documentação', 'causa': 'Folha faltando'}).status_code == 200
+    db.session.expire_all()
+    assert db.session.get(Prontuario, prontuario_id).erro_count == 4
+
+    contagens = contagens_dashboard([])
+    motivos, gerais = _agg_erros_por_motivo_detalhado(contagens, {})
+    assert {m['tipo']: (m['prontuarios_com_erro'], m['total_ocorrencias']) for m in motivos} == {
+        'Assinatura': (1, 3), 'Documentação': (2, 2)}
+    assert gerais['total_erros_registrados'] == 5
+    assert gerais['media_erros_por_prontuario'] == 2.5
+    top_causas = _agg_top_erros(contagens, {}, motivos)[1]
+    assert top_causas == [{'nome': 'Falta assinatura', 'contagem': 3}, {'nome': 'Folha faltando', 'contagem': 2}]
+    assert StatsAccumulator(linhas_estatistica_bd()).erros_por_motivo_detalhado({}) == (motivos, gerais)
+
+    # Rollup: qtd_erros soma as quantidades; qtd_prontuarios conta cada prontuário uma vez
+    assert resumo_gravado() == {c: v for c, v in _totais_resumo().items() if any(v)}
+    assert sum(r.qtd_erros for r in db.session.query(ResumoDiario)) == 5
+    assert sum(r.qtd_prontuarios for r in db.session.query(ResumoDiario).filter(ResumoDiario.tipo_erro_id > 0)) == 3
+
+
+def test_edicao_de_erros_so_mexe_no_que_mudou(cliente):
+    ontem = datetime.now() - timedelta(days=1)
+    p = Prontuario(beneficiario='Paciente', atendimento='S1', convenio='Convênio A', setor='Setor A')
+    p.erros = [Erro(tipo='Assinatura', causa='Falta assinatura', responsavel_id=1, quantidade=1, data_criacao=ontem),
+               Erro(tipo='Assinatura', causa='Falta carimbo', responsavel_id=1, quantidade=3, data_criacao=ontem),
+               Erro(tipo='Documentação', causa='Folha faltando', responsavel_id=1, quantidade=1, data_criacao=ontem),
+               Erro(tipo='Assinatura', causa='Falta assinatura', responsavel_id=2, quantidade=1)]
+    db.session.add(p)
+    db.session.commit()
+    antes = {(e.tipo, e.causa, e.responsavel_id): (e.id, e.data_criacao) for e in p.erros}
+    igual, reduzido, removido, de_hoje = antes.values()
+
+    erros = [('Assinatura', 'Falta assinatura', 1, 1),    # igual
+             ('Assinatura', 'Falta carimbo', 1, 2),       # reduzido na própria linha
+             ('Assinatura', 'Falta assinatura', 2, 3),    # aumentado na linha de hoje
+             ('Documentação', 'Folha faltando', 2, 1)]    # novo; ('Documentação', 'Folha faltando', 1) sai
+    resposta = cliente.post(f'/api/atualizar_erros_responsavel/{p.id}', json={'erros': [
+        {'tipo': t, 'causa': c, 'responsavel_id': r, 'quantidade': q} for t, c, r, q in erros]})
+    assert resposta.status_code == 200
+    assert {k: resposta.get_json()[k] for k in ('inseridos', 'atualizados', 'removidos')} == {
+        'inseridos': 1, 'atualizados': 2, 'removidos': 1}
+
+    db.session.expire_all()
+    depois = {(e.tipo, e.causa, e.responsavel_id): (e.id, e.data_criacao, e.quantidade)
+              for e in db.session.query(Erro).filter_by(prontuario_id=p.id)}
+    assert depois[('Assinatura', 'Falta assinatura', 1)] == (*igual, 1)
+    assert depois[('Assinatura', 'Falta carimbo', 1)] == (*reduzido, 2)
+    assert depois[('Assinatura', 'Falta assinatura', 2)] == (*de_hoje, 3)
+    assert depois[('Documentação', 'Folha faltando', 2)][0] not in {i for i, _ in antes.values()}
+    assert ('Documentação', 'Folha faltando', 1) not in depois
+    assert db.session.get(Erro, removido[0]) is None
+    assert db.session.get(Prontuario, p.id).erro_count == 7
@@ -0,0 +1,58 @@
+import pytest
+
+import app as modulo_app
+from app import db, Prontuario, Erro, Convenio
+from conftest import resumo_gravado
+
+
+def _item(atendimento, **campos):
+    return {'beneficiario': f'Paciente {atendimento}', 'atendimento': atendimento, 'convenio': 'Convênio A',
+            'setor': 'Setor A', 'admissao': '2024-03-01', 'responsaveis': [1],
+            'erros': [{'tipo': 'Assinatura', 'causa': 'Falta assinatura', 'responsavel_id': 1}], **campos}
+
+
+def _estado():
+    prontuarios = sorted((p.atendimento, p.convenio, p.erro_count) for p in db.session.query(Prontuario))
+    erros = sorted((e.prontuario_id, e.causa, e.quantidade) for e in db.session.query(Erro))
+    return prontuarios, erros, resumo_gravado(), db.session.query(Convenio).count()
+
+
+@pytest.fixture
+def existente(cliente):
+    resposta = cliente.post('/api/prontuarios/batch', json=[_item('L1')])
+    assert resposta.status_code == 200
+    return resposta.get_json()['resultados'][0]['prontuario_id']
+
+
+@pytest.mark.parametrize('invalido, mensagem', [
+    (_item('L9', setor=''), 'setor'),
+    (_item('L9', convenio='Convênio X'), 'Convênio X'),
+    (_item('L9', erros=[{'tipo': 'Assinatura', 'causa': 'Falta carimbo', 'responsavel_id': 999}]), '999'),
+    ({'id': 999999, 'convenio': 'Convênio B'}, '999999'),
+])
+def test_item_invalido_no_lote_nao_grava_nada(cliente, existente, invalido, mensagem):
+    antes = _estado()
+    lote = [_item('L2'), {'id': existente, 'convenio': 'Convênio B', 'erros': []}, invalido]
+
+    resposta = cliente.post('/api/prontuarios/batch', json=lote)
+    assert resposta.status_code == 400
+    resultados = resposta.get_json()['resultados']
+    assert [r['sucesso'] for r in resultados] == [True, True, False]
+    assert mensagem in resultados[2]['erro']
+    db.session.expire_all()
+    assert _estado() == antes
+
+
+def test_falha_na_gravacao_desfaz_o_lote_inteiro(cliente, existente, monkeypatch):
+    antes = _estado()
+
+    def falhar(*args):
+        raise RuntimeError('falha simulada no resumo')
+
+    # Falha depois das inserções e atualizações, antes do commit
+    monkeypatch.setattr(modulo_app, '_atualizar_resumo', falhar)
+    resposta = cliente.post('/api/prontuarios/batch', json=[
+        _item('L2'), {'id': existente, 'convenio': 'Convênio B', 'erros': []}])
+    assert resposta.status_code == 500
+    db.session.expire_all()
+    assert _estado() == antes
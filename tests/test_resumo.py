@@ -0,0 +1,70 @@
+from datetime import datetime, timedelta
+from io import BytesIO
+
+from openpyxl import Workbook
+
+from app import (db, Prontuario, STATUS_ARQUIVAVEL, arquivar_prontuarios, consultar_arquivo, estado_arquivo,
+                 importar_planilha, _somar_contribuicoes, _totais_resumo)
+from conftest import resumo_gravado
+
+
+def _esperado():
+    """Totais recalculados do zero: banco quente mais o arquivo"""
+    totais = _totais_resumo()
+    if estado_arquivo() is not None:
+        _somar_contribuicoes(totais, consultar_arquivo(lambda sessao: _totais_resumo(sessao=sessao)))
+    return {chave: list(valores) for chave, valores in totais.items() if any(valores)}
+
+
+def _lancamento(atendimento, convenio='Convênio A', erros=()):
+    return {'beneficiario': f'Paciente {atendimento}', 'atendimento': atendimento, 'convenio': convenio,
+            'setor': 'Setor A', 'admissao': '2024-03-01', 'responsaveis': [1],
+            'erros': [{'tipo': t, 'causa': c, 'quantidade': q, 'responsavel_id': 1} for t, c, q in erros]}
+
+
+def test_cada_escrita_mantem_o_resumo_igual_ao_recalculo(cliente):
+    def escrever(metodo, url, payload):
+        resposta = getattr(cliente, metodo)(url, json=payload)
+        assert resposta.status_code == 200, resposta.get_json()
+        assert resumo_gravado() == _esperado(), url
+        return resposta.get_json()
+
+    # Lançamento único
+    id_a1 = escrever('post', '/api/adicionar_prontuario',
+                     _lancamento('A1', erros=[('Assinatura', 'Falta assinatura', 2)]))['prontuario_id']
+
+    # Lote: um novo e a atualização do A1 (convênio e erros mudam)
+    escrever('post', '/api/prontuarios/batch', [
+        _lancamento('A2', 'Convênio B', [('Documentação', 'Folha faltando', 1)]),
+        {'id': id_a1, 'convenio': 'Convênio B', 'erros': [{'tipo': 'Assinatura', 'causa': 'Falta carimbo',
+                                                          'responsavel_id': 2}]},
+    ])
+
+    # Diferença de erros: troca as causas do A1
+    escrever('post', f'/api/atualizar_erros_responsavel/{id_a1}',
+             {'erros': [{'tipo': 'Assinatura', 'causa': 'Falta carimbo', 'responsavel_id': 2, 'quantidade': 3},
+                        {'tipo': 'Documentação', 'causa': 'Folha faltando', 'responsavel_id': 1}]})
+
+    # Importação: atualiza o A2 e cria o A3
+    wb = Workbook()
+    wb.active.append(['Atendimento', 'Beneficiário', 'Convênio', 'Setor', 'Tipo', 'Causa'])
+    wb.active.append(['A2', 'Paciente A2', 'Convênio B', 'Setor A', 'Assinatura', 'Falta assinatura'])
+    wb.active.append(['A3', 'Paciente A3', 'Convênio A', 'Setor A', None, None])
+    planilha = BytesIO()
+    wb.save(planilha)
+    planilha.seek(0)
+    assert importar_planilha(planilha)['linhas_invalidas'] == 0
+    assert resumo_gravado() == _esperado()
+
+    # Status em lote: entrega A1 e A2 ao faturamento
+    ids = [id_a1, db.session.query(Prontuario.id).filter_by(atendimento='A2').scalar()]
+    escrever('post', '/api/prontuarios/status', {'ids': ids, 'status': STATUS_ARQUIVAVEL})
+
+    # Arquivamento: os arquivados continuam no resumo do banco quente
+    tabela = Prontuario.__table__
+    db.session.execute(tabela.update().where(tabela.c.id.in_(ids))
+                       .values(enviado_faturamento=datetime.now() - timedelta(days=200)))
+    db.session.commit()
+    assert arquivar_prontuarios(180) == 2
+    assert resumo_gravado() == _esperado()
+    assert db.session.query(Prontuario).count() == 1